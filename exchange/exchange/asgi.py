@@ -0,0 +1,25 @@
+"""
+ASGI config for exchange project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+Stock events stream is served by the event loop directly, other requests go to Django.
+
+For more information on this file, see
+https://docs.djangoproject.com/en/3.0/howto/deployment/asgi/
+"""
+
+import os
+
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'exchange.settings')
+
+django_application = get_asgi_application()
+
+from exchange.stocks.events import EVENTS_PATH, events_application  # noqa: E402 apps must be loaded first
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'http' and scope['path'] == EVENTS_PATH:
+        return await events_application(scope, receive, send)
+    return await django_application(scope, receive, send)
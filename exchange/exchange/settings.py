@@ -83,7 +83,26 @@ DATABASES = {
         'PASSWORD': '123456',
         'HOST': 'localhost',
         'PORT': '',
-    }
+    },
+    # read replica, add its alias to STOCKS_SETTINGS['READ_REPLICAS'] to use it
+    # 'replica': {
+    #     'ENGINE': 'django.db.backends.postgresql_psycopg2',
+    #     'NAME': 'exchange',
+    #     'USER': 'exchange',
+    #     'PASSWORD': '123456',
+    #     'HOST': 'replica.localhost',
+    #     'PORT': '',
+    #     'TEST': {'MIRROR': 'default'},
+    # },
+}
+
+DATABASE_ROUTERS = ['exchange.stocks.routers.PrimaryReplicaRouter']
+
+# local memory works for single process only, use memcached or redis with several ones
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
 }
 
 
@@ -134,9 +153,78 @@ REST_FRAMEWORK = {
 
 # it is just for example
 STOCKS_SETTINGS = {
+    # currency code -> master stock pk or list of master sub-stocks pks,
+    # first one is primary. Sub-stock for commission and exchange income is picked by user,
+    # payouts are made by primary one, which other sub-stocks are swept into by consolidation.
+    # Sub-stocks of one currency must belong to different service users.
     'MASTER_STOCKS': {
         'USD': 1,
         'RUB': 2,
     },
-    'COMMISSION': 0.05
+    'COMMISSION': 0.05,
+    # rounding of commissions and converted amounts to minor units of currency,
+    # money.rounding() changes it for current thread
+    'ROUNDING': 'ROUND_HALF_EVEN',
+    # 'immediate' - commission is moved to master stock by each transfer,
+    # 'accrual' - it is journaled and moved by settle_commissions command
+    'COMMISSION_MODE': 'immediate',
+    'BATCH_MAX_SIZE': 500,
+    'CURRENCY_REGISTRY_TTL': 300,
+    'EXPORT_CHUNK_SIZE': 2000,
+    # seconds to keep responses of requests made with Idempotency-Key header
+    'IDEMPOTENCY_KEY_TTL': 24 * 60 * 60,
+    # collect request and service timings, exposed by /metrics/ in Prometheus format
+    'METRICS_ENABLED': False,
+    # POST /transactions/ only queues transaction and returns 202,
+    # it is executed by process_transaction_queue workers
+    'ASYNC_TRANSACTIONS': False,
+    # POST /transactions/ only queues exchange and returns 202, queued exchanges are executed
+    # together every WINDOW seconds by match_exchanges command, at most MAX_ORDERS at once.
+    # Opposite flows are netted, so master stocks are written once per batch with residual.
+    'EXCHANGE_MATCHING': {
+        'ENABLED': False,
+        'WINDOW': 0.5,
+        'MAX_ORDERS': 500,
+    },
+    # database aliases for reads, user's reads go to primary for REPLICA_PIN_SECONDS after his write.
+    # Pins are kept in default cache, which must be shared between processes then.
+    'READ_REPLICAS': [],
+    'REPLICA_PIN_SECONDS': 5,
+    # alias from CACHES for GET responses of currencies and stocks, None disables caching.
+    # Versions of cached data are kept there too, so it must be shared between processes.
+    'RESPONSE_CACHE': 'default',
+    'RESPONSE_CACHE_TTL': 300,
+    # balance and transaction events streamed to clients by /events/ of ASGI application.
+    # LocalBackend reaches clients of the same process only, PostgresBackend uses NOTIFY.
+    # Its listener reconnects after RECONNECT_DELAY seconds when connection fails.
+    'EVENTS': {
+        'ENABLED': False,
+        'BACKEND': 'exchange.stocks.events.LocalBackend',
+        'HEARTBEAT': 15,
+        'QUEUE_SIZE': 100,
+        'RECONNECT_DELAY': 1,
+    },
+    # transactions of months older than this are moved to archive table by archive_transactions command
+    'ARCHIVE_AFTER_MONTHS': 12,
+    # retries of operations failed with deadlock or serialization error, backoff is in seconds
+    'LOCK_RETRY': {
+        'ATTEMPTS': 5,
+        'BACKOFF': 0.01,
+        'MAX_BACKOFF': 0.5,
+    },
+    # rates are cached for TTL seconds, then stale rates are served for STALE_TTL seconds
+    # while they are refreshed in background
+    'EXCHANGE_RATES': {
+        'PROVIDER': 'exchange.stocks.rates.StubRateProvider',
+        'OPTIONS': {
+            'rates': {
+                'USD': 65,
+                'EUR': 75,
+                'RUB': 1,
+            },
+        },
+        'TTL': 60,
+        'STALE_TTL': 600,
+        'REFRESH_INTERVAL': 30,
+    },
 }
@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class StocksConfig(AppConfig):
     name = 'exchange.stocks'
+
+    def ready(self):
+        from .registry import check_master_stocks_settings
+        check_master_stocks_settings()
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors: norlyakov
+:Date: 18.10.2026
+"""
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .locking import retry_on_conflict
+from .models import Transaction, TransactionStatuses, ArchivedTransaction
+
+ARCHIVED_FIELDS = [
+    'id', 'created', 'updated', 'stock_from_id', 'stock_to_id', 'value', 'type', 'related_transaction_id',
+    'status', 'error',
+]
+
+
+def get_archive_cutoff(now=None):
+    """Start of the oldest month kept in hot table, earlier months are closed and can be archived"""
+    now = timezone.localtime(now or timezone.now())
+    month = now.year * 12 + now.month - 1 - settings.STOCKS_SETTINGS['ARCHIVE_AFTER_MONTHS']
+    return now.replace(year=month // 12, month=month % 12 + 1, day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def get_archive_boundary():
+    """Creation time of the latest archived transaction, None if archive is empty. Later ones are in hot table."""
+    return ArchivedTransaction.objects.order_by('-created').values_list('created', flat=True).first()
+
+
+def needs_archive(date_from, boundary):
+    """Range starting at date_from (None - from the beginning) has archived transactions"""
+    return boundary is not None and (date_from is None or date_from <= boundary)
+
+
+@retry_on_conflict
+def archive_batch(cutoff, batch_size):
+    """
+    Moves up to batch_size transactions created before cutoff to archive. Pending ones stay,
+    they are not executed yet. Rows are locked, so transaction being revoked is moved after it.
+    Returns number of moved transactions.
+    """
+    with transaction.atomic():
+        rows = list(Transaction.objects.filter(
+            created__lt=cutoff,
+        ).exclude(
+            status=TransactionStatuses.pending,
+        ).order_by('pk').select_for_update().values(*ARCHIVED_FIELDS)[:batch_size])
+        if not rows:
+            return 0
+        ArchivedTransaction.objects.bulk_create([ArchivedTransaction(**row) for row in rows])
+        Transaction.objects.filter(pk__in=[row['id'] for row in rows]).delete()
+    return len(rows)
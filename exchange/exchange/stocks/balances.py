@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors: norlyakov
+:Date: 18.10.2026
+"""
+from contextlib import contextmanager
+
+from django.db import transaction
+from django.db.models import Sum, Q, F, Max, OuterRef, Subquery
+from django.utils import timezone
+
+from .archive import get_archive_boundary, needs_archive
+from .locking import lock_stocks, retry_on_conflict
+from .models import (
+    Stock, Transaction, ArchivedTransaction, TransactionStatuses, CommissionAccrual, StockBalanceSnapshot,
+)
+
+
+def get_balance_change(stock_pk, after, until):
+    """
+    Change of stock's balance by done transactions and commission accruals created in (after, until].
+    Each sum is taken by index on (stock, created), archive is summed only if range reaches it.
+    """
+    models = [Transaction]
+    if needs_archive(after, get_archive_boundary()):
+        models.append(ArchivedTransaction)
+
+    change = 0
+    for model in models:
+        done = model.objects.filter(status=TransactionStatuses.done, created__gt=after, created__lte=until)
+        change += done.filter(stock_to=stock_pk).aggregate(total=Sum('value'))['total'] or 0
+        change -= done.filter(stock_from=stock_pk).aggregate(total=Sum('value'))['total'] or 0
+    accrued = CommissionAccrual.objects.filter(
+        stock=stock_pk, created__gt=after, created__lte=until,
+    ).aggregate(total=Sum('value'))['total'] or 0
+    return change - accrued
+
+
+@contextmanager
+def consistent_read():
+    """
+    Transaction in which all queries see the same snapshot of db without locking rows.
+    Each statement of READ COMMITTED transaction in Postgres gets a new snapshot, so isolation level is raised.
+    It can be set only before the first query, so inside outer transaction its level is kept.
+    """
+    connection = transaction.get_connection()
+    outermost = not connection.in_atomic_block
+    with transaction.atomic():
+        if outermost and connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY')
+        yield
+
+
+def get_balance_at(stock, at):
+    """
+    Balance of stock at given time, counted from the nearest snapshot before it or after it,
+    so only transactions between snapshot and given time are summed.
+    Stock without snapshots is counted back from its actual value, which is read in the same snapshot
+    as transactions, so writers are not blocked.
+    """
+    snapshots = StockBalanceSnapshot.objects.filter(stock=stock)
+    before = snapshots.filter(taken_at__lte=at).order_by('-taken_at').first()
+    after = snapshots.filter(taken_at__gt=at).order_by('taken_at').first()
+
+    if before and (not after or at - before.taken_at <= after.taken_at - at):
+        return before.value + get_balance_change(stock.pk, before.taken_at, at)
+    if after:
+        return after.value - get_balance_change(stock.pk, at, after.taken_at)
+
+    with consistent_read():
+        value = Stock.objects.filter(pk=stock.pk).values_list('value', flat=True).get()
+        # transactions created before now and not committed yet are neither in value nor in snapshot
+        now = timezone.now()
+        if at >= now:
+            return value
+        return value - get_balance_change(stock.pk, at, now)
+
+
+def get_stocks_to_snapshot(pk_from, limit):
+    """Pks of stocks, starting from pk_from, which were changed after their last snapshot or don't have it"""
+    last_taken_at = StockBalanceSnapshot.objects.filter(
+        stock=OuterRef('pk'),
+    ).order_by().values('stock').annotate(last=Max('taken_at')).values('last')
+    return list(
+        Stock.objects.filter(pk__gte=pk_from).annotate(
+            last_taken_at=Subquery(last_taken_at),
+        ).filter(
+            Q(last_taken_at__isnull=True) | Q(updated__gt=F('last_taken_at')),
+        ).order_by('pk').values_list('pk', flat=True)[:limit]
+    )
+
+
+@retry_on_conflict
+def take_snapshots(stock_pks):
+    """
+    Saves actual balances of stocks. They are locked while snapshot time is taken,
+    so every transaction of stocks is either included or is created after it.
+    """
+    with transaction.atomic():
+        locked_stocks = lock_stocks(stock_pks)
+        taken_at = timezone.now()
+        return StockBalanceSnapshot.objects.bulk_create([
+            StockBalanceSnapshot(stock=stock, taken_at=taken_at, value=stock.value)
+            for stock in locked_stocks.values()
+        ])
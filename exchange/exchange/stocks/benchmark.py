@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors: norlyakov
+:Date: 18.10.2026
+"""
+import math
+import multiprocessing
+import random
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.db import connection, connections, DatabaseError
+from rest_framework import serializers
+
+from .errors import TransactionCantBeRevoked
+from .locking import get_retry_stats, retry_counters
+from .models import Currency, Stock
+from .money import to_minor
+from .utils import UserTransactionService
+
+SCENARIOS = ('uniform', 'hot_user', 'hot_master')
+OPERATIONS = ('common', 'exchange', 'revoke')
+POOLS = ('thread', 'process')
+
+BENCHMARK_CURRENCIES = ('USD', 'RUB')
+# in major units
+INITIAL_VALUE = Decimal('1000000000')
+
+
+class QueryCounter:
+    """
+    Database execute wrapper counting queries of one connection while active. Time of SELECT ... FOR UPDATE
+    queries is summed as lock wait, on a contended row it is mostly time of waiting for the lock.
+    """
+
+    def __init__(self):
+        self.active = False
+        self.queries = 0
+        self.lock_wait = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        if not self.active:
+            return execute(sql, params, many, context)
+        self.queries += 1
+        if 'FOR UPDATE' not in sql:
+            return execute(sql, params, many, context)
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.lock_wait += time.perf_counter() - start
+
+
+def seed(users_count):
+    """
+    Creates users_count users with a stock in every benchmark currency and one master stock per currency.
+    Returns (users' stocks as list of dicts currency code -> stock, MASTER_STOCKS setting for them).
+    """
+    run_id = uuid.uuid4().hex[:8]
+    currencies = {
+        code: Currency.objects.get_or_create(code=code, defaults={'name': code})[0]
+        for code in BENCHMARK_CURRENCIES
+    }
+
+    master = User.objects.create(username=f'bench-{run_id}-master')
+    master_stocks = {
+        code: Stock.objects.create(user=master, currency=currency,
+                                   value=to_minor(INITIAL_VALUE * users_count, currency.scale))
+        for code, currency in currencies.items()
+    }
+
+    users = User.objects.bulk_create([User(username=f'bench-{run_id}-{i}') for i in range(users_count)])
+    if users and users[0].pk is None:
+        # backend can't return pks of created rows
+        users = list(User.objects.filter(username__startswith=f'bench-{run_id}-').exclude(pk=master.pk))
+    Stock.objects.bulk_create([
+        Stock(user=user, currency=currency, value=to_minor(INITIAL_VALUE, currency.scale))
+        for user in users for currency in currencies.values()
+    ])
+
+    codes = {currency.pk: code for code, currency in currencies.items()}
+    users_stocks = {}
+    for stock in Stock.objects.filter(user__in=users):
+        users_stocks.setdefault(stock.user_id, {})[codes[stock.currency_id]] = stock
+    return list(users_stocks.values()), {code: stock.pk for code, stock in master_stocks.items()}
+
+
+def plan_operations(users_stocks, scenario, operation, count, seed_value=None):
+    """
+    Returns list of (operation, stock_from, stock_to, value).
+    uniform - random users and currencies, hot_user - every operation is made from the first user's stock,
+    hot_master - random users, but single currency and exchange direction, so all hit the same master stocks.
+    """
+    rnd = random.Random(seed_value)
+    operations = []
+    for _ in range(count):
+        if scenario == 'hot_master':
+            code_from, code_to = BENCHMARK_CURRENCIES
+        else:
+            code_from, code_to = rnd.sample(BENCHMARK_CURRENCIES, 2)
+
+        user_from = users_stocks[0] if scenario == 'hot_user' else rnd.choice(users_stocks)
+        if operation == 'exchange':
+            stock_from, stock_to = user_from[code_from], user_from[code_to]
+        else:
+            user_to = rnd.choice([user for user in users_stocks if user is not user_from])
+            stock_from, stock_to = user_from[code_from], user_to[code_from]
+
+        # in minor units
+        value = rnd.randint(100, 10000)
+        operations.append((operation, stock_from, stock_to, value))
+    return operations
+
+
+def prepare_operation(operation, stock_from, stock_to, value):
+    """Returns function making operation, transaction for revoke is created here and isn't measured"""
+    if operation == 'revoke':
+        orig_transaction = UserTransactionService.common(value, stock_from, stock_to)
+        return lambda: UserTransactionService.revoke(orig_transaction)
+    return lambda: getattr(UserTransactionService, operation)(value, stock_from, stock_to)
+
+
+def run_chunk(operations):
+    """Runs operations one by one on db connection of current thread"""
+    counter = QueryCounter()
+    latencies = []
+    errors = 0
+    with connection.execute_wrapper(counter):
+        for operation in operations:
+            try:
+                make_operation = prepare_operation(*operation)
+                counter.active = True
+                start = time.perf_counter()
+                make_operation()
+                latencies.append(time.perf_counter() - start)
+            except (serializers.ValidationError, TransactionCantBeRevoked, DatabaseError):
+                errors += 1
+            finally:
+                counter.active = False
+
+    return {
+        'latencies': latencies,
+        'queries': counter.queries,
+        'lock_wait': counter.lock_wait,
+        'errors': errors,
+    }
+
+
+def run_worker_chunk(operations, collect_retry_stats=False):
+    """Runs chunk in pool worker, retry counters are collected by worker process only"""
+    if collect_retry_stats:
+        retry_counters.reset()
+    try:
+        result = run_chunk(operations)
+    finally:
+        connection.close()
+    result['retry_stats'] = get_retry_stats() if collect_retry_stats else None
+    return result
+
+
+def percentile(sorted_values, percent):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[max(0, math.ceil(percent / 100 * len(sorted_values)) - 1)]
+
+
+def run(operations, workers=1, pool='thread'):
+    """
+    Drives operations from pool of workers, each worker runs its part of operations sequentially.
+    Single thread worker runs in calling thread. Returns report dict.
+    SQLite allows single writer, so concurrent workers mostly fail there with "database is locked",
+    it's good for single worker baselines only. Lock waits are measured on PostgreSQL only,
+    because SQLite doesn't have SELECT ... FOR UPDATE.
+    """
+    chunks = [operations[i::workers] for i in range(workers)]
+    retry_counters.reset()
+
+    start = time.perf_counter()
+    if pool == 'process':
+        # children get copies of connections otherwise, they must open their own
+        connections.close_all()
+        with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('fork')) as executor:
+            results = list(executor.map(run_worker_chunk, chunks, [True] * workers))
+    elif workers == 1:
+        results = [run_chunk(chunks[0])]
+    else:
+        with ThreadPoolExecutor(workers) as executor:
+            results = list(executor.map(run_worker_chunk, chunks))
+    duration = time.perf_counter() - start
+
+    if pool == 'process':
+        retry_stats = {}
+        for result in results:
+            for name, count in result['retry_stats'].items():
+                retry_stats[name] = retry_stats.get(name, 0) + count
+    else:
+        retry_stats = get_retry_stats()
+
+    latencies = sorted(latency for result in results for latency in result['latencies'])
+    done = len(latencies)
+    errors = sum(result['errors'] for result in results)
+    attempted = done + errors
+    return {
+        'operations': done,
+        'errors': errors,
+        'duration': duration,
+        'tps': done / duration if duration else 0.0,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'lock_wait_ms': sum(result['lock_wait'] for result in results) * 1000,
+        # failed operations made queries too
+        'queries_per_operation': sum(result['queries'] for result in results) / attempted if attempted else 0.0,
+        **retry_stats,
+    }
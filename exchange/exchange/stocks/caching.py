@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors: norlyakov
+:Date: 18.10.2026
+"""
+import functools
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils.http import parse_etags, quote_etag
+from rest_framework import status
+from rest_framework.response import Response
+
+from . import routers
+from .models import Currency, Stock
+from .registry import master_stocks
+
+VERSION_KEY = 'stocks:version:{}'
+RESPONSE_KEY = 'stocks:response:{}'
+CURRENCIES_SCOPE = 'currencies'
+
+
+def get_cache():
+    return caches[settings.STOCKS_SETTINGS['RESPONSE_CACHE']]
+
+
+def is_enabled():
+    return settings.STOCKS_SETTINGS['RESPONSE_CACHE'] is not None
+
+
+def get_stocks_scope(user_id):
+    return f'stocks:{user_id}'
+
+
+def _new_version():
+    # version created after eviction must not repeat old one, which responses could be cached in
+    return time.time_ns() // 1000
+
+
+def get_version(scope):
+    cache = get_cache()
+    key = VERSION_KEY.format(scope)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, _new_version(), None)
+        version = cache.get(key)
+    return version
+
+
+def _increase_version(scope):
+    cache = get_cache()
+    key = VERSION_KEY.format(scope)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, _new_version(), None)
+
+
+def bump_version(scope):
+    """
+    Version is increased after commit, so response cached by concurrent request
+    before changes are visible can't get new version.
+    """
+    if is_enabled():
+        transaction.on_commit(functools.partial(_increase_version, scope))
+
+
+def bump_stocks_versions(stock_pks):
+    """Bumps versions of owners of stocks changed without signals, master stocks' owners are known by registry"""
+    if not is_enabled():
+        return
+    user_ids = set()
+    other_pks = []
+    for pk in stock_pks:
+        owner_id = master_stocks.get_owner_id(pk)
+        if owner_id is None:
+            other_pks.append(pk)
+        else:
+            user_ids.add(owner_id)
+    if other_pks:
+        user_ids.update(Stock.objects.filter(pk__in=other_pks).values_list('user_id', flat=True))
+    for user_id in user_ids:
+        bump_version(get_stocks_scope(user_id))
+
+
+def get_etag(scope, full_path):
+    version = get_version(scope)
+    return quote_etag(hashlib.md5(f'{scope}:{version}:{full_path}'.encode()).hexdigest())
+
+
+def cached_response(get_scope):
+    """
+    Serves GET viewset action from cache while version of its scope is the same.
+    ETag is made of version, so request with current one in If-None-Match gets 304 without any lookups.
+    Response is cached under current version, so it is read from primary - lagging replica could miss changes
+    which increased version.
+    get_scope takes request and returns scope name.
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(view, request, *args, **kwargs):
+            if not is_enabled():
+                return handler(view, request, *args, **kwargs)
+
+            etag = get_etag(get_scope(request), request.get_full_path())
+            if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+                response = Response(status=status.HTTP_304_NOT_MODIFIED)
+            else:
+                cache = get_cache()
+                key = RESPONSE_KEY.format(etag.strip('"'))
+                data = cache.get(key)
+                if data is not None:
+                    response = Response(data)
+                else:
+                    was_pinned = routers.is_pinned()
+                    routers.pin_to_primary()
+                    try:
+                        response = handler(view, request, *args, **kwargs)
+                    finally:
+                        if not was_pinned:
+                            routers.unpin()
+                    if response.status_code == status.HTTP_200_OK:
+                        cache.set(key, response.data, settings.STOCKS_SETTINGS['RESPONSE_CACHE_TTL'])
+
+            if response.status_code in (status.HTTP_200_OK, status.HTTP_304_NOT_MODIFIED):
+                response['ETag'] = etag
+            return response
+        return wrapper
+    return decorator
+
+
+@receiver(post_save, sender=Stock)
+@receiver(post_delete, sender=Stock)
+def bump_by_stock(sender, instance, **kwargs):
+    bump_version(get_stocks_scope(instance.user_id))
+
+
+@receiver(post_save, sender=Currency)
+@receiver(post_delete, sender=Currency)
+def bump_by_currency(sender, **kwargs):
+    bump_version(CURRENCIES_SCOPE)
+
+
+@receiver(setting_changed)
+def clear_by_settings(setting, **kwargs):
+    # cached responses depend on settings, which are changed by tests
+    if setting == 'STOCKS_SETTINGS' and is_enabled():
+        get_cache().clear()
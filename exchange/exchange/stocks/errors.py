@@ -15,3 +15,7 @@ class TransactionAlreadyExecuted(TransactionError):
 
 class TransactionCantBeRevoked(TransactionError):
     pass
+
+
+class ExchangeRateError(RuntimeError):
+    pass
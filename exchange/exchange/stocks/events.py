@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors: norlyakov
+:Date: 18.10.2026
+"""
+import asyncio
+import functools
+import json
+import logging
+import select
+import threading
+import time
+from http.cookies import SimpleCookie
+from types import SimpleNamespace
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user
+from django.db import connection, connections, transaction
+from django.utils.module_loading import import_string
+
+from .money import to_major
+from .registry import currencies
+
+logger = logging.getLogger(__name__)
+
+EVENTS_PATH = '/events/'
+NOTIFY_CHANNEL = 'stocks_events'
+# NOTIFY payload must be shorter than 8000 bytes
+NOTIFY_MAX_PAYLOAD = 7900
+
+
+def get_events_settings():
+    return settings.STOCKS_SETTINGS['EVENTS']
+
+
+class Subscription:
+    """Events of one user for one connected client, queue lives in event loop of client"""
+
+    def __init__(self, user_id, loop, queue_size):
+        self.user_id = user_id
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        # client which doesn't read events is disconnected, it gets actual state on reconnect
+        self.overflowed = False
+
+    def put(self, event):
+        if self.overflowed:
+            return
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.overflowed = True
+            # waiting client is woken up to be disconnected
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(None)
+
+
+class EventBroker:
+    """In-process fan-out of events to subscriptions, publishing is safe from any thread"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscriptions = {}  # user id -> set of subscriptions
+
+    def subscribe(self, user_id):
+        subscription = Subscription(user_id, asyncio.get_running_loop(), get_events_settings()['QUEUE_SIZE'])
+        with self._lock:
+            self._subscriptions.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.user_id, set())
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                self._subscriptions.pop(subscription.user_id, None)
+
+    def has_subscribers(self, user_id):
+        with self._lock:
+            return bool(self._subscriptions.get(user_id))
+
+    def dispatch(self, user_id, event):
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(user_id, ()))
+        for subscription in subscriptions:
+            subscription.loop.call_soon_threadsafe(subscription.put, event)
+
+
+broker = EventBroker()
+
+
+class LocalBackend:
+    """Events reach only clients connected to the same process"""
+
+    def publish(self, messages):
+        for user_id, event in messages:
+            broker.dispatch(user_id, event)
+
+    def start(self):
+        pass
+
+
+class PostgresBackend:
+    """
+    Events are sent by NOTIFY, so they reach clients connected to any process.
+    Every ASGI process LISTENs by its own connection in background thread.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def publish(self, messages):
+        with connection.cursor() as cursor:
+            for payload in split_payloads(messages):
+                cursor.execute('SELECT pg_notify(%s, %s)', [NOTIFY_CHANNEL, payload])
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self.listen, name='stocks-events', daemon=True)
+                self._thread.start()
+
+    def listen(self):
+        """Events notified while listener reconnects are lost, clients get actual state on their reconnect"""
+        while True:
+            try:
+                self._listen()
+            except Exception:
+                logger.exception('Stock events listener failed, reconnecting')
+                time.sleep(get_events_settings()['RECONNECT_DELAY'])
+
+    def _listen(self):
+        wrapper = connections['default']
+        listener = wrapper.get_new_connection(wrapper.get_connection_params())
+        try:
+            listener.autocommit = True
+            with listener.cursor() as cursor:
+                cursor.execute(f'LISTEN {NOTIFY_CHANNEL}')
+            while True:
+                if select.select([listener], [], [], get_events_settings()['HEARTBEAT']) == ([], [], []):
+                    continue
+                listener.poll()
+                while listener.notifies:
+                    notify = listener.notifies.pop(0)
+                    for user_id, event in json.loads(notify.payload):
+                        broker.dispatch(user_id, event)
+        finally:
+            listener.close()
+
+
+def split_payloads(messages, max_size=NOTIFY_MAX_PAYLOAD):
+    """
+    JSON lists of messages, each one shorter than max_size bytes.
+    Payload is ASCII, so its length is its size. Message which doesn't fit alone is dropped.
+    """
+    parts = []
+    size = 2  # brackets
+    for message in messages:
+        part = json.dumps(message)
+        if len(part) + 2 > max_size:
+            logger.error('Stock event of user %s is too large to be published', message[0])
+            continue
+        if parts and size + len(part) + 1 > max_size:
+            yield f"[{','.join(parts)}]"
+            parts = []
+            size = 2
+        size += len(part) + (1 if parts else 0)
+        parts.append(part)
+    if parts:
+        yield f"[{','.join(parts)}]"
+
+
+@functools.lru_cache(maxsize=None)
+def get_backend(path):
+    return import_string(path)()
+
+
+def balance_event(stock):
+    currency = currencies.get(stock.currency_id)
+    return {
+        'type': 'balance',
+        'stock': stock.pk,
+        'currency': currency.code,
+        'value': str(to_major(stock.value, currency.scale)),
+    }
+
+
+def transaction_event(transaction_model, currency_id):
+    currency = currencies.get(currency_id)
+    return {
+        'type': 'transaction',
+        'id': transaction_model.pk,
+        'created': transaction_model.created.isoformat(),
+        'transaction_type': transaction_model.type,
+        'stock_from': transaction_model.stock_from_id,
+        'stock_to': transaction_model.stock_to_id,
+        'value': str(to_major(transaction_model.value, currency.scale)),
+        'status': transaction_model.status,
+    }
+
+
+def _publish_changes(transaction_model, stocks):
+    """Events are made at commit, so balances include all changes of db transaction"""
+    messages = [(stock.user_id, balance_event(stock)) for stock in stocks]
+    if transaction_model is not None:
+        currency_id = stocks[0].currency_id
+        for user_id in {stock.user_id for stock in stocks}:
+            messages.append((user_id, transaction_event(transaction_model, currency_id)))
+    try:
+        get_backend(get_events_settings()['BACKEND']).publish(messages)
+    except Exception:
+        # changes are committed already, clients get them on reconnect
+        logger.exception('Failed to publish stock events')
+
+
+def publish_changes(transaction_model, stocks):
+    """
+    Publishes balance events of locked stocks and transaction event to their owners after commit.
+    Stocks updated by F() (master ones) have unknown balance and are skipped.
+    """
+    stocks = [stock for stock in stocks if stock is not None]
+    if get_events_settings()['ENABLED'] and stocks:
+        transaction.on_commit(functools.partial(_publish_changes, transaction_model, stocks))
+
+
+def _get_session_user_id(session_key):
+    engine = import_string(settings.SESSION_ENGINE)
+    user = get_user(SimpleNamespace(session=engine.SessionStore(session_key)))
+    return user.pk if user.is_authenticated else None
+
+
+def _format_event(event):
+    return f"event: {event['type']}\ndata: {json.dumps(event)}\n\n".encode()
+
+
+async def _wait_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def _send_empty(send, status):
+    await send({'type': 'http.response.start', 'status': status, 'headers': []})
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+async def events_application(scope, receive, send):
+    """
+    ASGI application streaming events of authenticated user as server-sent events.
+    Clients of process are served by its event loop, every one waits on its own queue.
+    """
+    if scope['method'] != 'GET':
+        return await _send_empty(send, 405)
+    cookies = SimpleCookie()
+    for name, value in scope['headers']:
+        if name == b'cookie':
+            cookies.load(value.decode('latin-1'))
+    session = cookies.get(settings.SESSION_COOKIE_NAME)
+    user_id = session and await sync_to_async(_get_session_user_id, thread_sensitive=True)(session.value)
+    if user_id is None:
+        return await _send_empty(send, 401)
+
+    events_settings = get_events_settings()
+    get_backend(events_settings['BACKEND']).start()
+    subscription = broker.subscribe(user_id)
+    disconnect = asyncio.ensure_future(_wait_disconnect(receive))
+    try:
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [
+            (b'content-type', b'text/event-stream'),
+            (b'cache-control', b'no-cache'),
+        ]})
+        while not disconnect.done():
+            event_waiter = asyncio.ensure_future(subscription.queue.get())
+            done, _ = await asyncio.wait(
+                {event_waiter, disconnect}, timeout=events_settings['HEARTBEAT'],
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            if event_waiter not in done:
+                event_waiter.cancel()
+                if not done:
+                    await send({'type': 'http.response.body', 'body': b': heartbeat\n\n', 'more_body': True})
+                continue
+            if subscription.overflowed:
+                break
+            await send({'type': 'http.response.body', 'body': _format_event(event_waiter.result()), 'more_body': True})
+        if not disconnect.done():
+            await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        broker.unsubscribe(subscription)
+        disconnect.cancel()
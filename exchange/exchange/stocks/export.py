@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors: norlyakov
+:Date: 18.10.2026
+"""
+import csv
+import json
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import StreamingHttpResponse
+
+from .money import to_major
+from .registry import currencies
+
+EXPORT_FIELDS = [
+    'id', 'created', 'type', 'stock_from', 'stock_to', 'currency', 'value', 'related_transaction', 'status',
+]
+
+CONTENT_TYPES = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+class Echo:
+    """File-like object which returns written line instead of buffering it"""
+
+    def write(self, value):
+        return value
+
+
+def transaction_to_row(transaction_model):
+    stock = transaction_model.stock_from or transaction_model.stock_to
+    currency = currencies.get(stock.currency_id)
+    return {
+        'id': transaction_model.pk,
+        'created': transaction_model.created.isoformat(),
+        'type': transaction_model.type,
+        'stock_from': transaction_model.stock_from_id,
+        'stock_to': transaction_model.stock_to_id,
+        'currency': currency.code,
+        'value': to_major(transaction_model.value, currency.scale),
+        'related_transaction': transaction_model.related_transaction_id,
+        'status': transaction_model.status,
+    }
+
+
+def iter_rows(querysets):
+    """
+    Rows of querysets one after another, archive goes first. They are fetched by server-side cursor,
+    so memory usage doesn't depend on history size.
+    """
+    for queryset in querysets:
+        queryset = queryset.select_related('stock_from', 'stock_to').order_by('created', 'id')
+        for transaction_model in queryset.iterator(chunk_size=settings.STOCKS_SETTINGS['EXPORT_CHUNK_SIZE']):
+            yield transaction_to_row(transaction_model)
+
+
+def iter_csv(querysets):
+    writer = csv.DictWriter(Echo(), fieldnames=EXPORT_FIELDS)
+    yield writer.writeheader()
+    for row in iter_rows(querysets):
+        yield writer.writerow(row)
+
+
+def iter_ndjson(querysets):
+    for row in iter_rows(querysets):
+        yield json.dumps(row, cls=DjangoJSONEncoder) + '\n'
+
+
+def export_transactions(querysets, output):
+    lines = iter_csv(querysets) if output == 'csv' else iter_ndjson(querysets)
+    response = StreamingHttpResponse(lines, content_type=CONTENT_TYPES[output])
+    response['Content-Disposition'] = f'attachment; filename="transactions.{output}"'
+    return response
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors: norlyakov
+:Date: 18.10.2026
+"""
+import functools
+import hashlib
+import json
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction, IntegrityError
+from django.utils import timezone
+from rest_framework import serializers, status
+from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
+
+from .locking import retry_on_conflict
+from .models import IdempotencyKey
+
+IDEMPOTENCY_KEY_HEADER = 'Idempotency-Key'
+REPLAYED_HEADER = 'Idempotent-Replayed'
+
+
+def get_expiry():
+    return timezone.now() - timedelta(seconds=settings.STOCKS_SETTINGS['IDEMPOTENCY_KEY_TTL'])
+
+
+def get_request_hash(request):
+    data = json.dumps(request.data, cls=JSONEncoder, sort_keys=True)
+    return hashlib.sha256(f'{request.method} {request.path} {data}'.encode()).hexdigest()
+
+
+def replay(stored, request_hash):
+    if stored.request_hash != request_hash:
+        return Response({'detail': f'{IDEMPOTENCY_KEY_HEADER} was already used with another request'},
+                        status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+    response = Response(json.loads(stored.response), status=stored.status_code)
+    response[REPLAYED_HEADER] = 'true'
+    return response
+
+
+@retry_on_conflict
+def execute_and_store(handler, key, request_hash, stored_expired, view, request, *args, **kwargs):
+    """Response is stored in the same db transaction as changes made by handler"""
+    with transaction.atomic():
+        if stored_expired:
+            IdempotencyKey.objects.filter(user=request.user, key=key).delete()
+        response = handler(view, request, *args, **kwargs)
+        IdempotencyKey.objects.create(
+            user=request.user,
+            key=key,
+            request_hash=request_hash,
+            status_code=response.status_code,
+            response=json.dumps(response.data, cls=JSONEncoder),
+        )
+    return response
+
+
+def idempotent(handler):
+    """
+    Makes viewset action safe to retry with Idempotency-Key header. Successful response is stored
+    and returned to retries without executing action again. Failed requests are not stored.
+    """
+    @functools.wraps(handler)
+    def wrapper(view, request, *args, **kwargs):
+        key = request.headers.get(IDEMPOTENCY_KEY_HEADER)
+        if key is None:
+            return handler(view, request, *args, **kwargs)
+        if not key or len(key) > IdempotencyKey._meta.get_field('key').max_length:
+            raise serializers.ValidationError({IDEMPOTENCY_KEY_HEADER: ['Invalid key']})
+
+        request_hash = get_request_hash(request)
+        stored = IdempotencyKey.objects.filter(user=request.user, key=key).first()
+        if stored and stored.created >= get_expiry():
+            return replay(stored, request_hash)
+
+        try:
+            return execute_and_store(handler, key, request_hash, stored is not None, view, request, *args, **kwargs)
+        except IntegrityError:
+            # concurrent request with the same key has won, its changes are kept and ours are rolled back
+            stored = IdempotencyKey.objects.filter(user=request.user, key=key).first()
+            if stored is None:
+                raise
+            return replay(stored, request_hash)
+
+    return wrapper
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors: norlyakov
+:Date: 18.10.2026
+"""
+import functools
+import logging
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.db import transaction, OperationalError
+from django.db.models import Case, When, Value, IntegerField
+
+from . import metrics
+from .models import Stock
+from .registry import master_stocks
+
+logger = logging.getLogger(__name__)
+
+SERIALIZATION_FAILURE = '40001'
+DEADLOCK_DETECTED = '40P01'
+
+
+class RetryCounters:
+    """Process wide counters of retried operations, safe to use from many threads"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._counters = {
+                'retries': 0,
+                'deadlocks': 0,
+                'serialization_failures': 0,
+                'exhausted': 0,
+            }
+
+    def increment(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def as_dict(self):
+        with self._lock:
+            return dict(self._counters)
+
+
+retry_counters = RetryCounters()
+
+
+def get_retry_stats():
+    return retry_counters.as_dict()
+
+
+def lock_stocks(stock_pks):
+    """
+    Locks all given stocks by single query. Rows are always locked in the same order -
+    users' stocks by pk and then master stocks by pk, so concurrent callers can't deadlock each other.
+    Master stocks which are only updated without locking must be updated after users' ones too.
+    Returns dict pk -> locked stock with actual value.
+    """
+    stock_pks = set(stock_pks)
+    ordering = ['pk']
+    master_stock_pks = stock_pks & master_stocks.get_all_pks()
+    if master_stock_pks:
+        is_master = Case(When(pk__in=master_stock_pks, then=Value(1)), default=Value(0), output_field=IntegerField())
+        ordering.insert(0, is_master)
+    stocks = Stock.objects.filter(pk__in=stock_pks).order_by(*ordering).select_for_update()
+    with metrics.timer(metrics.lock_seconds, 'stock'):
+        return {stock.pk: stock for stock in stocks}
+
+
+def _get_conflict_code(error):
+    code = getattr(error.__cause__, 'pgcode', None)
+    if code in (SERIALIZATION_FAILURE, DEADLOCK_DETECTED):
+        return code
+    return None
+
+
+def retry_on_conflict(func):
+    """
+    Reruns decorated function in new db transaction on deadlock or serialization failure.
+    Does nothing inside outer atomic block, because only whole transaction can be retried.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if transaction.get_connection().in_atomic_block:
+            return func(*args, **kwargs)
+
+        retry_settings = settings.STOCKS_SETTINGS['LOCK_RETRY']
+        attempts = retry_settings['ATTEMPTS']
+        for attempt in range(1, attempts + 1):
+            try:
+                with transaction.atomic():
+                    result = func(*args, **kwargs)
+                    commit_start = time.perf_counter()
+                metrics.observe(metrics.commit_seconds, time.perf_counter() - commit_start)
+                return result
+            except OperationalError as e:
+                code = _get_conflict_code(e)
+                if code is None:
+                    raise
+                retry_counters.increment('deadlocks' if code == DEADLOCK_DETECTED else 'serialization_failures')
+                if attempt == attempts:
+                    retry_counters.increment('exhausted')
+                    raise
+                retry_counters.increment('retries')
+
+                # exponential backoff with full jitter
+                backoff = min(retry_settings['MAX_BACKOFF'], retry_settings['BACKOFF'] * 2 ** (attempt - 1))
+                logger.info('%s failed with %s, retry %s of %s', func.__qualname__, code, attempt, attempts - 1)
+                time.sleep(random.uniform(0, backoff))
+
+    return wrapper
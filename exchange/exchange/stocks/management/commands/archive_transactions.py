@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors: norlyakov
+:Date: 18.10.2026
+"""
+from django.core.management.base import BaseCommand
+
+from ...archive import get_archive_cutoff, archive_batch
+
+
+class Command(BaseCommand):
+    help = ("Moves transactions of closed months older than STOCKS_SETTINGS['ARCHIVE_AFTER_MONTHS'] "
+            "to archive table in batches")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=10000, help='Transactions moved by one db transaction')
+
+    def handle(self, *args, **options):
+        cutoff = get_archive_cutoff()
+        archived = 0
+        while True:
+            moved = archive_batch(cutoff, options['batch_size'])
+            if not moved:
+                break
+            archived += moved
+        self.stdout.write(f'Archived {archived} transactions created before {cutoff.isoformat()}')
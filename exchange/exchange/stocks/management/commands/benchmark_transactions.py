@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors: norlyakov
+:Date: 18.10.2026
+"""
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ... import benchmark
+from ...registry import master_stocks
+
+REPORT_FORMAT = (
+    '{scenario:<10} {operation:<8} ops={operations} errors={errors} tps={tps:.1f} '
+    'p50={p50_ms:.2f}ms p99={p99_ms:.2f}ms lock_wait={lock_wait_ms:.1f}ms '
+    'queries/op={queries_per_operation:.1f} retries={retries} deadlocks={deadlocks} '
+    'serialization_failures={serialization_failures} exhausted={exhausted}'
+)
+
+
+class Command(BaseCommand):
+    help = ('Seeds users with stocks and measures transactions under concurrent load. '
+            'Writes to the configured database, so run it against a scratch SQLite or PostgreSQL one.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=100, help='Seeded users, each gets a stock per currency')
+        parser.add_argument('--operations', type=int, default=1000, help='Operations per scenario')
+        parser.add_argument('--operation', choices=benchmark.OPERATIONS, default='common')
+        parser.add_argument('--scenario', choices=benchmark.SCENARIOS, action='append',
+                            help='Contention scenario, may be repeated, all by default')
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--pool', choices=benchmark.POOLS, default='thread')
+        parser.add_argument('--seed', type=int, default=None, help='Random seed of planned operations')
+        parser.add_argument('--json', action='store_true', help='Print reports as JSON lines')
+
+    def handle(self, *args, **options):
+        if options['users'] < 2:
+            raise CommandError('At least 2 users are needed')
+        if options['workers'] < 1:
+            raise CommandError('At least 1 worker is needed')
+
+        users_stocks, master_stocks_setting = benchmark.seed(options['users'])
+        # seeded master stocks are used by this process and workers forked from it only
+        stocks_settings = settings.STOCKS_SETTINGS
+        settings.STOCKS_SETTINGS = {**stocks_settings, 'MASTER_STOCKS': master_stocks_setting}
+        master_stocks.invalidate()
+        try:
+            self.run_scenarios(users_stocks, options)
+        finally:
+            settings.STOCKS_SETTINGS = stocks_settings
+            master_stocks.invalidate()
+
+    def run_scenarios(self, users_stocks, options):
+        for scenario in options['scenario'] or benchmark.SCENARIOS:
+            operations = benchmark.plan_operations(
+                users_stocks, scenario, options['operation'], options['operations'], options['seed'],
+            )
+            report = benchmark.run(operations, workers=options['workers'], pool=options['pool'])
+            report.update(scenario=scenario, operation=options['operation'])
+            if options['json']:
+                self.stdout.write(json.dumps(report))
+            else:
+                self.stdout.write(REPORT_FORMAT.format(**report))
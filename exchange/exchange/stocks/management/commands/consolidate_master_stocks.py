@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors: norlyakov
+:Date: 18.10.2026
+"""
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ...money import to_major
+from ...registry import currencies, get_master_stock_pks
+from ...utils import UserTransactionService
+
+
+class Command(BaseCommand):
+    help = 'Sweeps balances of master sub-stocks into the primary master stock of each currency'
+
+    def add_arguments(self, parser):
+        parser.add_argument('currencies', nargs='*', help='Currency codes, all configured currencies by default')
+        parser.add_argument('--dry-run', action='store_true', help='Only show master balances')
+
+    def handle(self, *args, **options):
+        currency_codes = options['currencies'] or list(settings.STOCKS_SETTINGS['MASTER_STOCKS'])
+
+        for currency_code in currency_codes:
+            currency = currencies.get_by_code(currency_code)
+            if not currency:
+                raise CommandError(f'Currency {currency_code} does not exist')
+
+            shards_count = len(get_master_stock_pks(currency_code))
+            balance = to_major(UserTransactionService.get_master_balance(currency), currency.scale)
+            self.stdout.write(f'{currency_code}: {balance} on {shards_count} master stock(s)')
+
+            if options['dry_run'] or shards_count < 2:
+                continue
+
+            transactions = UserTransactionService.consolidate_master_stocks(currency_code)
+            for consolidation_transaction in transactions:
+                self.stdout.write(f'  swept {to_major(consolidation_transaction.value, currency.scale)} '
+                                  f'from stock {consolidation_transaction.stock_from_id}')
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors: norlyakov
+:Date: 18.10.2026
+"""
+from django.core.management.base import BaseCommand
+
+from ...idempotency import get_expiry
+from ...models import IdempotencyKey
+
+
+class Command(BaseCommand):
+    help = 'Deletes expired idempotency keys'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=10000, help='Keys deleted by one query')
+
+    def handle(self, *args, **options):
+        expiry = get_expiry()
+        deleted = 0
+        while True:
+            pks = list(IdempotencyKey.objects.filter(
+                created__lt=expiry,
+            ).values_list('pk', flat=True)[:options['batch_size']])
+            if not pks:
+                break
+            deleted += IdempotencyKey.objects.filter(pk__in=pks).delete()[0]
+        self.stdout.write(f'Deleted {deleted} expired idempotency keys')
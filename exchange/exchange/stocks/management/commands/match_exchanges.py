@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors: norlyakov
+:Date: 18.10.2026
+"""
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from ...models import TransactionStatuses
+from ...utils import UserTransactionService
+
+
+class Command(BaseCommand):
+    help = ('Executes exchanges queued while EXCHANGE_MATCHING is enabled by batches, '
+            'opposite flows of currencies are netted on master stocks.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--window', type=float, default=None,
+                            help='Seconds to collect exchanges between batches, EXCHANGE_MATCHING WINDOW by default')
+        parser.add_argument('--max-orders', type=int, default=None,
+                            help='Exchanges in one batch, EXCHANGE_MATCHING MAX_ORDERS by default')
+        parser.add_argument('--drain', action='store_true', help='Exit when queue is empty')
+
+    def handle(self, *args, **options):
+        matching_settings = settings.STOCKS_SETTINGS['EXCHANGE_MATCHING']
+        window = matching_settings['WINDOW'] if options['window'] is None else options['window']
+        max_orders = options['max_orders'] or matching_settings['MAX_ORDERS']
+
+        while True:
+            matched = UserTransactionService.match_exchanges(max_orders)
+            for matched_transaction in matched:
+                if matched_transaction.status == TransactionStatuses.failed:
+                    self.stdout.write(f'Transaction {matched_transaction.pk} failed: {matched_transaction.error}')
+            if not matched and options['drain']:
+                break
+            # full batch means more exchanges are waiting already
+            if len(matched) < max_orders:
+                time.sleep(window)
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors: norlyakov
+:Date: 18.10.2026
+"""
+import multiprocessing
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, connections
+
+from ...models import TransactionStatuses
+from ...utils import UserTransactionService
+
+
+class Command(BaseCommand):
+    help = ('Executes transactions queued in async mode by pool of worker processes. '
+            'Needs database with SELECT ... FOR UPDATE SKIP LOCKED to run more than one worker.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=1, help='Worker processes')
+        parser.add_argument('--interval', type=float, default=1.0,
+                            help='Seconds to wait when there is nothing to execute')
+        parser.add_argument('--drain', action='store_true', help='Exit when queue is empty')
+
+    def handle(self, *args, **options):
+        if options['workers'] == 1:
+            self.work(options['interval'], options['drain'])
+            return
+
+        # each process must open its own connection
+        connections.close_all()
+        context = multiprocessing.get_context('fork')
+        processes = [
+            context.Process(target=self.work_in_process, args=(options['interval'], options['drain']))
+            for _ in range(options['workers'])
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+
+    def work_in_process(self, interval, drain):
+        try:
+            self.work(interval, drain)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            connection.close()
+
+    def work(self, interval, drain):
+        while True:
+            queued_transaction = UserTransactionService.process_queued()
+            if queued_transaction is None:
+                if drain:
+                    break
+                time.sleep(interval)
+                continue
+
+            if queued_transaction.status == TransactionStatuses.failed:
+                self.stdout.write(f'Transaction {queued_transaction.pk} failed: {queued_transaction.error}')
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors: norlyakov
+:Date: 18.10.2026
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from ...models import Stock
+from ...provisioning import provision_currency
+from ...registry import currencies
+
+
+class Command(BaseCommand):
+    help = 'Creates stocks of currency for all active users which do not have it, by batches of users.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('currency', help='Currency code')
+        parser.add_argument('--pk-from', type=int, default=0, help='First user id, to continue interrupted run')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Users processed by one insert')
+
+    def handle(self, *args, **options):
+        currency = currencies.get_by_code(options['currency'])
+        if currency is None:
+            raise CommandError(f"Currency {options['currency']} does not exist")
+
+        stocks_before = Stock.objects.filter(currency=currency).count()
+        pk_from = options['pk_from']
+        users = 0
+        while True:
+            user_pks = provision_currency(currency.pk, pk_from, options['batch_size'])
+            if not user_pks:
+                break
+            users += len(user_pks)
+            pk_from = user_pks[-1] + 1
+            self.stderr.write(f'Processed users up to {user_pks[-1]}')
+        created = Stock.objects.filter(currency=currency).count() - stocks_before
+        self.stdout.write(f'Processed {users} users, created {created} stocks of {currency.code}')
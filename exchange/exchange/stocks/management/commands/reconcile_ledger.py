@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors: norlyakov
+:Date: 18.10.2026
+"""
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...reconciliation import get_stocks_to_reconcile, reconcile_stocks
+
+
+class Command(BaseCommand):
+    help = ('Checks that values of stocks changed since last run equal their ledger balances. '
+            'Mismatches are written to stdout as JSON lines. Stock id ranges can be reconciled in parallel.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--pk-from', type=int, default=0, help='First stock id of range')
+        parser.add_argument('--pk-to', type=int, default=None, help='Stock id after range')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Stocks locked and reconciled by one transaction')
+        parser.add_argument('--loop', type=float, default=None, metavar='SECONDS',
+                            help='Keep running and reconcile every SECONDS')
+        parser.add_argument('--baseline', action='store_true',
+                            help='Take values of never reconciled stocks as their ledger balances')
+        parser.add_argument('--fail-on-mismatch', action='store_true',
+                            help='Exit with error status if mismatch is found')
+
+    def handle(self, *args, **options):
+        while True:
+            mismatches = self.reconcile(options['pk_from'], options['pk_to'], options['batch_size'],
+                                        options['baseline'])
+            if options['loop'] is None:
+                break
+            time.sleep(options['loop'])
+
+        if mismatches and options['fail_on_mismatch']:
+            raise CommandError(f'Found {mismatches} mismatched stocks')
+
+    def reconcile(self, pk_from, pk_to, batch_size, baseline):
+        reconciled = 0
+        mismatches = 0
+        while True:
+            stock_pks = get_stocks_to_reconcile(pk_from, pk_to, batch_size)
+            if not stock_pks:
+                break
+            for mismatch in reconcile_stocks(stock_pks, baseline):
+                self.stdout.write(json.dumps(mismatch))
+                mismatches += 1
+            reconciled += len(stock_pks)
+            pk_from = stock_pks[-1] + 1
+        self.stderr.write(f'Reconciled {reconciled} stocks, {mismatches} mismatched')
+        return mismatches
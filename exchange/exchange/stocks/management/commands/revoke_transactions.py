@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors: norlyakov
+:Date: 18.10.2026
+"""
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_datetime
+
+from ...utils import UserTransactionService, get_revocable_transactions
+
+
+def datetime_type(value):
+    result = parse_datetime(value)
+    if result is None:
+        raise ValueError(value)
+    return result
+
+
+class Command(BaseCommand):
+    help = ('Revokes common transactions with their commissions, given by ids or by filter. '
+            'Outcome of each transaction is written to stdout as JSON line.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ids', type=int, nargs='+', help='Ids of transactions')
+        parser.add_argument('--date-from', type=datetime_type, help='Transactions created at or after this time')
+        parser.add_argument('--date-to', type=datetime_type, help='Transactions created before this time')
+        parser.add_argument('--stock', type=int, help='Transactions of this stock')
+        parser.add_argument('--batch-size', type=int, default=settings.STOCKS_SETTINGS['BATCH_MAX_SIZE'],
+                            help='Transactions locked and revoked by one db transaction')
+
+    def handle(self, *args, **options):
+        filters = [options[name] for name in ('date_from', 'date_to', 'stock')]
+        if options['ids'] and any(value is not None for value in filters):
+            raise CommandError('Give either --ids or filter')
+        if not options['ids'] and all(value is None for value in filters):
+            raise CommandError('Need to provide --ids or filter')
+
+        revoked = failed = 0
+        for pks in self.iter_batches(options['ids'], filters, options['batch_size']):
+            results = UserTransactionService.revoke_batch(pks, atomic=False)
+            for pk, (legs, error) in zip(pks, results):
+                if error is None:
+                    self.stdout.write(json.dumps({'transaction': pk, 'status': 'ok', 'revoke': legs[0].pk}))
+                    revoked += 1
+                else:
+                    self.stdout.write(json.dumps({'transaction': pk, 'status': 'error', 'errors': error}))
+                    failed += 1
+        self.stderr.write(f'Revoked {revoked} transactions, {failed} failed')
+
+    @staticmethod
+    def iter_batches(ids, filters, batch_size):
+        if ids:
+            for start in range(0, len(ids), batch_size):
+                yield ids[start:start + batch_size]
+            return
+
+        # failed transactions still match filter, so batches go by pk
+        queryset = get_revocable_transactions(*filters).order_by('pk')
+        last_pk = 0
+        while True:
+            pks = list(queryset.filter(pk__gt=last_pk).values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                break
+            yield pks
+            last_pk = pks[-1]
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors: norlyakov
+:Date: 18.10.2026
+"""
+import time
+
+from django.core.management.base import BaseCommand
+
+from ...models import CommissionAccrual
+from ...money import to_major
+from ...registry import currencies
+from ...utils import UserTransactionService
+
+
+class Command(BaseCommand):
+    help = 'Settles pending commission accruals to master stocks, one transaction per currency'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=10000,
+                            help='Max accruals settled by one transaction')
+        parser.add_argument('--loop', type=float, default=None, metavar='SECONDS',
+                            help='Keep running and settle accruals every SECONDS')
+
+    def handle(self, *args, **options):
+        while True:
+            self.settle(options['limit'])
+            if options['loop'] is None:
+                break
+            time.sleep(options['loop'])
+
+    def settle(self, limit):
+        currency_ids = CommissionAccrual.objects.filter(
+            settlement__isnull=True,
+        ).values_list('currency_id', flat=True).distinct()
+
+        for currency_id in currency_ids:
+            while True:
+                summary_transaction = UserTransactionService.settle_commissions(currency_id, limit=limit)
+                if summary_transaction is None:
+                    break
+                currency = currencies.get(currency_id)
+                self.stdout.write(f'{currency}: settled {to_major(summary_transaction.value, currency.scale)} '
+                                  f'by transaction {summary_transaction.pk}')
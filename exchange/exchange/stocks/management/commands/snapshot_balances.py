@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors: norlyakov
+:Date: 18.10.2026
+"""
+import time
+
+from django.core.management.base import BaseCommand
+
+from ...balances import get_stocks_to_snapshot, take_snapshots
+
+
+class Command(BaseCommand):
+    help = "Saves balance snapshots of stocks changed after their last snapshot, balance at time is counted from them"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Stocks locked and snapshotted by one transaction')
+        parser.add_argument('--loop', type=float, default=None, metavar='SECONDS',
+                            help='Keep running and take snapshots every SECONDS')
+
+    def handle(self, *args, **options):
+        while True:
+            self.checkpoint(options['batch_size'])
+            if options['loop'] is None:
+                break
+            time.sleep(options['loop'])
+
+    def checkpoint(self, batch_size):
+        taken = 0
+        pk_from = 0
+        while True:
+            stock_pks = get_stocks_to_snapshot(pk_from, batch_size)
+            if not stock_pks:
+                break
+            taken += len(take_snapshots(stock_pks))
+            pk_from = stock_pks[-1] + 1
+        self.stdout.write(f'Took {taken} balance snapshots')
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors: norlyakov
+:Date: 18.10.2026
+"""
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...errors import ExchangeRateError
+from ...money import to_major
+from ...registry import currencies
+from ...valuation import get_all_valuations, format_valuation
+
+
+class Command(BaseCommand):
+    help = ("Values stocks of all users in given currency for risk reports. "
+            "Valuations are written to stdout as JSON lines, total of all users to stderr.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('currency', help='Code of base currency')
+
+    def handle(self, *args, **options):
+        base_currency = currencies.get_by_code(options['currency'])
+        if base_currency is None:
+            raise CommandError(f"Currency {options['currency']} does not exist")
+
+        users = 0
+        total = 0
+        try:
+            for user_id, value, holdings in get_all_valuations(base_currency):
+                self.stdout.write(json.dumps({'user': user_id, **format_valuation(value, holdings, base_currency)}))
+                users += 1
+                total += value
+        except ExchangeRateError as e:
+            raise CommandError(str(e))
+        self.stderr.write(f'Valued {users} users, total {to_major(total, base_currency.scale)} {base_currency.code}')
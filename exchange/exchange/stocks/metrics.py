@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors: norlyakov
+:Date: 18.10.2026
+"""
+import bisect
+import functools
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connection
+from rest_framework.exceptions import ValidationError
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+MAX_REASON_LENGTH = 100
+
+
+def is_enabled():
+    return settings.STOCKS_SETTINGS['METRICS_ENABLED']
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric:
+    """Aggregates values in process memory, one lock per metric, so workers' threads can share it"""
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def reset(self):
+        with self._lock:
+            self._values = {}
+
+    def render(self):
+        with self._lock:
+            values = {labels: self._copy(value) for labels, value in self._values.items()}
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        for labels, value in sorted(values.items()):
+            lines.extend(self._render_value(labels, value))
+        return lines
+
+    @staticmethod
+    def _copy(value):
+        return value
+
+    def _render_value(self, labels, value):
+        raise NotImplementedError()
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def _render_value(self, labels, value):
+        return [f'{self.name}{_format_labels(self.labelnames, labels)} {value}']
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=TIME_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        # counts are kept per bucket and made cumulative on render only
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @staticmethod
+    def _copy(value):
+        return [list(value[0]), value[1], value[2]]
+
+    def _render_value(self, labels, value):
+        bucket_counts, total, count = value
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + ('+Inf',), bucket_counts):
+            cumulative += bucket_count
+            le = _format_labels(self.labelnames, labels, f'le="{bound}"')
+            lines.append(f'{self.name}_bucket{le} {cumulative}')
+        lines.append(f'{self.name}_sum{_format_labels(self.labelnames, labels)} {total}')
+        lines.append(f'{self.name}_count{_format_labels(self.labelnames, labels)} {count}')
+        return lines
+
+
+class MetricsRegistry:
+
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, *args, **kwargs):
+        return self._register(Counter(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self._register(Histogram(*args, **kwargs))
+
+    def _register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def reset(self):
+        for metric in self.metrics:
+            metric.reset()
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+request_seconds = registry.histogram(
+    'stocks_request_seconds', 'Time of API request', ('view', 'action', 'method', 'status'))
+request_queries = registry.histogram(
+    'stocks_request_queries', 'DB queries made by API request', ('view', 'action'), buckets=COUNT_BUCKETS)
+request_db_seconds = registry.histogram(
+    'stocks_request_db_seconds', 'Time of DB queries made by API request', ('view', 'action'))
+validation_failures = registry.counter(
+    'stocks_validation_failures_total', 'API requests rejected by validation', ('view', 'reason'))
+serializer_validate_seconds = registry.histogram(
+    'stocks_serializer_validate_seconds', 'Time of serializer validation with its lookups', ('serializer',))
+service_seconds = registry.histogram(
+    'stocks_service_seconds', 'Time of UserTransactionService method, retries included', ('method', 'outcome'))
+lock_seconds = registry.histogram(
+    'stocks_lock_seconds', 'Time of acquiring row locks', ('target',))
+commit_seconds = registry.histogram(
+    'stocks_commit_seconds', 'Time of committing service transaction')
+rate_fetch_seconds = registry.histogram(
+    'stocks_rate_fetch_seconds', 'Time of getting exchange rate')
+
+
+def observe(histogram, value, *labels):
+    if is_enabled():
+        histogram.observe(value, *labels)
+
+
+@contextmanager
+def timer(histogram, *labels):
+    if not is_enabled():
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.observe(time.perf_counter() - start, *labels)
+
+
+def instrumented(method_name):
+    """Records time and outcome of decorated service method"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not is_enabled():
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            outcome = 'ok'
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                outcome = type(e).__name__
+                raise
+            finally:
+                service_seconds.observe(time.perf_counter() - start, method_name, outcome)
+        return wrapper
+    return decorator
+
+
+def get_failure_reasons(detail):
+    """Field errors are reported by field name and error code, non-field ones by message"""
+    if isinstance(detail, list):
+        return {str(message)[:MAX_REASON_LENGTH] for message in detail}
+    if not isinstance(detail, dict):
+        return {str(detail)[:MAX_REASON_LENGTH]}
+
+    reasons = set()
+    for field, errors in detail.items():
+        if field == 'non_field_errors':
+            reasons |= get_failure_reasons(errors)
+        elif isinstance(errors, list) and errors and hasattr(errors[0], 'code'):
+            reasons.add(f'{field}:{errors[0].code}')
+        else:
+            reasons.add(field)
+    return reasons
+
+
+class QueryTimer:
+    """Database execute wrapper counting queries and their time"""
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.seconds += time.perf_counter() - start
+
+
+class InstrumentedViewMixin:
+    """Records time, DB queries and validation failures of viewset requests"""
+
+    def dispatch(self, request, *args, **kwargs):
+        if not is_enabled():
+            return super().dispatch(request, *args, **kwargs)
+
+        query_timer = QueryTimer()
+        start = time.perf_counter()
+        with connection.execute_wrapper(query_timer):
+            response = super().dispatch(request, *args, **kwargs)
+        seconds = time.perf_counter() - start
+
+        view, action = type(self).__name__, getattr(self, 'action', None) or ''
+        request_seconds.observe(seconds, view, action, request.method, response.status_code)
+        request_queries.observe(query_timer.queries, view, action)
+        request_db_seconds.observe(query_timer.seconds, view, action)
+        return response
+
+    def handle_exception(self, exc):
+        if isinstance(exc, ValidationError) and is_enabled():
+            for reason in get_failure_reasons(exc.detail):
+                validation_failures.inc(type(self).__name__, reason)
+        return super().handle_exception(exc)
@@ -0,0 +1,18 @@
+# Generated by Django 3.0 on 2026-10-18 11:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stocks', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='transaction',
+            name='type',
+            field=models.CharField(choices=[('CMN', 'Common'), ('EXC', 'Exchange'), ('CMS', 'Commission'), ('CNL', 'Canceled'), ('RVK', 'Revoke'), ('CNS', 'Consolidation')], default='CMN', max_length=3),
+        ),
+    ]
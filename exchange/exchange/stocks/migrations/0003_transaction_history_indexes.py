@@ -0,0 +1,32 @@
+# Generated by Django 3.0 on 2026-10-18 11:44
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stocks', '0002_transaction_consolidation_type'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='transaction',
+            name='stock_from',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='stocks.Stock'),
+        ),
+        migrations.AlterField(
+            model_name='transaction',
+            name='stock_to',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='stocks.Stock'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['stock_from', 'created', 'id'], name='transaction_from_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['stock_to', 'created', 'id'], name='transaction_to_created_idx'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 3.0 on 2026-10-18 11:48
+
+from decimal import Decimal
+import django.core.validators
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stocks', '0003_transaction_history_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CommissionAccrual',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('value', models.DecimalField(decimal_places=5, default=0, max_digits=100, validators=[django.core.validators.MinValueValidator(Decimal('0'))])),
+                ('currency', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='+', to='stocks.Currency')),
+                ('settlement', models.ForeignKey(default=None, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='stocks.Transaction')),
+                ('stock', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='+', to='stocks.Stock')),
+                ('transaction', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='+', to='stocks.Transaction')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='commissionaccrual',
+            index=models.Index(condition=models.Q(settlement__isnull=True), fields=['currency'], name='accrual_pending_idx'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 3.0 on 2026-10-18 11:55
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stocks', '0005_idempotency_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transaction',
+            name='error',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='status',
+            field=models.CharField(choices=[('DON', 'Done'), ('PND', 'Pending'), ('FLD', 'Failed')], default='DON', max_length=3),
+        ),
+        migrations.CreateModel(
+            name='TransactionQueueItem',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('stock_from', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='stocks.Stock')),
+                ('stock_to', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='stocks.Stock')),
+                ('transaction', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='stocks.Transaction')),
+            ],
+        ),
+    ]
@@ -0,0 +1,86 @@
+# Generated by Django 3.0 on 2026-10-18 12:10
+
+from decimal import Decimal
+
+import django.core.validators
+from django.db import migrations, models
+from django.db.models import F, Q, ExpressionWrapper
+from django.db.models.functions import Cast, Round
+
+import exchange.stocks.money
+
+# existing currencies get scale 5, so their amounts are converted without loss
+EXISTING_SCALE = 5
+FACTOR = 10 ** EXISTING_SCALE
+MONEY_MODELS = ('Stock', 'Transaction', 'CommissionAccrual')
+
+
+def values_to_minor(apps, schema_editor):
+    max_value = Decimal(exchange.stocks.money.MAX_MINOR) / FACTOR
+    for model_name in MONEY_MODELS:
+        model = apps.get_model('stocks', model_name)
+        if model.objects.filter(value__gt=max_value).exists():
+            raise RuntimeError(f"{model_name} has value which doesn't fit into 64-bit minor units")
+        model.objects.update(value_minor=Cast(Round(F('value') * FACTOR), models.BigIntegerField()))
+
+
+def has_scale(model_name, scale):
+    """Rows with currency of given scale, transactions without stock_from have currency of stock_to"""
+    if model_name == 'Transaction':
+        return Q(stock_from__currency__scale=scale) | Q(stock_from=None, stock_to__currency__scale=scale)
+    return Q(currency__scale=scale)
+
+
+def values_to_major(apps, schema_editor):
+    # currency scale can be changed after migration, so each row is converted by scale of its currency
+    scales = apps.get_model('stocks', 'Currency').objects.values_list('scale', flat=True).distinct()
+    for model_name in MONEY_MODELS:
+        model = apps.get_model('stocks', model_name)
+        for scale in scales:
+            model.objects.filter(has_scale(model_name, scale)).update(value=ExpressionWrapper(
+                F('value_minor') * Decimal(1).scaleb(-scale),
+                output_field=models.DecimalField(max_digits=100, decimal_places=5),
+            ))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stocks', '0006_transaction_queue'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='currency',
+            name='scale',
+            field=models.PositiveSmallIntegerField(default=EXISTING_SCALE, validators=[
+                django.core.validators.MaxValueValidator(5)]),
+        ),
+        migrations.AlterField(
+            model_name='currency',
+            name='scale',
+            field=models.PositiveSmallIntegerField(default=2, validators=[
+                django.core.validators.MaxValueValidator(5)]),
+        ),
+    ] + [
+        migrations.AddField(
+            model_name=model_name.lower(),
+            name='value_minor',
+            field=exchange.stocks.money.MoneyField(null=True),
+        )
+        for model_name in MONEY_MODELS
+    ] + [
+        migrations.RunPython(values_to_minor, values_to_major),
+    ] + [
+        operation
+        for model_name in MONEY_MODELS
+        for operation in (
+            migrations.RemoveField(model_name=model_name.lower(), name='value'),
+            migrations.RenameField(model_name=model_name.lower(), old_name='value_minor', new_name='value'),
+            migrations.AlterField(
+                model_name=model_name.lower(),
+                name='value',
+                field=exchange.stocks.money.MoneyField(default=0),
+            ),
+        )
+    ]
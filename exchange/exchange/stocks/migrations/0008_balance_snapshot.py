@@ -0,0 +1,36 @@
+# Generated by Django 3.0 on 2026-10-18 12:04
+
+from django.db import migrations, models
+import django.db.models.deletion
+import exchange.stocks.money
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stocks', '0007_money_minor_units'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockBalanceSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('taken_at', models.DateTimeField()),
+                ('value', exchange.stocks.money.MoneyField(default=0)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='commissionaccrual',
+            index=models.Index(fields=['stock', 'created'], name='accrual_stock_created_idx'),
+        ),
+        migrations.AddField(
+            model_name='stockbalancesnapshot',
+            name='stock',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='stocks.Stock'),
+        ),
+        migrations.AddIndex(
+            model_name='stockbalancesnapshot',
+            index=models.Index(fields=['stock', 'taken_at'], name='snapshot_stock_taken_idx'),
+        ),
+    ]
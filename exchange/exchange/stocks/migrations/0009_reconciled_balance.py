@@ -0,0 +1,23 @@
+# Generated by Django 3.0 on 2026-10-18 12:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+import exchange.stocks.money
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stocks', '0008_balance_snapshot'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReconciledBalance',
+            fields=[
+                ('stock', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='reconciled_balance', serialize=False, to='stocks.Stock')),
+                ('value', exchange.stocks.money.MoneyField(default=0)),
+                ('reconciled_at', models.DateTimeField()),
+            ],
+        ),
+    ]
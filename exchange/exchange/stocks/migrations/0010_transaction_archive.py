@@ -0,0 +1,57 @@
+# Generated by Django 3.0 on 2026-10-18 12:09
+
+from django.db import migrations, models
+import django.db.models.deletion
+import exchange.stocks.money
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stocks', '0009_reconciled_balance'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='commissionaccrual',
+            name='settlement',
+            field=models.ForeignKey(db_constraint=False, default=None, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='stocks.Transaction'),
+        ),
+        migrations.AlterField(
+            model_name='commissionaccrual',
+            name='transaction',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='stocks.Transaction'),
+        ),
+        migrations.AlterField(
+            model_name='transaction',
+            name='related_transaction',
+            field=models.ForeignKey(db_constraint=False, default=None, null=True, on_delete=django.db.models.deletion.DO_NOTHING, to='stocks.Transaction'),
+        ),
+        migrations.CreateModel(
+            name='ArchivedTransaction',
+            fields=[
+                ('value', exchange.stocks.money.MoneyField(default=0)),
+                ('type', models.CharField(choices=[('CMN', 'Common'), ('EXC', 'Exchange'), ('CMS', 'Commission'), ('CNL', 'Canceled'), ('RVK', 'Revoke'), ('CNS', 'Consolidation')], default='CMN', max_length=3)),
+                ('status', models.CharField(choices=[('DON', 'Done'), ('PND', 'Pending'), ('FLD', 'Failed')], default='DON', max_length=3)),
+                ('error', models.CharField(blank=True, default='', max_length=255)),
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('created', models.DateTimeField()),
+                ('updated', models.DateTimeField()),
+                ('related_transaction', models.ForeignKey(db_constraint=False, default=None, null=True, on_delete=django.db.models.deletion.DO_NOTHING, to='stocks.ArchivedTransaction')),
+                ('stock_from', models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='stocks.Stock')),
+                ('stock_to', models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='stocks.Stock')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='archivedtransaction',
+            index=models.Index(fields=['stock_from', 'created', 'id'], name='archived_from_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='archivedtransaction',
+            index=models.Index(fields=['stock_to', 'created', 'id'], name='archived_to_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='archivedtransaction',
+            index=models.Index(fields=['created'], name='archived_created_idx'),
+        ),
+    ]
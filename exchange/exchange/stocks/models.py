@@ -1,13 +1,16 @@
-from decimal import Decimal
-
 from django.conf import settings
-from django.core.validators import MinValueValidator
+from django.core.validators import MaxValueValidator
 from django.db import models
+from django.db.models import Q
+
+from .money import MoneyField, MAX_SCALE, to_major
 
 
 class Currency(models.Model):
     name = models.CharField(max_length=100)
     code = models.CharField(max_length=10, unique=True)
+    # decimal places of currency, amounts are kept in its minor units
+    scale = models.PositiveSmallIntegerField(default=2, validators=[MaxValueValidator(MAX_SCALE)])
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
 
@@ -20,8 +23,7 @@ class Stock(models.Model):
     updated = models.DateTimeField(auto_now=True)
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     currency = models.ForeignKey(Currency, on_delete=models.PROTECT)
-    value = models.DecimalField(default=0, max_digits=100, decimal_places=5,
-                                validators=[MinValueValidator(Decimal('0'))])
+    value = MoneyField(default=0)
     is_active = models.BooleanField(default=True)
 
     class Meta:
@@ -37,18 +39,144 @@ class TransactionTypes(models.TextChoices):
     commission = 'CMS', 'Commission'
     canceled = 'CNL', 'Canceled'
     revoke = 'RVK', 'Revoke'
+    consolidation = 'CNS', 'Consolidation'
+
 
+class TransactionStatuses(models.TextChoices):
+    done = 'DON', 'Done'
+    # queued in async mode and not executed yet
+    pending = 'PND', 'Pending'
+    failed = 'FLD', 'Failed'
 
-class Transaction(models.Model):
+
+class TransactionBase(models.Model):
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
-    stock_from = models.ForeignKey(Stock, on_delete=models.PROTECT, null=True, related_name='+')
-    stock_to = models.ForeignKey(Stock, on_delete=models.PROTECT, null=True, related_name='+')
-    value = models.DecimalField(default=0, max_digits=100, decimal_places=5,
-                                validators=[MinValueValidator(Decimal('0'))])
+    # fks are covered by composite indexes below
+    stock_from = models.ForeignKey(Stock, on_delete=models.PROTECT, null=True, related_name='+', db_index=False)
+    stock_to = models.ForeignKey(Stock, on_delete=models.PROTECT, null=True, related_name='+', db_index=False)
+    value = MoneyField(default=0)
     type = models.CharField(max_length=3, choices=TransactionTypes.choices,
                             default=TransactionTypes.common)
-    related_transaction = models.ForeignKey('self', on_delete=models.PROTECT, null=True, default=None)
+    # related transaction can be moved to archive, so there is no constraint
+    related_transaction = models.ForeignKey('self', on_delete=models.DO_NOTHING, null=True, default=None,
+                                            db_constraint=False)
+    status = models.CharField(max_length=3, choices=TransactionStatuses.choices, default=TransactionStatuses.done)
+    error = models.CharField(max_length=255, blank=True, default='')
+
+    class Meta:
+        abstract = True
+
+    def __str__(self):
+        currency = (self.stock_from or self.stock_to).currency
+        return f'{to_major(self.value, currency.scale)} {currency}'
+
+
+class Transaction(TransactionBase):
+
+    class Meta:
+        indexes = [
+            # stock's history is paginated by (created, id)
+            models.Index(fields=['stock_from', 'created', 'id'], name='transaction_from_created_idx'),
+            models.Index(fields=['stock_to', 'created', 'id'], name='transaction_to_created_idx'),
+        ]
+
+
+class ArchivedTransaction(TransactionBase):
+    """Transaction of closed month moved out of hot table by archive_transactions command, with the same id"""
+    id = models.IntegerField(primary_key=True)
+    created = models.DateTimeField()
+    updated = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['stock_from', 'created', 'id'], name='archived_from_created_idx'),
+            models.Index(fields=['stock_to', 'created', 'id'], name='archived_to_created_idx'),
+            # archive boundary is its latest transaction
+            models.Index(fields=['created'], name='archived_created_idx'),
+        ]
+
+
+class CommissionAccrual(models.Model):
+    """
+    Commission taken from user's stock but not added to master stock yet.
+    Pending accruals are periodically settled by one summary transaction per currency.
+    """
+    created = models.DateTimeField(auto_now_add=True)
+    # transactions can be moved to archive, so there are no constraints
+    transaction = models.ForeignKey(Transaction, on_delete=models.DO_NOTHING, related_name='+', db_constraint=False)
+    stock = models.ForeignKey(Stock, on_delete=models.PROTECT, related_name='+')
+    currency = models.ForeignKey(Currency, on_delete=models.PROTECT, related_name='+')
+    value = MoneyField(default=0)
+    settlement = models.ForeignKey(Transaction, on_delete=models.DO_NOTHING, null=True, default=None,
+                                   related_name='+', db_constraint=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['currency'], name='accrual_pending_idx', condition=Q(settlement__isnull=True)),
+            # stock's balance changes are summed by created
+            models.Index(fields=['stock', 'created'], name='accrual_stock_created_idx'),
+        ]
+
+    def __str__(self):
+        return f'{to_major(self.value, self.currency.scale)} {self.currency}'
+
+
+class IdempotencyKey(models.Model):
+    """Response of request made with Idempotency-Key header, replayed on retries of the request"""
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='+')
+    key = models.CharField(max_length=255)
+    request_hash = models.CharField(max_length=64)
+    status_code = models.PositiveSmallIntegerField()
+    response = models.TextField()
+
+    class Meta:
+        unique_together = ('user', 'key')
+
+    def __str__(self):
+        return f"{self.user}'s {self.key}"
+
+
+class TransactionQueueItem(models.Model):
+    """
+    Pending transaction waiting for queue worker. Stocks of request are copied here,
+    item isn't taken while earlier item with any of its stocks is in queue.
+    """
+    transaction = models.OneToOneField(Transaction, on_delete=models.CASCADE, related_name='+')
+    stock_from = models.ForeignKey(Stock, on_delete=models.CASCADE, related_name='+')
+    stock_to = models.ForeignKey(Stock, on_delete=models.CASCADE, related_name='+')
+
+    def __str__(self):
+        return f'Queued {self.transaction_id}'
+
+
+class StockBalanceSnapshot(models.Model):
+    """
+    Balance of stock at taken_at, made by checkpoint job. It includes all done transactions
+    and commission accruals of stock created before taken_at and none created after it.
+    """
+    stock = models.ForeignKey(Stock, on_delete=models.CASCADE, related_name='+', db_index=False)
+    taken_at = models.DateTimeField()
+    value = MoneyField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['stock', 'taken_at'], name='snapshot_stock_taken_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.stock} at {self.taken_at}'
+
+
+class ReconciledBalance(models.Model):
+    """
+    Balance of stock by its ledger: done transactions and commission accruals created up to reconciled_at.
+    It's the watermark of reconciliation, only later flows are summed by next run.
+    """
+    stock = models.OneToOneField(Stock, on_delete=models.CASCADE, primary_key=True, related_name='reconciled_balance')
+    value = MoneyField(default=0)
+    reconciled_at = models.DateTimeField()
 
     def __str__(self):
-        return f'{self.value} {self.stock_from.currency}'
+        return f'{self.stock} reconciled at {self.reconciled_at}'
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors: norlyakov
+:Date: 18.10.2026
+"""
+import threading
+from contextlib import contextmanager
+from decimal import Decimal, Context, localcontext
+
+from django.conf import settings
+from django.core.validators import MinValueValidator
+from django.db import models
+
+# amounts had 5 decimal places before they were kept in minor units
+MAX_SCALE = 5
+MAX_MINOR = 2 ** 63 - 1
+# enough for any 64-bit amount multiplied by rate or fraction
+PRECISION = 60
+ONE = Decimal(1)
+
+_state = threading.local()
+
+
+class MoneyField(models.BigIntegerField):
+    """Amount in minor units of currency, see Currency.scale"""
+    default_validators = [MinValueValidator(0)]
+
+
+def get_rounding():
+    return getattr(_state, 'rounding', None) or settings.STOCKS_SETTINGS['ROUNDING']
+
+
+@contextmanager
+def rounding(mode):
+    """Rounding mode of money operations made by current thread, STOCKS_SETTINGS['ROUNDING'] by default"""
+    previous = getattr(_state, 'rounding', None)
+    _state.rounding = mode
+    try:
+        yield
+    finally:
+        _state.rounding = previous
+
+
+def _round(amount):
+    minor = int(amount.quantize(ONE, rounding=get_rounding()))
+    if abs(minor) > MAX_MINOR:
+        raise ValueError('Amount is too big')
+    return minor
+
+
+def fits_scale(amount, scale):
+    """Amount in major units has no more decimal places than currency has"""
+    return Decimal(amount).normalize().as_tuple().exponent >= -scale
+
+
+def to_minor(amount, scale):
+    """Converts amount in major units to minor ones, extra decimal places are rounded"""
+    with localcontext(Context(prec=PRECISION)):
+        return _round(Decimal(amount).scaleb(scale))
+
+
+def to_major(minor, scale):
+    return Decimal(minor).scaleb(-scale)
+
+
+def multiply(minor, factor):
+    """Part of amount, like commission, rounded to minor units"""
+    with localcontext(Context(prec=PRECISION)):
+        return _round(Decimal(minor) * Decimal(str(factor)))
+
+
+def convert(minor, scale_from, scale_to, rate):
+    """Converts amount between currencies by rate of their major units"""
+    with localcontext(Context(prec=PRECISION)):
+        return _round(Decimal(minor).scaleb(scale_to - scale_from) * rate)
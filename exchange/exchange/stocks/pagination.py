@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors: norlyakov
+:Date: 18.10.2026
+"""
+import json
+from base64 import b64decode, b64encode
+from collections import OrderedDict
+
+from django.db import connections
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+
+class UnionCursorPagination(BasePagination):
+    """
+    Keyset pagination by (created, id), newest first, over union of several querysets (legs).
+    Every leg is filtered by cursor and limited separately, so each of them can be served
+    by its own (fk, created, id) index and page fetch time doesn't depend on page depth.
+    """
+    cursor_query_param = 'cursor'
+    page_size = api_settings.PAGE_SIZE
+    invalid_cursor_message = 'Invalid cursor'
+
+    def __init__(self):
+        self.base_url = None
+        self.next_position = None
+        self.previous_position = None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        return self.paginate_legs([queryset], request, view)
+
+    def paginate_legs(self, legs, request, view=None, archive_legs=(), archive_boundary=None):
+        """
+        Archive legs are queried only when page reaches transactions created at or before archive_boundary,
+        their results are merged with results of legs.
+        """
+        self.base_url = request.build_absolute_uri()
+        self.next_position = self.previous_position = None
+        if not legs:
+            return []
+
+        position = self.decode_cursor(request)
+        reverse = position is not None and position['reverse']
+        ordering = ('created', 'id') if reverse else ('-created', '-id')
+
+        results = self._fetch_legs(legs, position, ordering)
+        if archive_legs and self._needs_archive(results, position, reverse, archive_boundary):
+            results += self._fetch_legs(archive_legs, position, ordering)
+            results.sort(key=lambda item: (item.created, item.pk), reverse=not reverse)
+            results = results[:self.page_size + 1]
+
+        has_more = len(results) > self.page_size
+        results = results[:self.page_size]
+        if reverse:
+            results.reverse()
+
+        if results:
+            first, last = results[0], results[-1]
+            if reverse:
+                # we came here from later page, so it exists
+                self.next_position = self._get_position(last, reverse=False)
+                if has_more:
+                    self.previous_position = self._get_position(first, reverse=True)
+            else:
+                if has_more:
+                    self.next_position = self._get_position(last, reverse=False)
+                if position is not None:
+                    self.previous_position = self._get_position(first, reverse=True)
+        return results
+
+    def _fetch_legs(self, legs, position, ordering):
+        filtered_legs = [self._filter_leg(leg, position) for leg in legs]
+        queryset = filtered_legs[0]
+        if len(filtered_legs) > 1:
+            if connections[queryset.db].features.supports_slicing_ordering_in_compound:
+                filtered_legs = [leg.order_by(*ordering)[:self.page_size + 1] for leg in filtered_legs]
+            queryset = filtered_legs[0].union(*filtered_legs[1:])
+        return list(queryset.order_by(*ordering)[:self.page_size + 1])
+
+    def _needs_archive(self, results, position, reverse, archive_boundary):
+        if archive_boundary is None:
+            return False
+        if reverse:
+            # newer page starts in archive
+            return position['created'] <= archive_boundary
+        return len(results) <= self.page_size or results[-1].created <= archive_boundary
+
+    @staticmethod
+    def _filter_leg(leg, position):
+        if position is None:
+            return leg
+        if position['reverse']:
+            condition = Q(created__gt=position['created']) | Q(created=position['created'], id__gt=position['id'])
+            return leg.filter(condition, created__gte=position['created'])
+        condition = Q(created__lt=position['created']) | Q(created=position['created'], id__lt=position['id'])
+        return leg.filter(condition, created__lte=position['created'])
+
+    @staticmethod
+    def _get_position(instance, reverse):
+        return {'created': instance.created, 'id': instance.pk, 'reverse': reverse}
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+        try:
+            data = json.loads(b64decode(encoded.encode('ascii'), altchars=b'-_'))
+            created = parse_datetime(data['c'])
+            if created is None:
+                raise ValueError()
+            return {'created': created, 'id': int(data['i']), 'reverse': bool(data['r'])}
+        except (TypeError, ValueError, KeyError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def encode_cursor(self, position):
+        data = {'c': position['created'].isoformat(), 'i': position['id'], 'r': int(position['reverse'])}
+        encoded = b64encode(json.dumps(data).encode('ascii'), altchars=b'-_').decode('ascii')
+        return replace_query_param(self.base_url, self.cursor_query_param, encoded)
+
+    def get_next_link(self):
+        if self.next_position is None:
+            return None
+        return self.encode_cursor(self.next_position)
+
+    def get_previous_link(self):
+        if self.previous_position is None:
+            return None
+        return self.encode_cursor(self.previous_position)
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data),
+        ]))
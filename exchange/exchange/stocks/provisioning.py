@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors: norlyakov
+:Date: 18.10.2026
+"""
+from django.contrib.auth import get_user_model
+
+from .caching import bump_version, get_stocks_scope
+from .models import Stock
+
+
+def provision_stocks(user_id, currency_ids):
+    """
+    Creates user's stocks of currencies he doesn't have yet by single insert, existing ones are skipped
+    by unique constraint on (user, currency). Returns user's stocks of these currencies.
+    """
+    Stock.objects.bulk_create([Stock(user_id=user_id, currency_id=currency_id) for currency_id in currency_ids],
+                              ignore_conflicts=True)
+    # stocks are inserted without signals
+    bump_version(get_stocks_scope(user_id))
+    return Stock.objects.filter(user_id=user_id, currency_id__in=currency_ids).select_related('user').order_by('pk')
+
+
+def provision_currency(currency_id, pk_from, limit):
+    """
+    Creates stocks of currency for up to limit active users starting from pk_from by single insert,
+    users having such stock are skipped. Returns pks of processed users.
+    """
+    user_pks = list(get_user_model().objects.filter(
+        pk__gte=pk_from, is_active=True,
+    ).order_by('pk').values_list('pk', flat=True)[:limit])
+    Stock.objects.bulk_create([Stock(user_id=pk, currency_id=currency_id) for pk in user_pks], ignore_conflicts=True)
+    for pk in user_pks:
+        bump_version(get_stocks_scope(pk))
+    return user_pks
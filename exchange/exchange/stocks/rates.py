@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors: norlyakov
+:Date: 18.10.2026
+"""
+import logging
+import os
+import threading
+import time
+from decimal import Decimal, localcontext
+from itertools import product
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from . import metrics
+from .errors import ExchangeRateError
+
+logger = logging.getLogger(__name__)
+
+
+class RateProvider:
+    """Source of exchange rates, rates are prices of currencies in any common unit"""
+
+    def get_rates(self):
+        """Returns dict currency code -> price"""
+        raise NotImplementedError()
+
+
+class StubRateProvider(RateProvider):
+    """Local provider with fixed rates, for development and tests"""
+
+    def __init__(self, rates):
+        self.rates = rates
+
+    def get_rates(self):
+        return dict(self.rates)
+
+
+def build_rates_matrix(rates):
+    """Precomputes cross rates for every pair of currencies"""
+    with localcontext() as ctx:
+        ctx.prec = 28
+        prices = {code: Decimal(price) for code, price in rates.items()}
+        return {
+            (code_from, code_to): prices[code_from] / prices[code_to]
+            for code_from, code_to in product(prices, prices)
+            if prices[code_to]
+        }
+
+
+class RatesCache:
+    """
+    In-process cache of cross rates matrix shared by all threads.
+    Fresh matrix is returned as is, stale one is returned while it is refreshed in background
+    and only expired (or missing) matrix is loaded synchronously.
+    """
+
+    def __init__(self):
+        self._refresh_lock = threading.Lock()
+        self._state = (None, 0)  # (matrix, monotonic time of fetching), swapped atomically
+        self._provider = None
+        self._refresher_lock = threading.Lock()
+        self._refresher_pid = None
+
+    @staticmethod
+    def _get_options():
+        return settings.STOCKS_SETTINGS['EXCHANGE_RATES']
+
+    def _get_provider(self):
+        if self._provider is None:
+            options = self._get_options()
+            self._provider = import_string(options['PROVIDER'])(**options.get('OPTIONS', {}))
+        return self._provider
+
+    def reset(self):
+        self._state = (None, 0)
+        self._provider = None
+
+    def get_rate(self, currency_code_from, currency_code_to):
+        with metrics.timer(metrics.rate_fetch_seconds):
+            matrix = self.get_matrix()
+        try:
+            return matrix[(currency_code_from, currency_code_to)]
+        except KeyError:
+            raise ExchangeRateError(f"Don't have exchange rate {currency_code_from}/{currency_code_to}")
+
+    def get_matrix(self):
+        options = self._get_options()
+        self._start_refresher(options)
+
+        matrix, fetched = self._state
+        age = time.monotonic() - fetched
+        if matrix is None or age > options['TTL'] + options['STALE_TTL']:
+            self.refresh()
+            matrix, _ = self._state
+        elif age > options['TTL']:
+            self._refresh_in_background()
+        return matrix
+
+    def refresh(self):
+        started = time.monotonic()
+        with self._refresh_lock:
+            _, fetched = self._state
+            if fetched >= started:
+                # another thread has refreshed matrix while we waited for lock
+                return
+            try:
+                rates = self._get_provider().get_rates()
+            except Exception as e:
+                # provider errors are not shown to users
+                raise ExchangeRateError('Exchange rates are not available') from e
+            self._state = (build_rates_matrix(rates), time.monotonic())
+
+    def _safe_refresh(self):
+        try:
+            self.refresh()
+        except Exception:
+            logger.exception('Failed to refresh exchange rates, stale rates are kept')
+
+    def _refresh_in_background(self):
+        if self._refresh_lock.locked():
+            return
+        threading.Thread(target=self._safe_refresh, daemon=True).start()
+
+    def _start_refresher(self, options):
+        """Starts periodic refresh once per process, lazily to not start threads before workers fork"""
+        interval = options.get('REFRESH_INTERVAL')
+        if not interval or self._refresher_pid == os.getpid():
+            return
+        with self._refresher_lock:
+            if self._refresher_pid == os.getpid():
+                return
+            self._refresher_pid = os.getpid()
+
+            def refresh_periodically():
+                while True:
+                    time.sleep(interval)
+                    self._safe_refresh()
+
+            threading.Thread(target=refresh_periodically, name='rates-refresher', daemon=True).start()
+
+
+rates_cache = RatesCache()
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors: norlyakov
+:Date: 18.10.2026
+"""
+from datetime import datetime
+
+from django.db import transaction
+from django.db.models import Sum, Q, F, Value, OuterRef, Subquery, DateTimeField
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .locking import lock_stocks, retry_on_conflict
+from .models import (
+    Stock, Transaction, ArchivedTransaction, TransactionStatuses, CommissionAccrual, ReconciledBalance,
+)
+from .money import MoneyField, to_major
+from .registry import currencies
+
+# watermark of stocks which were never reconciled, their whole ledger is summed
+BEGINNING = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def _flows_sum(queryset, stock_field, until):
+    """Sum of stock's flows created after its watermark, by index on (stock, created)"""
+    flows = queryset.filter(**{
+        stock_field: OuterRef('pk'),
+        'created__gt': OuterRef('reconciled_since'),
+        'created__lte': until,
+    }).order_by().values(stock_field).annotate(total=Sum('value')).values('total')
+    return Coalesce(Subquery(flows, output_field=MoneyField()), 0)
+
+
+def get_stocks_to_reconcile(pk_from, pk_to, limit):
+    """
+    Pks of stocks in [pk_from, pk_to) which were never reconciled, were changed after their watermark
+    or mismatched their ledger balance last time
+    """
+    stocks = Stock.objects.filter(pk__gte=pk_from)
+    if pk_to is not None:
+        stocks = stocks.filter(pk__lt=pk_to)
+    return list(stocks.filter(
+        Q(reconciled_balance__isnull=True) |
+        Q(updated__gt=F('reconciled_balance__reconciled_at')) |
+        ~Q(value=F('reconciled_balance__value')),
+    ).order_by('pk').values_list('pk', flat=True)[:limit])
+
+
+@retry_on_conflict
+def reconcile_stocks(stock_pks, baseline=False):
+    """
+    Compares stocks' values with their ledger balances and moves their watermark to now.
+    Stocks are locked first, so transactions in progress are committed and every flow of them
+    is either created before now or after it. Ledger balances of all stocks are summed by one query.
+    With baseline=True stocks which were never reconciled take their values as ledger balances,
+    so reconciliation can be started on existing stocks without summing their whole history.
+    Returns list of mismatches, their ledger balance is kept, so they are reported until fixed.
+    """
+    done = Transaction.objects.filter(status=TransactionStatuses.done)
+    # stocks which were never reconciled have flows in archive
+    archived = ArchivedTransaction.objects.filter(status=TransactionStatuses.done)
+    with transaction.atomic():
+        locked_stocks = lock_stocks(stock_pks)
+        now = timezone.now()
+        stocks = Stock.objects.filter(pk__in=locked_stocks).annotate(
+            reconciled_value=Coalesce('reconciled_balance__value', 0),
+            reconciled_since=Coalesce(
+                'reconciled_balance__reconciled_at', Value(BEGINNING, output_field=DateTimeField()),
+            ),
+            income=_flows_sum(done, 'stock_to', now) + _flows_sum(archived, 'stock_to', now),
+            outcome=_flows_sum(done, 'stock_from', now) + _flows_sum(archived, 'stock_from', now),
+            accrued=_flows_sum(CommissionAccrual.objects.all(), 'stock', now),
+        ).values('pk', 'currency_id', 'reconciled_balance', 'reconciled_value', 'income', 'outcome', 'accrued')
+
+        mismatches = []
+        new_balances = []
+        updated_balances = []
+        for row in stocks:
+            actual = locked_stocks[row['pk']].value
+            if baseline and row['reconciled_balance'] is None:
+                expected = actual
+            else:
+                expected = row['reconciled_value'] + row['income'] - row['outcome'] - row['accrued']
+            balance = ReconciledBalance(stock_id=row['pk'], value=expected, reconciled_at=now)
+            if row['reconciled_balance'] is None:
+                new_balances.append(balance)
+            else:
+                updated_balances.append(balance)
+
+            if actual != expected:
+                currency = currencies.get(row['currency_id'])
+                mismatches.append({
+                    'stock': row['pk'],
+                    'currency': currency.code,
+                    'expected': str(to_major(expected, currency.scale)),
+                    'actual': str(to_major(actual, currency.scale)),
+                    'difference': str(to_major(actual - expected, currency.scale)),
+                    'reconciled_at': now.isoformat(),
+                })
+
+        ReconciledBalance.objects.bulk_create(new_balances)
+        ReconciledBalance.objects.bulk_update(updated_balances, ['value', 'reconciled_at'])
+
+    return mismatches
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors: norlyakov
+:Date: 18.10.2026
+"""
+import threading
+import time
+import zlib
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .models import Currency, Stock
+
+
+def get_master_stock_pks(currency_code):
+    """
+    Returns list of master sub-stocks (shards) pks for currency.
+    First of them is primary one, other shards are swept into it by consolidation.
+    """
+    master_stock_pks = settings.STOCKS_SETTINGS['MASTER_STOCKS'].get(currency_code)
+    if not master_stock_pks:
+        raise RuntimeError(f"Didn't find master stock for currency {currency_code}")
+    if isinstance(master_stock_pks, int):
+        return [master_stock_pks]
+    return list(master_stock_pks)
+
+
+def get_shard_index(shard_key, shards_count):
+    """Stable between processes, unlike builtin hash() for strings"""
+    return zlib.crc32(str(shard_key).encode()) % shards_count
+
+
+def check_master_stocks_settings():
+    for currency_code, master_stock_pks in settings.STOCKS_SETTINGS['MASTER_STOCKS'].items():
+        if isinstance(master_stock_pks, int):
+            master_stock_pks = [master_stock_pks]
+        if not master_stock_pks or not all(isinstance(pk, int) for pk in master_stock_pks):
+            raise ImproperlyConfigured(f'Master stocks for {currency_code} must be pk or list of pks')
+
+
+class MasterStockRegistry:
+    """
+    Process-local map currency id -> master sub-stocks pks.
+    It is loaded and validated against db on first use and dropped when master stocks,
+    currencies or settings are changed.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._state = None  # (currency id -> pks, all pks, pk -> owner id, pk -> primary pk), swapped atomically
+
+    def invalidate(self):
+        self._state = None
+
+    def _load(self):
+        configured = {code: get_master_stock_pks(code) for code in settings.STOCKS_SETTINGS['MASTER_STOCKS']}
+        all_pks = {pk for pks in configured.values() for pk in pks}
+        found = {
+            pk: (currency_id, currency_code, user_id)
+            for pk, currency_id, currency_code, user_id in
+            Stock.objects.filter(pk__in=all_pks).values_list('pk', 'currency_id', 'currency__code', 'user_id')
+        }
+
+        by_currency = {}
+        for currency_code, pks in configured.items():
+            for pk in pks:
+                if pk not in found:
+                    raise RuntimeError(f"Didn't find master stock {pk} for currency {currency_code}")
+                if found[pk][1] != currency_code:
+                    raise RuntimeError(f'Master stock for {currency_code} has another currency - {found[pk][1]}')
+            by_currency[found[pks[0]][0]] = pks
+        owners = {pk: found[pk][2] for pk in all_pks}
+        primaries = {pk: pks[0] for pks in configured.values() for pk in pks}
+        return by_currency, frozenset(all_pks), owners, primaries
+
+    def _get_state(self):
+        state = self._state
+        if state is None:
+            with self._lock:
+                if self._state is None:
+                    self._state = self._load()
+                state = self._state
+        return state
+
+    def get_pks(self, currency_id):
+        by_currency, _, _, _ = self._get_state()
+        master_stock_pks = by_currency.get(currency_id)
+        if not master_stock_pks:
+            raise RuntimeError(f"Didn't find master stock for currency {currency_id}")
+        return master_stock_pks
+
+    def get_pk(self, currency_id, shard_key=None):
+        master_stock_pks = self.get_pks(currency_id)
+        if shard_key is None:
+            return master_stock_pks[0]
+        return master_stock_pks[get_shard_index(shard_key, len(master_stock_pks))]
+
+    def get_all_pks(self):
+        _, all_pks, _, _ = self._get_state()
+        return all_pks
+
+    def get_owner_id(self, stock_pk):
+        """User of master stock, None for other stocks"""
+        _, _, owners, _ = self._get_state()
+        return owners.get(stock_pk)
+
+    def get_primary_pk(self, stock_pk):
+        """Primary master stock of the same currency as master stock, None for other stocks"""
+        _, _, _, primaries = self._get_state()
+        return primaries.get(stock_pk)
+
+    def contains(self, stock_pk):
+        """Checks stock without loading registry"""
+        state = self._state
+        return state is not None and stock_pk in state[1]
+
+
+master_stocks = MasterStockRegistry()
+
+
+class CurrencyRegistry:
+    """
+    Process-local versioned copy of currencies table. Currencies are almost never changed,
+    so they are loaded once and reloaded after changes, on lookup miss (currency could be created
+    by another process) or after CURRENCY_REGISTRY_TTL seconds. Version is increased on every reload.
+    Returned currencies are shared between threads and must not be modified.
+    """
+    MISS_RELOAD_INTERVAL = 1
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._state = None  # (ordered currencies, id -> currency, code -> currency, load time)
+        self.version = 0
+
+    def invalidate(self):
+        with self._lock:
+            self._state = None
+            self.version += 1
+
+    def _get_state(self, reload=False):
+        state = self._state
+        if state is not None and not reload:
+            if time.monotonic() - state[3] < settings.STOCKS_SETTINGS['CURRENCY_REGISTRY_TTL']:
+                return state
+        with self._lock:
+            if self._state is state:
+                currencies = list(Currency.objects.order_by('pk'))
+                self._state = (
+                    currencies,
+                    {currency.pk: currency for currency in currencies},
+                    {currency.code: currency for currency in currencies},
+                    time.monotonic(),
+                )
+                self.version += 1
+            return self._state
+
+    def _reload_on_miss(self, state):
+        if time.monotonic() - state[3] < self.MISS_RELOAD_INTERVAL:
+            return state
+        return self._get_state(reload=True)
+
+    def all(self):
+        return self._get_state()[0]
+
+    def get(self, pk):
+        state = self._get_state()
+        if pk not in state[1]:
+            state = self._reload_on_miss(state)
+        return state[1].get(pk)
+
+    def get_by_code(self, code):
+        state = self._get_state()
+        if code not in state[2]:
+            state = self._reload_on_miss(state)
+        return state[2].get(code)
+
+
+currencies = CurrencyRegistry()
+
+
+@receiver(post_save, sender=Stock)
+@receiver(post_delete, sender=Stock)
+def invalidate_master_stocks_by_stock(sender, instance, update_fields=None, **kwargs):
+    # balance updates of master stocks don't change registry
+    if update_fields is not None and not {'currency', 'is_active'} & set(update_fields):
+        return
+    if master_stocks.contains(instance.pk):
+        master_stocks.invalidate()
+
+
+@receiver(post_save, sender=Currency)
+@receiver(post_delete, sender=Currency)
+def invalidate_by_currency(sender, **kwargs):
+    master_stocks.invalidate()
+    currencies.invalidate()
+
+
+@receiver(setting_changed)
+def invalidate_by_settings(setting, **kwargs):
+    if setting == 'STOCKS_SETTINGS':
+        master_stocks.invalidate()
+        currencies.invalidate()
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors: norlyakov
+:Date: 18.10.2026
+"""
+import random
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections
+from rest_framework.permissions import SAFE_METHODS
+
+PIN_CACHE_KEY = 'stocks:primary-pin:{}'
+
+_state = threading.local()
+
+
+def pin_to_primary():
+    """Reads of current thread go to primary until unpin()"""
+    _state.pinned = True
+
+
+def unpin():
+    _state.pinned = False
+
+
+def is_pinned():
+    return getattr(_state, 'pinned', False)
+
+
+def pin_user(user_id):
+    """
+    User's reads go to primary for REPLICA_PIN_SECONDS after his write, so he doesn't get
+    stale balance from lagging replica. Cache must be shared by all processes to work between them.
+    """
+    cache.set(PIN_CACHE_KEY.format(user_id), True, settings.STOCKS_SETTINGS['REPLICA_PIN_SECONDS'])
+
+
+def is_user_pinned(user_id):
+    return cache.get(PIN_CACHE_KEY.format(user_id), False)
+
+
+class PrimaryReplicaRouter:
+    """
+    Sends reads to random replica from STOCKS_SETTINGS['READ_REPLICAS'], everything else to primary.
+    Reads stay on primary inside transaction, in pinned thread and for select_for_update querysets,
+    which Django routes as writes.
+    """
+
+    def db_for_read(self, model, **hints):
+        replicas = settings.STOCKS_SETTINGS['READ_REPLICAS']
+        if not replicas or is_pinned() or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replicas have the same data as primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db not in settings.STOCKS_SETTINGS['READ_REPLICAS']
+
+
+class PrimaryPinViewMixin:
+    """
+    Pins requests with unsafe methods to primary and pins user to primary after them.
+    Is done after authentication, when user is known.
+    """
+    pinned_user_id = None
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        if not settings.STOCKS_SETTINGS['READ_REPLICAS']:
+            return
+
+        user_id = request.user.pk
+        if request.method not in SAFE_METHODS:
+            pin_to_primary()
+            self.pinned_user_id = user_id
+        elif user_id and is_user_pinned(user_id):
+            pin_to_primary()
+
+    def dispatch(self, request, *args, **kwargs):
+        try:
+            return super().dispatch(request, *args, **kwargs)
+        finally:
+            unpin()
+            if self.pinned_user_id:
+                pin_user(self.pinned_user_id)
@@ -5,16 +5,22 @@
 """
 from decimal import Decimal
 
+from django.conf import settings
 from rest_framework import serializers
 
+from . import metrics, money
 from .models import Currency, Stock, TransactionTypes
-from .utils import UserTransactionService
+from .provisioning import provision_stocks
+from .registry import currencies
+from .utils import (
+    UserTransactionService, is_async_transactions, is_exchange_matching, get_minor_value, get_revocable_transactions,
+)
 
 
 class CurrencySerializer(serializers.ModelSerializer):
     class Meta:
         model = Currency
-        fields = ['id', 'name', 'code']
+        fields = ['id', 'name', 'code', 'scale']
 
     def create(self, validated_data):
         return NotImplementedError('Currency can not be created')
@@ -23,32 +29,82 @@ class CurrencySerializer(serializers.ModelSerializer):
         raise NotImplementedError('Currency can not be updated')
 
 
+class CurrencyCodeField(serializers.CharField):
+    """Currency shown by code, resolved by currency registry without queries"""
+
+    def get_attribute(self, instance):
+        return instance.currency_id
+
+    def to_representation(self, value):
+        return currencies.get(value).code
+
+    def run_validation(self, data=serializers.empty):
+        currency = currencies.get_by_code(super().run_validation(data))
+        if not currency:
+            raise serializers.ValidationError('Currency with such code does not exist')
+        return currency
+
+
+class AmountField(serializers.DecimalField):
+    """
+    Amount kept in minor units, shown in major units of currency of stock or transaction.
+    Input is validated as decimal, serializer converts it to minor units when currency is known.
+    """
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault('max_digits', len(str(money.MAX_MINOR)) + money.MAX_SCALE)
+        kwargs.setdefault('decimal_places', money.MAX_SCALE)
+        super().__init__(**kwargs)
+
+    def get_attribute(self, instance):
+        # stock has currency, transaction has it through its stocks
+        stock = instance if isinstance(instance, Stock) else instance.stock_from or instance.stock_to
+        return super().get_attribute(instance), stock.currency_id
+
+    def to_representation(self, value):
+        minor, currency_id = value
+        return str(money.to_major(minor, currencies.get(currency_id).scale))
+
+
 class StockSerializer(serializers.Serializer):
     id = serializers.IntegerField(read_only=True)
     user = serializers.ReadOnlyField(source='user.username')
-    currency = serializers.CharField(max_length=10, source='currency.code')
-    value = serializers.DecimalField(max_digits=100, decimal_places=5, read_only=True)
+    currency = CurrencyCodeField(max_length=10)
+    value = AmountField(read_only=True)
 
     def create(self, validated_data):
-        currency_code = validated_data.pop('currency')['code']
-        currency = Currency.objects.filter(code=currency_code).first()
-        if not currency:
-            raise serializers.ValidationError('Currency with such code does not exist')
-        return Stock.objects.create(currency=currency, **validated_data)
+        return Stock.objects.create(**validated_data)
 
     def update(self, instance, validated_data):
         raise NotImplementedError('Stock can not be updated')
 
     def validate(self, attrs):
-        stock = Stock.objects.filter(
-            currency__code=attrs['currency']['code'],
+        stock_exists = Stock.objects.filter(
+            currency_id=attrs['currency'].pk,
             user=self.context['request'].user
-        ).first()
-        if stock:
+        ).exists()
+        if stock_exists:
             raise serializers.ValidationError('User already have stock with this currency')
         return attrs
 
 
+class StockBulkCreateSerializer(serializers.Serializer):
+    currencies = serializers.ListField(child=CurrencyCodeField(max_length=10), allow_empty=False)
+
+    def create(self, validated_data):
+        currency_ids = {currency.pk for currency in validated_data['currencies']}
+        return provision_stocks(self.context['request'].user.pk, currency_ids)
+
+    def update(self, instance, validated_data):
+        raise NotImplementedError('Stock can not be updated')
+
+    def validate_currencies(self, value):
+        max_size = settings.STOCKS_SETTINGS['BATCH_MAX_SIZE']
+        if len(value) > max_size:
+            raise serializers.ValidationError(f'Can create at most {max_size} stocks at once')
+        return value
+
+
 TYPE_CHOICES = [
     TransactionTypes.common,
     TransactionTypes.exchange,
@@ -59,18 +115,135 @@ class TransactionSerializer(serializers.Serializer):
     id = serializers.IntegerField(read_only=True)
     created = serializers.DateTimeField(read_only=True)
     updated = serializers.DateTimeField(read_only=True)
-    stock_from = serializers.PrimaryKeyRelatedField(allow_null=True, queryset=Stock.objects.filter(is_active=True))
-    stock_to = serializers.PrimaryKeyRelatedField(allow_null=True, queryset=Stock.objects.filter(is_active=True))
-    value = serializers.DecimalField(max_digits=100, decimal_places=5, min_value=Decimal('0'))
+    # stocks are resolved together in validate()
+    stock_from = serializers.IntegerField(allow_null=True, source='stock_from_id')
+    stock_to = serializers.IntegerField(allow_null=True, source='stock_to_id')
+    value = AmountField(min_value=Decimal('0'))
     type = serializers.ChoiceField(choices=TYPE_CHOICES)
+    # transaction is pending until queue worker executes it in async mode
+    status = serializers.CharField(read_only=True)
+    error = serializers.CharField(read_only=True)
 
     def create(self, validated_data):
+        # matched exchanges are executed together by match_exchanges command
+        if is_async_transactions() or validated_data['type'] == TransactionTypes.exchange and is_exchange_matching():
+            return UserTransactionService.enqueue_transaction(validated_data)
         return UserTransactionService.make_transaction(validated_data)
 
     def update(self, instance, validated_data):
         raise NotImplementedError('Transaction can not be updated')
 
-    def validate_stock_from(self, value):
-        if value.user != self.context['request'].user:
+    @metrics.timer(metrics.serializer_validate_seconds, 'TransactionSerializer')
+    def validate(self, attrs):
+        stock_pks = {attrs['stock_from_id'], attrs['stock_to_id']} - {None}
+        stocks = Stock.objects.filter(pk__in=stock_pks, is_active=True).in_bulk() if stock_pks else {}
+
+        errors = {}
+        for field_name in ('stock_from', 'stock_to'):
+            pk = attrs.pop(f'{field_name}_id')
+            attrs[field_name] = stocks.get(pk)
+            if pk is not None and attrs[field_name] is None:
+                errors[field_name] = [f'Invalid pk "{pk}" - object does not exist.']
+        if errors:
+            raise serializers.ValidationError(errors)
+
+        if attrs['stock_from'] and attrs['stock_from'].user_id != self.context['request'].user.pk:
+            raise serializers.ValidationError({'stock_from': ["Stock don't belong to user."]})
+
+        if attrs['stock_from']:
+            attrs['value'] = get_minor_value(attrs['value'], attrs['stock_from'].currency_id)
+        return attrs
+
+
+class TransactionBatchItemSerializer(serializers.Serializer):
+    stock_from = serializers.IntegerField()
+    stock_to = serializers.IntegerField()
+    value = AmountField(min_value=Decimal('0'))
+    type = serializers.ChoiceField(choices=TYPE_CHOICES)
+
+
+class TransactionBatchSerializer(serializers.Serializer):
+    transactions = TransactionBatchItemSerializer(many=True, allow_empty=False)
+    atomic = serializers.BooleanField(default=True)
+
+    def create(self, validated_data):
+        results = UserTransactionService.make_batch(
+            self.context['request'].user,
+            validated_data['transactions'],
+            atomic=validated_data['atomic'],
+        )
+        return [
+            {'status': 'error', 'errors': error} if error is not None else
+            {'status': 'ok', 'transaction': TransactionSerializer(legs[0]).data}
+            for legs, error in results
+        ]
+
+    def update(self, instance, validated_data):
+        raise NotImplementedError('Transaction can not be updated')
+
+    def validate_transactions(self, value):
+        max_size = settings.STOCKS_SETTINGS['BATCH_MAX_SIZE']
+        if len(value) > max_size:
+            raise serializers.ValidationError(f'Batch can contain at most {max_size} transactions')
+        return value
+
+
+class TransactionRevokeBatchSerializer(serializers.Serializer):
+    """Transactions to revoke are given by ids or by filter of done common transactions"""
+    transactions = serializers.ListField(child=serializers.IntegerField(), required=False, allow_empty=False)
+    date_from = serializers.DateTimeField(required=False)
+    date_to = serializers.DateTimeField(required=False)
+    stock = serializers.IntegerField(required=False)
+    atomic = serializers.BooleanField(default=True)
+
+    def create(self, validated_data):
+        results = UserTransactionService.revoke_batch(validated_data['transactions'], atomic=validated_data['atomic'])
+        return [
+            {'transaction': pk, 'status': 'error', 'errors': error} if error is not None else
+            {'transaction': pk, 'status': 'ok', 'revoke': legs[0].pk}
+            for pk, (legs, error) in zip(validated_data['transactions'], results)
+        ]
+
+    def update(self, instance, validated_data):
+        raise NotImplementedError('Transaction can not be updated')
+
+    def validate(self, attrs):
+        max_size = settings.STOCKS_SETTINGS['BATCH_MAX_SIZE']
+        filters = {name: attrs[name] for name in ('date_from', 'date_to', 'stock') if name in attrs}
+        if 'transactions' in attrs:
+            if filters:
+                raise serializers.ValidationError('Give either transactions or filter')
+        elif filters:
+            attrs['transactions'] = list(get_revocable_transactions(
+                filters.get('date_from'), filters.get('date_to'), filters.get('stock'),
+            ).order_by('pk').values_list('pk', flat=True)[:max_size + 1])
+            if not attrs['transactions']:
+                raise serializers.ValidationError('No transactions match filter')
+        else:
+            raise serializers.ValidationError('Need to provide transactions or filter')
+
+        if len(attrs['transactions']) > max_size:
+            raise serializers.ValidationError(
+                f'Batch can contain at most {max_size} transactions, use revoke_transactions command for more'
+            )
+        return attrs
+
+
+class StockBalanceSerializer(serializers.Serializer):
+    at = serializers.DateTimeField()
+
+
+class StockValuationSerializer(serializers.Serializer):
+    currency = CurrencyCodeField(max_length=10)
+
+
+class TransactionExportSerializer(serializers.Serializer):
+    output = serializers.ChoiceField(choices=['csv', 'ndjson'], default='csv')
+    date_from = serializers.DateTimeField(required=False)
+    date_to = serializers.DateTimeField(required=False)
+    stock = serializers.PrimaryKeyRelatedField(required=False, queryset=Stock.objects.all())
+
+    def validate_stock(self, value):
+        if value.user_id != self.context['request'].user.pk:
             raise serializers.ValidationError("Stock don't belong to user.")
         return value
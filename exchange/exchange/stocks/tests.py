@@ -1,3 +1,1445 @@
-from django.test import TestCase
+import asyncio
+import csv
+import json
+import time
+from datetime import timedelta
+from decimal import Decimal, ROUND_UP
+from io import StringIO
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command, CommandError
+from django.db import connection, connections, transaction, OperationalError
+from django.db.migrations.executor import MigrationExecutor
+from django.db.models import F
+from django.test import TestCase, SimpleTestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from . import benchmark, metrics, routers
+from .balances import get_balance_at
+from .errors import ExchangeRateError
+from .events import broker, events_application, split_payloads, PostgresBackend
+from .locking import lock_stocks, retry_on_conflict, retry_counters, get_retry_stats
+from .money import to_minor, to_major, multiply, convert, rounding
+from .models import (
+    Currency, Stock, Transaction, TransactionTypes, TransactionStatuses, TransactionQueueItem, CommissionAccrual,
+    IdempotencyKey, StockBalanceSnapshot, ReconciledBalance, ArchivedTransaction,
+)
+from .rates import RateProvider, RatesCache
+from .registry import currencies, master_stocks, get_shard_index
+from .utils import UserTransactionService
+
+
+class StocksTestCase(TestCase):
+    """Two currencies with master stocks and two users with stocks"""
+
+    def setUp(self):
+        self.usd = Currency.objects.create(name='dollar', code='USD')
+        self.rub = Currency.objects.create(name='ruble', code='RUB')
+
+        master = User.objects.create(username='master')
+        self.master_usd = Stock.objects.create(user=master, currency=self.usd,
+                                               value=to_minor('100000', self.usd.scale))
+        self.master_rub = Stock.objects.create(user=master, currency=self.rub,
+                                               value=to_minor('100000', self.rub.scale))
+        settings_override = override_settings(STOCKS_SETTINGS={
+            **settings.STOCKS_SETTINGS,
+            'MASTER_STOCKS': {'USD': self.master_usd.pk, 'RUB': self.master_rub.pk},
+        })
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.user = User.objects.create(username='user')
+        self.user_usd = Stock.objects.create(user=self.user, currency=self.usd, value=to_minor('1000', self.usd.scale))
+        self.user_rub = Stock.objects.create(user=self.user, currency=self.rub, value=to_minor('1000', self.rub.scale))
+        self.other_user = User.objects.create(username='other_user')
+        self.other_usd = Stock.objects.create(user=self.other_user, currency=self.usd,
+                                              value=to_minor('0', self.usd.scale))
+
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+        # registries are process-wide and loaded once, their queries are not part of request
+        currencies.all()
+        master_stocks.get_all_pks()
+
+    def post_transaction(self, stock_from, stock_to, value, tr_type=TransactionTypes.common, client=None,
+                         status_code=None, **extra):
+        """Posts transaction by self.client or given client, checks response status if it is given"""
+        response = (client or self.client).post('/transactions/', {
+            'stock_from': stock_from.pk,
+            'stock_to': stock_to.pk,
+            'value': value,
+            'type': tr_type,
+        }, format='json', **extra)
+        if status_code is not None:
+            self.assertEqual(response.status_code, status_code, response.data)
+        return response
+
+    def run_commit_hooks(self):
+        # test case is never committed, so on_commit callbacks are run explicitly
+        callbacks, connection.run_on_commit = connection.run_on_commit, []
+        for _, callback in callbacks:
+            callback()
+
+    def assertStockValue(self, stock, value):
+        """Compares value in major units"""
+        stock.refresh_from_db()
+        self.assertEqual(to_major(stock.value, currencies.get(stock.currency_id).scale), Decimal(value))
+
+
+class TransactionCreateQueriesTestCase(StocksTestCase):
+
+    def test_common(self):
+        # stocks, savepoint, lock, 2 stock updates, insert, stock and master updates, insert, release
+        with self.assertNumQueries(10):
+            response = self.post_transaction(self.user_usd, self.other_usd, '100', TransactionTypes.common)
+        self.assertEqual(response.status_code, 201, response.data)
+
+        self.assertStockValue(self.user_usd, '895')
+        self.assertStockValue(self.other_usd, '100')
+        self.assertStockValue(self.master_usd, '100005')
+
+    def test_exchange(self):
+        # stocks, savepoint, lock, 2 x (2 stock updates, insert), release
+        with self.assertNumQueries(10):
+            response = self.post_transaction(self.user_usd, self.user_rub, '10', TransactionTypes.exchange)
+        self.assertEqual(response.status_code, 201, response.data)
+
+        self.assertStockValue(self.user_usd, '990')
+        self.assertStockValue(self.user_rub, '1650')
+        self.assertStockValue(self.master_usd, '100010')
+        self.assertStockValue(self.master_rub, '99350')
+
+    def test_not_enough_money(self):
+        # stocks, savepoint, lock, 2 stock updates, insert, commission fails, rollback to savepoint, release
+        with self.assertNumQueries(8):
+            response = self.post_transaction(self.user_usd, self.other_usd, '1000', TransactionTypes.common)
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Transaction.objects.exists())
+
+    def test_foreign_stock(self):
+        with self.assertNumQueries(1):
+            response = self.post_transaction(self.other_usd, self.user_usd, '1', TransactionTypes.common)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('stock_from', response.data)
+
+    def test_unknown_stock(self):
+        with self.assertNumQueries(1):
+            response = self.client.post('/transactions/', {
+                'stock_from': self.user_usd.pk,
+                'stock_to': 0,
+                'value': '1',
+                'type': TransactionTypes.common,
+            }, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('stock_to', response.data)
+
+
+class MasterStockShardsTestCase(StocksTestCase):
+    """USD master stock has sub-stock of another service user"""
+
+    def setUp(self):
+        super().setUp()
+        self.master_usd_shard = Stock.objects.create(user=User.objects.create(username='master2'), currency=self.usd)
+        settings_override = override_settings(STOCKS_SETTINGS={
+            **settings.STOCKS_SETTINGS,
+            'MASTER_STOCKS': {'USD': [self.master_usd.pk, self.master_usd_shard.pk], 'RUB': self.master_rub.pk},
+        })
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        # user whose commissions go to the shard
+        shard_user = User.objects.create(username='shard_user')
+        while get_shard_index(shard_user.pk, 2) != 1:
+            shard_user.delete()
+            shard_user = User.objects.create(username='shard_user')
+        self.shard_user = shard_user
+        self.shard_usd = Stock.objects.create(user=shard_user, currency=self.usd,
+                                              value=to_minor('1000', self.usd.scale))
+        self.shard_rub = Stock.objects.create(user=shard_user, currency=self.rub,
+                                              value=to_minor('6500', self.rub.scale))
+        self.shard_client = APIClient()
+        self.shard_client.force_authenticate(shard_user)
+
+    def test_get_pk(self):
+        usd_pks = [self.master_usd.pk, self.master_usd_shard.pk]
+        self.assertEqual(master_stocks.get_pks(self.usd.pk), usd_pks)
+        self.assertEqual(master_stocks.get_pk(self.usd.pk), self.master_usd.pk)
+        self.assertEqual(master_stocks.get_pk(self.usd.pk, shard_key=self.shard_user.pk), self.master_usd_shard.pk)
+        self.assertEqual({master_stocks.get_pk(self.usd.pk, shard_key=key) for key in range(10)}, set(usd_pks))
+        self.assertEqual(master_stocks.get_pk(self.rub.pk, shard_key=self.shard_user.pk), self.master_rub.pk)
+        self.assertEqual(master_stocks.get_owner_id(self.master_usd_shard.pk), self.master_usd_shard.user_id)
+        self.assertEqual(master_stocks.get_primary_pk(self.master_usd_shard.pk), self.master_usd.pk)
+        self.assertIsNone(master_stocks.get_primary_pk(self.shard_usd.pk))
+
+    def test_master_balance(self):
+        self.post_transaction(self.shard_usd, self.other_usd, '100', client=self.shard_client, status_code=201)
+        self.assertStockValue(self.master_usd_shard, '5')
+        self.assertEqual(UserTransactionService.get_master_balance(self.usd), to_minor('100005', self.usd.scale))
+
+    def test_exchange_after_consolidation(self):
+        self.post_transaction(self.shard_usd, self.other_usd, '100', client=self.shard_client, status_code=201)
+        stdout = StringIO()
+        call_command('consolidate_master_stocks', 'USD', stdout=stdout)
+        self.assertIn(f'swept 5.00 from stock {self.master_usd_shard.pk}', stdout.getvalue())
+        self.assertStockValue(self.master_usd_shard, '0')
+        self.assertStockValue(self.master_usd, '100005')
+        self.assertEqual(UserTransactionService.get_master_balance(self.usd), to_minor('100005', self.usd.scale))
+
+        # payout goes from primary master stock, income of the other currency goes to user's shard
+        self.post_transaction(self.shard_rub, self.shard_usd, '6500', TransactionTypes.exchange,
+                              client=self.shard_client, status_code=201)
+        self.assertStockValue(self.shard_usd, '995')
+        self.assertStockValue(self.master_usd, '99905')
+        self.post_transaction(self.shard_usd, self.shard_rub, '10', TransactionTypes.exchange,
+                              client=self.shard_client, status_code=201)
+        self.assertStockValue(self.master_usd_shard, '10')
+        self.assertStockValue(self.master_usd, '99905')
+
+    def test_revoke_after_consolidation(self):
+        transaction_pk = self.post_transaction(self.shard_usd, self.other_usd, '100', client=self.shard_client,
+                                               status_code=201).data['id']
+        call_command('consolidate_master_stocks', 'USD', stdout=StringIO())
+
+        # commission is returned from primary master stock, shard is empty
+        response = self.shard_client.post(f'/transactions/{transaction_pk}/revoke/')
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertStockValue(self.shard_usd, '1000')
+        self.assertStockValue(self.other_usd, '0')
+        self.assertStockValue(self.master_usd_shard, '0')
+        self.assertStockValue(self.master_usd, '100000')
+
+    def test_consolidation_dry_run(self):
+        self.post_transaction(self.shard_usd, self.other_usd, '100', client=self.shard_client, status_code=201)
+        stdout = StringIO()
+        call_command('consolidate_master_stocks', '--dry-run', stdout=stdout)
+        self.assertIn('USD: 100005.00 on 2 master stock(s)', stdout.getvalue())
+        self.assertIn('RUB: 100000.00 on 1 master stock(s)', stdout.getvalue())
+        self.assertStockValue(self.master_usd_shard, '5')
+
+
+class LockStocksTestCase(StocksTestCase):
+
+    def test_lock_order(self):
+        # users' stocks go first, master ones have lower pks here
+        locked_stocks = lock_stocks([self.master_rub.pk, self.other_usd.pk, self.master_usd.pk, self.user_usd.pk])
+        self.assertEqual(list(locked_stocks), [self.user_usd.pk, self.other_usd.pk,
+                                               self.master_usd.pk, self.master_rub.pk])
+        self.assertEqual(locked_stocks[self.user_usd.pk].value, self.user_usd.value)
+
+
+def conflict_error(pgcode):
+    error = OperationalError('conflict')
+    error.__cause__ = Exception()
+    error.__cause__.pgcode = pgcode
+    return error
+
+
+@override_settings(STOCKS_SETTINGS={
+    **settings.STOCKS_SETTINGS,
+    'LOCK_RETRY': {'ATTEMPTS': 4, 'BACKOFF': 0.1, 'MAX_BACKOFF': 0.25},
+})
+class RetryOnConflictTestCase(TransactionTestCase):
+    """Retries work outside of atomic block only, so test case doesn't wrap tests in transaction"""
+
+    def setUp(self):
+        retry_counters.reset()
+        self.addCleanup(retry_counters.reset)
+        self.errors = []
+        self.calls = 0
+        sleep_patch = mock.patch('exchange.stocks.locking.time.sleep')
+        self.sleep = sleep_patch.start()
+        self.addCleanup(sleep_patch.stop)
+        # the longest backoff is taken
+        uniform_patch = mock.patch('exchange.stocks.locking.random.uniform', side_effect=lambda low, high: high)
+        uniform_patch.start()
+        self.addCleanup(uniform_patch.stop)
+
+    @retry_on_conflict
+    def operation(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return 'done'
+
+    def test_retried(self):
+        self.errors = [conflict_error('40P01'), conflict_error('40001')]
+        self.assertEqual(self.operation(), 'done')
+        self.assertEqual(self.calls, 3)
+        self.assertEqual(get_retry_stats(), {
+            'retries': 2, 'deadlocks': 1, 'serialization_failures': 1, 'exhausted': 0,
+        })
+        self.assertEqual([call.args[0] for call in self.sleep.call_args_list], [0.1, 0.2])
+
+    def test_exhausted(self):
+        self.errors = [conflict_error('40001') for _ in range(5)]
+        with self.assertRaises(OperationalError):
+            self.operation()
+        self.assertEqual(self.calls, 4)
+        self.assertEqual(get_retry_stats(), {
+            'retries': 3, 'deadlocks': 0, 'serialization_failures': 4, 'exhausted': 1,
+        })
+        self.assertEqual([call.args[0] for call in self.sleep.call_args_list], [0.1, 0.2, 0.25])
+
+    def test_other_error_is_not_retried(self):
+        self.errors = [OperationalError('connection lost'), conflict_error('23505')]
+        with self.assertRaises(OperationalError):
+            self.operation()
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(get_retry_stats()['retries'], 0)
+        self.sleep.assert_not_called()
+
+    def test_not_retried_inside_atomic(self):
+        self.errors = [conflict_error('40P01')]
+        with self.assertRaises(OperationalError):
+            with transaction.atomic():
+                self.operation()
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(get_retry_stats()['deadlocks'], 0)
+
+
+class MasterStockRegistryTestCase(StocksTestCase):
+
+    def test_invalidation(self):
+        master_stocks.get_all_pks()
+        self.assertTrue(master_stocks.contains(self.master_usd.pk))
+
+        # balance updates keep registry
+        self.master_usd.value += 1
+        self.master_usd.save(update_fields=['value', 'updated'])
+        self.assertTrue(master_stocks.contains(self.master_usd.pk))
+        self.user_usd.save()
+        self.assertTrue(master_stocks.contains(self.master_usd.pk))
+
+        self.master_usd.save()
+        self.assertFalse(master_stocks.contains(self.master_usd.pk))
+
+        master_stocks.get_all_pks()
+        Currency.objects.create(name='euro', code='EUR')
+        self.assertFalse(master_stocks.contains(self.master_usd.pk))
+
+    def test_settings_changed(self):
+        self.assertEqual(master_stocks.get_pk(self.rub.pk), self.master_rub.pk)
+        usd_only = {'USD': self.master_usd.pk}
+        with override_settings(STOCKS_SETTINGS={**settings.STOCKS_SETTINGS, 'MASTER_STOCKS': usd_only}):
+            with self.assertRaises(RuntimeError):
+                master_stocks.get_pk(self.rub.pk)
+        self.assertEqual(master_stocks.get_pk(self.rub.pk), self.master_rub.pk)
+
+
+class CurrencyRegistryTestCase(StocksTestCase):
+
+    def test_invalidation(self):
+        version = currencies.version
+        with self.assertNumQueries(0):
+            self.assertEqual(currencies.get_by_code('USD'), self.usd)
+
+        euro = Currency.objects.create(name='euro', code='EUR')
+        self.assertGreater(currencies.version, version)
+        with self.assertNumQueries(1):
+            self.assertEqual(currencies.get_by_code('EUR'), euro)
+            self.assertEqual(currencies.get(euro.pk).name, 'euro')
+
+        euro.name = 'Euro'
+        euro.save()
+        self.assertEqual(currencies.get(euro.pk).name, 'Euro')
+
+        version = currencies.version
+        with override_settings(STOCKS_SETTINGS={**settings.STOCKS_SETTINGS, 'CURRENCY_REGISTRY_TTL': 1}):
+            self.assertGreater(currencies.version, version)
+
+    def test_miss_reloads(self):
+        currencies.all()
+        # currency created by another process, signals are not sent
+        Currency.objects.bulk_create([Currency(name='pound', code='GBP')])
+        with mock.patch('exchange.stocks.registry.time.monotonic', return_value=time.monotonic() + 2):
+            self.assertEqual(currencies.get_by_code('GBP').name, 'pound')
+        self.assertIsNone(currencies.get_by_code('XXX'))
+
+
+class TransactionBatchTestCase(StocksTestCase):
+
+    def post_batch(self, items, **kwargs):
+        return self.client.post('/transactions/batch/', {
+            'transactions': [
+                {'stock_from': stock_from.pk, 'stock_to': stock_to.pk, 'value': value, 'type': tr_type}
+                for stock_from, stock_to, value, tr_type in items
+            ],
+            **kwargs,
+        }, format='json')
+
+    def transfers(self, count, value='10'):
+        return [(self.user_usd, self.other_usd, value, TransactionTypes.common)] * count
+
+    def test_atomic_rejected(self):
+        response = self.post_batch(self.transfers(1) + self.transfers(1, value='1000'))
+        self.assertEqual(response.status_code, 400, response.data)
+        self.assertEqual(response.data['results'], [
+            {'status': 'ok'},
+            {'status': 'error', 'errors': ["Don't have enough money on stock_from"]},
+        ])
+        self.assertFalse(Transaction.objects.exists())
+        self.assertStockValue(self.user_usd, '1000')
+
+    def test_partial(self):
+        response = self.post_batch([
+            (self.user_usd, self.other_usd, '100', TransactionTypes.common),
+            (self.user_usd, self.other_usd, '1000', TransactionTypes.common),
+            (self.other_usd, self.user_usd, '1', TransactionTypes.common),
+            (self.user_usd, self.user_rub, '10', TransactionTypes.exchange),
+            (self.user_usd, self.user_usd, '1', TransactionTypes.common),
+        ], atomic=False)
+        self.assertEqual(response.status_code, 201, response.data)
+        results = response.data['results']
+        self.assertEqual([item['status'] for item in results], ['ok', 'error', 'error', 'ok', 'error'])
+        self.assertEqual(results[1]['errors'], ["Don't have enough money on stock_from"])
+        self.assertEqual(results[2]['errors'], ["Stock don't belong to user."])
+        self.assertEqual(results[4]['errors'], ['Need different stocks'])
+
+        self.assertStockValue(self.user_usd, '885')
+        self.assertStockValue(self.other_usd, '100')
+        self.assertStockValue(self.user_rub, '1650')
+        self.assertStockValue(self.master_usd, '100015')
+        self.assertStockValue(self.master_rub, '99350')
+
+        # commission is linked to its transaction
+        commission = Transaction.objects.get(type=TransactionTypes.commission)
+        self.assertEqual(commission.related_transaction_id, results[0]['transaction']['id'])
+        self.assertEqual(commission.value, to_minor('5', self.usd.scale))
+
+    def test_max_size(self):
+        with override_settings(STOCKS_SETTINGS={**settings.STOCKS_SETTINGS, 'BATCH_MAX_SIZE': 2}):
+            response = self.post_batch(self.transfers(3))
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('transactions', response.data)
+
+    def test_queries(self):
+        # queries don't depend on batch size: one lock query, one balances update and bulk inserts
+        queries = []
+        for count in (2, 6):
+            with CaptureQueriesContext(connection) as context:
+                response = self.post_batch(self.transfers(count))
+            self.assertEqual(response.status_code, 201, response.data)
+            queries.append([query['sql'] for query in context.captured_queries])
+        stock_table = Stock._meta.db_table
+        other_queries = []
+        for count, sqls in zip((2, 6), queries):
+            inserts = [sql for sql in sqls if sql.startswith('INSERT')]
+            if connection.features.can_return_rows_from_bulk_insert:
+                self.assertEqual(len(inserts), 2)
+            else:
+                # without returning pks from bulk insert transactions are inserted one by one
+                self.assertEqual(len(inserts), count * 2)
+            other_queries.append(len(sqls) - len(inserts))
+            self.assertEqual(len([sql for sql in sqls if sql.startswith(f'UPDATE "{stock_table}"')]), 1)
+            locks = [sql for sql in sqls if sql.startswith('SELECT') and f'FROM "{stock_table}"' in sql]
+            # stocks of request and lock of all affected stocks
+            self.assertEqual(len(locks), 2)
+        self.assertEqual(other_queries[0], other_queries[1])
+        self.assertStockValue(self.user_usd, '916')
+
+
+class CountingRateProvider(RateProvider):
+    """Rates are changed by tests, provider fails while rates are None"""
+    rates = None
+    calls = 0
+
+    def get_rates(self):
+        CountingRateProvider.calls += 1
+        if self.rates is None:
+            raise ConnectionError('provider is down')
+        return dict(self.rates)
+
+
+@override_settings(STOCKS_SETTINGS={
+    **settings.STOCKS_SETTINGS,
+    'EXCHANGE_RATES': {'PROVIDER': 'exchange.stocks.tests.CountingRateProvider', 'TTL': 60, 'STALE_TTL': 600},
+})
+class RatesCacheTestCase(SimpleTestCase):
+
+    def setUp(self):
+        CountingRateProvider.rates = {'USD': 65, 'RUB': 1}
+        CountingRateProvider.calls = 0
+        self.now = 1000
+        clock_patch = mock.patch('exchange.stocks.rates.time.monotonic', side_effect=lambda: self.now)
+        clock_patch.start()
+        self.addCleanup(clock_patch.stop)
+        self.rates_cache = RatesCache()
+
+    def test_ttl(self):
+        self.assertEqual(self.rates_cache.get_rate('USD', 'RUB'), 65)
+        self.now += 59
+        self.assertEqual(self.rates_cache.get_rate('RUB', 'USD'), Decimal(1) / 65)
+        self.assertEqual(CountingRateProvider.calls, 1)
+
+    def test_stale_while_revalidate(self):
+        self.rates_cache.get_rate('USD', 'RUB')
+        CountingRateProvider.rates = {'USD': 70, 'RUB': 1}
+        self.now += 61
+        with mock.patch.object(self.rates_cache, '_refresh_in_background') as refresh_in_background:
+            self.assertEqual(self.rates_cache.get_rate('USD', 'RUB'), 65)
+        refresh_in_background.assert_called_once_with()
+
+        # expired rates are loaded synchronously
+        self.now += 600
+        self.assertEqual(self.rates_cache.get_rate('USD', 'RUB'), 70)
+        self.assertEqual(CountingRateProvider.calls, 2)
+
+    def test_unknown_pair(self):
+        with self.assertRaises(ExchangeRateError):
+            self.rates_cache.get_rate('USD', 'EUR')
+
+    def test_provider_error(self):
+        CountingRateProvider.rates = None
+        with self.assertRaisesMessage(ExchangeRateError, 'Exchange rates are not available'):
+            self.rates_cache.get_rate('USD', 'RUB')
+
+
+class ExchangeRatesApiTestCase(StocksTestCase):
+
+    def test_exchange(self):
+        self.post_transaction(self.user_usd, self.user_rub, '10', TransactionTypes.exchange, status_code=201)
+        self.assertStockValue(self.user_usd, '990')
+        self.assertStockValue(self.user_rub, '1650')
+
+    def test_rates_not_available(self):
+        CountingRateProvider.rates = None
+        rates_settings = {'PROVIDER': 'exchange.stocks.tests.CountingRateProvider', 'TTL': 60, 'STALE_TTL': 600}
+        with override_settings(STOCKS_SETTINGS={**settings.STOCKS_SETTINGS, 'EXCHANGE_RATES': rates_settings}), \
+                mock.patch('exchange.stocks.utils.rates_cache', RatesCache()):
+            response = self.post_transaction(self.user_usd, self.user_rub, '10', TransactionTypes.exchange)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data, ['Exchange rates are not available'])
+        self.assertStockValue(self.user_usd, '1000')
+
+
+class TransactionHistoryTestCase(StocksTestCase):
+
+    def setUp(self):
+        super().setUp()
+        # incoming and outgoing transactions, most of them created at the same time
+        created = timezone.now() - timedelta(hours=1)
+        for index in range(25):
+            stock_from, stock_to = (self.other_usd, self.user_usd) if index % 3 else (self.user_usd, self.other_usd)
+            Transaction.objects.create(type=TransactionTypes.common, value=index + 1,
+                                       stock_from=stock_from, stock_to=stock_to)
+        Transaction.objects.filter(pk__in=Transaction.objects.order_by('pk')[5:20].values('pk')).update(created=created)
+        # transaction of other users isn't shown
+        Transaction.objects.create(type=TransactionTypes.common, value=1, stock_from=self.other_usd,
+                                   stock_to=self.master_usd)
+        self.expected = list(Transaction.objects.exclude(stock_to=self.master_usd).order_by(
+            '-created', '-id',
+        ).values_list('pk', flat=True))
+
+    def get_page(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200, response.data)
+        return response.data
+
+    def test_forward_and_backward(self):
+        pages = []
+        page = self.get_page('/transactions/')
+        self.assertIsNone(page['previous'])
+        while True:
+            pages.append([item['id'] for item in page['results']])
+            if page['next'] is None:
+                break
+            page = self.get_page(page['next'])
+        self.assertEqual([len(ids) for ids in pages], [10, 10, 5])
+        self.assertEqual([pk for ids in pages for pk in ids], self.expected)
+
+        # back from the last page
+        for ids in reversed(pages[:-1]):
+            page = self.get_page(page['previous'])
+            self.assertEqual([item['id'] for item in page['results']], ids)
+        self.assertIsNone(page['previous'])
+
+    def test_invalid_cursor(self):
+        response = self.client.get('/transactions/', {'cursor': 'garbage'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_user_without_stocks(self):
+        client = APIClient()
+        client.force_authenticate(User.objects.create(username='newcomer'))
+        response = client.get('/transactions/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, {'next': None, 'previous': None, 'results': []})
+
+
+class TransactionExportTestCase(StocksTestCase):
+
+    def setUp(self):
+        super().setUp()
+        now = timezone.now()
+        self.days_ago = [now - timedelta(days=days) for days in range(4)]
+        self.transactions = []
+        for created, stock_from, stock_to, value in [
+            (self.days_ago[3], self.user_usd, self.other_usd, 150),
+            (self.days_ago[2], self.user_rub, self.master_rub, 2000),
+            (self.days_ago[1], self.other_usd, self.user_usd, 25),
+        ]:
+            transaction_model = Transaction.objects.create(type=TransactionTypes.common, value=value,
+                                                           stock_from=stock_from, stock_to=stock_to)
+            Transaction.objects.filter(pk=transaction_model.pk).update(created=created)
+            self.transactions.append(transaction_model)
+        # transaction of other users isn't exported
+        Transaction.objects.create(type=TransactionTypes.common, value=1, stock_from=self.other_usd,
+                                   stock_to=self.master_usd)
+
+    def export(self, **params):
+        response = self.client.get('/transactions/export/', params)
+        self.assertEqual(response.status_code, 200)
+        return response, b''.join(response.streaming_content).decode()
+
+    def test_csv(self):
+        response, content = self.export()
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="transactions.csv"')
+        rows = list(csv.DictReader(StringIO(content)))
+        self.assertEqual([int(row['id']) for row in rows], [tr.pk for tr in self.transactions])
+        self.assertEqual(rows[0], {
+            'id': str(self.transactions[0].pk),
+            'created': self.days_ago[3].isoformat(),
+            'type': TransactionTypes.common,
+            'stock_from': str(self.user_usd.pk),
+            'stock_to': str(self.other_usd.pk),
+            'currency': 'USD',
+            'value': '1.50',
+            'related_transaction': '',
+            'status': TransactionStatuses.done,
+        })
+
+    def test_ndjson(self):
+        response, content = self.export(output='ndjson')
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        rows = [json.loads(line) for line in content.splitlines()]
+        self.assertEqual([row['id'] for row in rows], [tr.pk for tr in self.transactions])
+        self.assertEqual([(row['currency'], row['value']) for row in rows],
+                         [('USD', '1.50'), ('RUB', '20.00'), ('USD', '0.25')])
+        self.assertIsNone(rows[0]['related_transaction'])
+
+    def test_filters(self):
+        _, content = self.export(output='ndjson', date_from=self.days_ago[3].isoformat(),
+                                 date_to=self.days_ago[1].isoformat())
+        self.assertEqual([json.loads(line)['id'] for line in content.splitlines()],
+                         [tr.pk for tr in self.transactions[:2]])
+
+        _, content = self.export(output='ndjson', stock=self.user_usd.pk)
+        self.assertEqual([json.loads(line)['id'] for line in content.splitlines()],
+                         [self.transactions[0].pk, self.transactions[2].pk])
+
+        _, content = self.export(output='ndjson', stock=self.user_usd.pk, date_from=self.days_ago[2].isoformat())
+        self.assertEqual([json.loads(line)['id'] for line in content.splitlines()], [self.transactions[2].pk])
+
+    def test_invalid_params(self):
+        for params in [{'output': 'xml'}, {'stock': self.other_usd.pk}, {'date_from': 'yesterday'}]:
+            response = self.client.get('/transactions/export/', params)
+            self.assertEqual(response.status_code, 400, params)
+
+
+class CommissionAccrualTestCase(StocksTestCase):
+
+    def setUp(self):
+        super().setUp()
+        settings_override = override_settings(STOCKS_SETTINGS={
+            **settings.STOCKS_SETTINGS,
+            'COMMISSION_MODE': 'accrual',
+        })
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def test_accrue_and_settle(self):
+        for value in ('100', '200'):
+            self.post_transaction(self.user_usd, self.other_usd, value, status_code=201)
+
+        self.assertStockValue(self.user_usd, '685')
+        self.assertStockValue(self.master_usd, '100000')
+        self.assertEqual(CommissionAccrual.objects.filter(settlement__isnull=True).count(), 2)
+
+        call_command('settle_commissions', stdout=StringIO())
+
+        self.assertStockValue(self.master_usd, '100015')
+        self.assertFalse(CommissionAccrual.objects.filter(settlement__isnull=True).exists())
+        summary = Transaction.objects.get(type=TransactionTypes.commission)
+        self.assertEqual(summary.value, to_minor('15', self.usd.scale))
+        self.assertEqual(summary.stock_to_id, self.master_usd.pk)
+
+
+class IdempotencyKeyTestCase(StocksTestCase):
+
+    def post_with_key(self, key, value='100'):
+        return self.post_transaction(self.user_usd, self.other_usd, value, HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_replay(self):
+        response = self.post_with_key('key-1')
+        self.assertEqual(response.status_code, 201, response.data)
+
+        # single key lookup, no stock is locked
+        with self.assertNumQueries(1):
+            replayed = self.post_with_key('key-1')
+        self.assertEqual(replayed.status_code, 201)
+        self.assertEqual(replayed['Idempotent-Replayed'], 'true')
+        self.assertEqual(replayed.data['id'], response.data['id'])
+        self.assertEqual(Transaction.objects.filter(type=TransactionTypes.common).count(), 1)
+        self.assertStockValue(self.user_usd, '895')
+
+    def test_key_reused_for_another_request(self):
+        self.post_with_key('key-1')
+        response = self.post_with_key('key-1', value='200')
+        self.assertEqual(response.status_code, 422)
+        self.assertStockValue(self.user_usd, '895')
+
+    def test_failed_request_is_not_stored(self):
+        response = self.post_with_key('key-1', value='1000')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(IdempotencyKey.objects.exists())
+
+    def test_evict_expired(self):
+        self.post_with_key('key-1')
+        IdempotencyKey.objects.update(created=timezone.now() - timedelta(days=2))
+        call_command('evict_idempotency_keys', stdout=StringIO())
+        self.assertFalse(IdempotencyKey.objects.exists())
+
+
+class BenchmarkTestCase(TestCase):
+    """Benchmark harness run inline with single worker, so it sees test db transaction"""
+
+    def test_scenarios(self):
+        users_stocks, master_stocks_setting = benchmark.seed(5)
+        stocks_settings = {**settings.STOCKS_SETTINGS, 'MASTER_STOCKS': master_stocks_setting}
+        with override_settings(STOCKS_SETTINGS=stocks_settings):
+            for operation in benchmark.OPERATIONS:
+                for scenario in benchmark.SCENARIOS:
+                    operations = benchmark.plan_operations(users_stocks, scenario, operation, 10, seed_value=1)
+                    report = benchmark.run(operations)
+                    self.assertEqual(report['operations'], 10, (operation, scenario))
+                    self.assertEqual(report['errors'], 0)
+                    self.assertGreater(report['queries_per_operation'], 0)
+                    self.assertLessEqual(report['p50_ms'], report['p99_ms'])
+
+    def test_command(self):
+        stocks_settings = settings.STOCKS_SETTINGS
+        stdout = StringIO()
+        call_command('benchmark_transactions', '--users', '3', '--operations', '5', '--workers', '1',
+                     '--scenario', 'uniform', '--json', stdout=stdout)
+        report = json.loads(stdout.getvalue())
+        self.assertEqual(report['operations'], 5)
+        self.assertEqual(report['errors'], 0)
+        # seeded master stocks are not left in settings
+        self.assertIs(settings.STOCKS_SETTINGS, stocks_settings)
+
+
+class MetricsTestCase(StocksTestCase):
+
+    def setUp(self):
+        super().setUp()
+        settings_override = override_settings(STOCKS_SETTINGS={
+            **settings.STOCKS_SETTINGS,
+            'METRICS_ENABLED': True,
+        })
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        metrics.registry.reset()
+
+    def test_scrape(self):
+        for value in ('100', '1000'):
+            self.post_transaction(self.user_usd, self.other_usd, value)
+
+        response = self.client.get('/metrics/')
+        self.assertEqual(response.status_code, 200)
+        text = response.content.decode()
+        self.assertIn('stocks_request_seconds_count{view="TransactionViewSet",action="create",method="POST",'
+                      'status="201"} 1', text)
+        self.assertIn('stocks_service_seconds_count{method="common",outcome="ok"} 1', text)
+        self.assertIn('stocks_lock_seconds_count{target="stock"} 2', text)
+        self.assertIn('stocks_validation_failures_total{view="TransactionViewSet",'
+                      'reason="Don\'t have enough money on stock_from"} 1', text)
+        self.assertIn('stocks_lock_retries_total 0', text)
+
+    def test_disabled(self):
+        with override_settings(STOCKS_SETTINGS={**settings.STOCKS_SETTINGS, 'METRICS_ENABLED': False}):
+            self.assertEqual(self.client.get('/metrics/').status_code, 404)
+
+
+class AsyncTransactionsTestCase(StocksTestCase):
+
+    def setUp(self):
+        super().setUp()
+        settings_override = override_settings(STOCKS_SETTINGS={
+            **settings.STOCKS_SETTINGS,
+            'ASYNC_TRANSACTIONS': True,
+        })
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def test_queued_in_order(self):
+        response = self.post_transaction(self.user_usd, self.other_usd, '100')
+        self.assertEqual(response.status_code, 202, response.data)
+        self.assertEqual(response.data['status'], TransactionStatuses.pending)
+        self.assertStockValue(self.user_usd, '1000')
+
+        # spends money which other user gets by the first transaction
+        other_client = APIClient()
+        other_client.force_authenticate(self.other_user)
+        response = self.post_transaction(self.other_usd, self.user_usd, '50', client=other_client)
+        self.assertEqual(response.status_code, 202, response.data)
+
+        call_command('process_transaction_queue', '--drain', stdout=StringIO())
+
+        self.assertFalse(TransactionQueueItem.objects.exists())
+        self.assertEqual(Transaction.objects.filter(type=TransactionTypes.common,
+                                                    status=TransactionStatuses.done).count(), 2)
+        self.assertStockValue(self.user_usd, '945')
+        self.assertStockValue(self.other_usd, '47.5')
+
+    def test_queue_heads(self):
+        third_user = User.objects.create(username='third_user')
+        third_rub = Stock.objects.create(user=third_user, currency=self.rub, value=to_minor('0', self.rub.scale))
+        other_client = APIClient()
+        other_client.force_authenticate(self.other_user)
+
+        first = self.post_transaction(self.user_usd, self.other_usd, '100')
+        self.post_transaction(self.other_usd, self.user_usd, '50', client=other_client)
+        independent = self.post_transaction(self.user_rub, third_rub, '10')
+
+        # second one waits for first, it uses the same stocks
+        heads = UserTransactionService.get_queue_heads().order_by('pk')
+        self.assertEqual([item.transaction_id for item in heads], [first.data['id'], independent.data['id']])
+
+    def test_failed(self):
+        response = self.post_transaction(self.user_usd, self.other_usd, '1000')
+        self.assertEqual(response.status_code, 202, response.data)
+
+        call_command('process_transaction_queue', '--drain', stdout=StringIO())
+
+        failed = Transaction.objects.get(pk=response.data['id'])
+        self.assertEqual(failed.status, TransactionStatuses.failed)
+        self.assertEqual(failed.error, "Don't have enough money on stock_from")
+        self.assertStockValue(self.user_usd, '1000')
+
+    def test_unexpected_error(self):
+        first = self.post_transaction(self.user_usd, self.user_rub, '10', TransactionTypes.exchange)
+        second = self.post_transaction(self.user_usd, self.other_usd, '100')
+
+        with mock.patch('exchange.stocks.utils.convert_value', side_effect=RuntimeError('rates are broken')), \
+                self.assertLogs('exchange.stocks.utils', 'ERROR') as logs:
+            call_command('process_transaction_queue', '--drain', stdout=StringIO())
+
+        # failed head is removed from queue and doesn't block next transaction of its stock
+        self.assertIn(f'Queued transaction {first.data["id"]} failed', logs.output[0])
+        self.assertFalse(TransactionQueueItem.objects.exists())
+        failed = Transaction.objects.get(pk=first.data['id'])
+        self.assertEqual(failed.status, TransactionStatuses.failed)
+        self.assertEqual(failed.error, 'Internal error')
+        self.assertEqual(Transaction.objects.get(pk=second.data['id']).status, TransactionStatuses.done)
+        self.assertStockValue(self.user_usd, '895')
+        self.assertStockValue(self.user_rub, '1000')
+
+
+class ReplicaRouterTestCase(SimpleTestCase):
+
+    def setUp(self):
+        settings_override = override_settings(STOCKS_SETTINGS={
+            **settings.STOCKS_SETTINGS,
+            'READ_REPLICAS': ['replica'],
+        })
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.router = routers.PrimaryReplicaRouter()
+
+    def test_routing(self):
+        self.assertEqual(self.router.db_for_read(Stock), 'replica')
+        self.assertEqual(self.router.db_for_write(Stock), 'default')
+        self.assertFalse(self.router.allow_migrate('replica', 'stocks'))
+
+        routers.pin_to_primary()
+        self.addCleanup(routers.unpin)
+        self.assertEqual(self.router.db_for_read(Stock), 'default')
+
+
+class ReplicaPinTestCase(StocksTestCase):
+
+    def setUp(self):
+        super().setUp()
+        # replica isn't allowed in this test case, so any read sent to it fails
+        settings_override = override_settings(STOCKS_SETTINGS={
+            **settings.STOCKS_SETTINGS,
+            'READ_REPLICAS': ['replica'],
+        })
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.addCleanup(cache.clear)
+
+    def test_reads_after_write_are_pinned(self):
+        response = self.post_transaction(self.user_usd, self.other_usd, '100')
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertTrue(routers.is_user_pinned(self.user.pk))
+        self.assertFalse(routers.is_pinned())
+
+        response = self.client.get(f'/stocks/{self.user_usd.pk}/')
+        self.assertEqual(response.data['value'], '895.00')
+
+
+@skipUnless('replica' in settings.DATABASES, 'needs replica alias, run tests with exchange.test_settings')
+class ReplicaReadsTestCase(TransactionTestCase):
+    """Replica alias mirrors test database, data is committed to be seen by its connection"""
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        usd = Currency.objects.create(name='dollar', code='USD')
+        master_usd = Stock.objects.create(user=User.objects.create(username='master'), currency=usd,
+                                          value=to_minor('100000', usd.scale))
+        self.user = User.objects.create(username='user')
+        self.user_usd = Stock.objects.create(user=self.user, currency=usd, value=to_minor('1000', usd.scale))
+        self.other_user = User.objects.create(username='other_user')
+        self.other_usd = Stock.objects.create(user=self.other_user, currency=usd, value=to_minor('0', usd.scale))
+        settings_override = override_settings(STOCKS_SETTINGS={
+            **settings.STOCKS_SETTINGS,
+            'MASTER_STOCKS': {'USD': master_usd.pk},
+            'READ_REPLICAS': ['replica'],
+        })
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.addCleanup(cache.clear)
+
+    def get_history(self, user):
+        """Returns ids of user's transactions and counts of queries to primary and replica"""
+        client = APIClient()
+        client.force_authenticate(user)
+        with CaptureQueriesContext(connections['default']) as primary, \
+                CaptureQueriesContext(connections['replica']) as replica:
+            response = client.get('/transactions/')
+        self.assertEqual(response.status_code, 200)
+        return [item['id'] for item in response.data['results']], len(primary), len(replica)
+
+    def test_read_your_writes(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        response = client.post('/transactions/', {
+            'stock_from': self.user_usd.pk,
+            'stock_to': self.other_usd.pk,
+            'value': '100',
+            'type': TransactionTypes.common,
+        }, format='json')
+        self.assertEqual(response.status_code, 201, response.data)
+        transaction_pk = response.data['id']
+
+        pks, primary_queries, replica_queries = self.get_history(self.user)
+        self.assertIn(transaction_pk, pks)
+        self.assertGreater(primary_queries, 0)
+        self.assertEqual(replica_queries, 0)
+
+        pks, primary_queries, replica_queries = self.get_history(self.other_user)
+        self.assertEqual(pks, [transaction_pk])
+        self.assertEqual(primary_queries, 0)
+        self.assertGreater(replica_queries, 0)
+
+
+class MoneyTestCase(SimpleTestCase):
+
+    def test_conversions(self):
+        self.assertEqual(to_minor('123456.78', 2), 12345678)
+        self.assertEqual(to_major(12345678, 2), Decimal('123456.78'))
+        self.assertEqual(convert(1000, 2, 0, Decimal('65')), 650)
+        with self.assertRaises(ValueError):
+            to_minor('1e20', 2)
+
+    def test_rounding(self):
+        self.assertEqual(multiply(10, 0.05), 0)
+        self.assertEqual(multiply(30, 0.05), 2)
+        with rounding(ROUND_UP):
+            self.assertEqual(multiply(10, 0.05), 1)
+        self.assertEqual(multiply(10, 0.05), 0)
+
+
+class MoneyApiTestCase(StocksTestCase):
+
+    def test_big_amount_is_exact(self):
+        Stock.objects.filter(pk=self.user_usd.pk).update(value=to_minor('1000000', self.usd.scale))
+        response = self.post_transaction(self.user_usd, self.other_usd, '123456.78')
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertEqual(response.data['value'], '123456.78')
+        self.assertStockValue(self.other_usd, '123456.78')
+        # commission 6172.839 is rounded half to even
+        self.assertStockValue(self.user_usd, '870370.38')
+
+    def test_too_many_decimal_places(self):
+        response = self.post_transaction(self.user_usd, self.other_usd, '1.001')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('value', response.data)
+
+
+class MoneyMigrationTestCase(TransactionTestCase):
+    """Reverse of minor units migration, test case doesn't wrap tests in transaction to run migrations"""
+    migrate_from = ('stocks', '0006_transaction_queue')
+    migrate_to = ('stocks', '0007_money_minor_units')
+
+    def migrate(self, target):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate([target])
+        return executor.loader.project_state(target).apps
+
+    def test_reverse(self):
+        self.addCleanup(self.migrate, MigrationExecutor(connection).loader.graph.leaf_nodes('stocks')[0])
+        apps = self.migrate(self.migrate_to)
+        currency_model = apps.get_model('stocks', 'Currency')
+        stock_model = apps.get_model('stocks', 'Stock')
+        transaction_model = apps.get_model('stocks', 'Transaction')
+        accrual_model = apps.get_model('stocks', 'CommissionAccrual')
+
+        user = apps.get_model('auth', 'User').objects.create(username='user')
+        usd = currency_model.objects.create(name='dollar', code='USD', scale=2)
+        btc = currency_model.objects.create(name='bitcoin', code='BTC', scale=5)
+        user_usd = stock_model.objects.create(user_id=user.pk, currency=usd, value=12345)
+        user_btc = stock_model.objects.create(user_id=user.pk, currency=btc, value=12345)
+        usd_transaction = transaction_model.objects.create(type='CMN', stock_from=user_usd, stock_to=user_usd,
+                                                           value=250)
+        btc_deposit = transaction_model.objects.create(type='CMN', stock_to=user_btc, value=250)
+        accrual_model.objects.create(transaction_id=usd_transaction.pk, stock=user_usd, currency=usd, value=5)
+
+        apps = self.migrate(self.migrate_from)
+        stocks = apps.get_model('stocks', 'Stock').objects.in_bulk()
+        transactions = apps.get_model('stocks', 'Transaction').objects.in_bulk()
+        self.assertEqual(stocks[user_usd.pk].value, Decimal('123.45'))
+        self.assertEqual(stocks[user_btc.pk].value, Decimal('0.12345'))
+        self.assertEqual(transactions[usd_transaction.pk].value, Decimal('2.5'))
+        self.assertEqual(transactions[btc_deposit.pk].value, Decimal('0.0025'))
+        self.assertEqual(apps.get_model('stocks', 'CommissionAccrual').objects.get().value, Decimal('0.05'))
+
+
+class StockBalanceTestCase(StocksTestCase):
+
+    def get_balance(self, stock, at):
+        response = self.client.get(f'/stocks/{stock.pk}/balance/', {'at': at.isoformat()})
+        self.assertEqual(response.status_code, 200, response.data)
+        return response.data['value']
+
+    def test_balance_at(self):
+        before_first = timezone.now()
+        self.post_transaction(self.user_usd, self.other_usd, '100', status_code=201)
+        # without snapshots balance is counted back from actual value
+        self.assertEqual(self.get_balance(self.user_usd, before_first), '1000.00')
+
+        call_command('snapshot_balances', stdout=StringIO())
+        self.assertEqual(StockBalanceSnapshot.objects.count(), 5)
+        before_second = timezone.now()
+        self.post_transaction(self.user_usd, self.other_usd, '200', status_code=201)
+        after_second = timezone.now()
+
+        self.assertEqual(self.get_balance(self.user_usd, before_first), '1000.00')
+        self.assertEqual(self.get_balance(self.user_usd, before_second), '895.00')
+        self.assertEqual(self.get_balance(self.user_usd, after_second), '685.00')
+        self.assertEqual(get_balance_at(self.master_usd, after_second), to_minor('100015', self.usd.scale))
+
+        # only changed stocks get new snapshots
+        call_command('snapshot_balances', stdout=StringIO())
+        self.assertEqual(StockBalanceSnapshot.objects.count(), 8)
+        self.assertEqual(self.get_balance(self.user_usd, before_second), '895.00')
+
+    def test_without_snapshots_doesnt_lock(self):
+        self.post_transaction(self.user_usd, self.other_usd, '100', status_code=201)
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(get_balance_at(self.user_usd, timezone.now() - timedelta(hours=1)),
+                             to_minor('1000', self.usd.scale))
+        self.assertFalse([query for query in context.captured_queries if 'FOR UPDATE' in query['sql']])
+
+    def test_accrued_commission(self):
+        with override_settings(STOCKS_SETTINGS={**settings.STOCKS_SETTINGS, 'COMMISSION_MODE': 'accrual'}):
+            call_command('snapshot_balances', stdout=StringIO())
+            self.post_transaction(self.user_usd, self.other_usd, '100', status_code=201)
+            self.assertEqual(self.get_balance(self.user_usd, timezone.now()), '895.00')
+
+    def test_foreign_stock(self):
+        response = self.client.get(f'/stocks/{self.other_usd.pk}/balance/', {'at': timezone.now().isoformat()})
+        self.assertEqual(response.status_code, 404)
+
+
+class ReconciliationTestCase(StocksTestCase):
+
+    def reconcile(self, *args):
+        stdout = StringIO()
+        call_command('reconcile_ledger', *args, stdout=stdout, stderr=StringIO())
+        return [json.loads(line) for line in stdout.getvalue().splitlines()]
+
+    def test_without_baseline(self):
+        # seeded values are not explained by transactions, stocks of range only are reconciled
+        mismatches = self.reconcile('--pk-from', str(self.user_usd.pk), '--pk-to', str(self.other_usd.pk))
+        self.assertEqual({mismatch['stock'] for mismatch in mismatches}, {self.user_usd.pk, self.user_rub.pk})
+        self.assertEqual(ReconciledBalance.objects.count(), 2)
+
+    def test_reconcile(self):
+        self.assertEqual(self.reconcile('--baseline'), [])
+        self.assertEqual(ReconciledBalance.objects.count(), 5)
+
+        transaction_pk = self.post_transaction(self.user_usd, self.other_usd, '100', status_code=201).data['id']
+        self.post_transaction(self.user_usd, self.user_rub, '10', TransactionTypes.exchange, status_code=201)
+        self.client.post(f'/transactions/{transaction_pk}/revoke/')
+        with override_settings(STOCKS_SETTINGS={**settings.STOCKS_SETTINGS, 'COMMISSION_MODE': 'accrual'}):
+            self.post_transaction(self.user_usd, self.other_usd, '20', status_code=201)
+            call_command('settle_commissions', stdout=StringIO())
+        self.assertEqual(self.reconcile(), [])
+
+        Stock.objects.filter(pk=self.user_usd.pk).update(value=F('value') + 1, updated=timezone.now())
+        mismatches = self.reconcile()
+        self.assertEqual(len(mismatches), 1)
+        self.assertEqual(mismatches[0]['stock'], self.user_usd.pk)
+        self.assertEqual(mismatches[0]['difference'], '0.01')
+        with self.assertRaises(CommandError):
+            self.reconcile('--fail-on-mismatch')
+
+
+class RevokeBatchTestCase(StocksTestCase):
+
+    def test_api(self):
+        pks = [self.post_transaction(self.user_usd, self.other_usd, value, status_code=201).data['id']
+               for value in ('100', '200')]
+        exchange_pk = self.post_transaction(self.user_usd, self.user_rub, '10', TransactionTypes.exchange,
+                                            status_code=201).data['id']
+
+        response = self.client.post('/transactions/revoke/', {'transactions': pks}, format='json')
+        self.assertEqual(response.status_code, 403)
+
+        self.user.is_staff = True
+        self.user.save()
+        response = self.client.post('/transactions/revoke/', {
+            'transactions': pks + [exchange_pk], 'atomic': False,
+        }, format='json')
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual([item['status'] for item in response.data['results']], ['ok', 'ok', 'error'])
+
+        # transfers and their commissions are returned
+        self.assertStockValue(self.user_usd, '990')
+        self.assertStockValue(self.other_usd, '0')
+        self.assertStockValue(self.master_usd, '100010')
+        self.assertEqual(Transaction.objects.filter(pk__in=pks, type=TransactionTypes.canceled).count(), 2)
+        self.assertEqual(Transaction.objects.filter(type=TransactionTypes.revoke).count(), 4)
+
+    def test_command_with_accrued_commission(self):
+        with override_settings(STOCKS_SETTINGS={**settings.STOCKS_SETTINGS, 'COMMISSION_MODE': 'accrual'}):
+            self.post_transaction(self.user_usd, self.other_usd, '100', status_code=201)
+            call_command('settle_commissions', stdout=StringIO())
+        self.post_transaction(self.user_usd, self.other_usd, '50', status_code=201)
+
+        stdout = StringIO()
+        call_command('revoke_transactions', '--stock', str(self.user_usd.pk), '--batch-size', '1',
+                     stdout=stdout, stderr=StringIO())
+        results = [json.loads(line) for line in stdout.getvalue().splitlines()]
+        self.assertEqual([item['status'] for item in results], ['ok', 'ok'])
+
+        self.assertStockValue(self.user_usd, '1000')
+        self.assertStockValue(self.other_usd, '0')
+        self.assertStockValue(self.master_usd, '100000')
+
+
+class TransactionArchiveTestCase(StocksTestCase):
+
+    def test_archive(self):
+        for _ in range(6):
+            response = self.post_transaction(self.user_usd, self.other_usd, '10', status_code=201)
+        history = list(Transaction.objects.order_by('-created', '-id').values_list('pk', flat=True))
+        old_pks = history[4:]
+        Transaction.objects.filter(pk__in=old_pks).update(created=F('created') - timedelta(days=800))
+        at_old = timezone.now() - timedelta(days=790)
+
+        stdout = StringIO()
+        call_command('archive_transactions', stdout=stdout)
+        self.assertIn('Archived 8 transactions', stdout.getvalue())
+        self.assertEqual(set(ArchivedTransaction.objects.values_list('pk', flat=True)), set(old_pks))
+
+        response = self.client.get('/transactions/')
+        self.assertEqual([item['id'] for item in response.data['results']], history[:10])
+        response = self.client.get(response.data['next'])
+        self.assertEqual([item['id'] for item in response.data['results']], history[10:])
+        response = self.client.get(response.data['previous'])
+        self.assertEqual([item['id'] for item in response.data['results']], history[:10])
+
+        response = self.client.get(f'/transactions/{min(old_pks)}/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['value'], '10.00')
+
+        response = self.client.get('/transactions/export/')
+        self.assertEqual(len(b''.join(response.streaming_content).decode().splitlines()), 13)
+
+        # 4 transfers with commission are before at_old
+        self.assertEqual(get_balance_at(self.user_usd, at_old), to_minor('958', self.usd.scale))
+
+
+class ResponseCacheTestCase(StocksTestCase):
+
+    def test_stocks(self):
+        response = self.client.get('/stocks/')
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+
+        with self.assertNumQueries(0):
+            response = self.client.get('/stocks/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        with self.assertNumQueries(0):
+            response = self.client.get('/stocks/')
+        self.assertEqual(response['ETag'], etag)
+
+        self.post_transaction(self.user_usd, self.other_usd, '100')
+        self.run_commit_hooks()
+
+        response = self.client.get('/stocks/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        values = {item['id']: item['value'] for item in response.data['results']}
+        self.assertEqual(values[self.user_usd.pk], '895.00')
+
+    def test_currencies(self):
+        etag = self.client.get('/currencies/')['ETag']
+        self.assertEqual(self.client.get('/currencies/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        Currency.objects.create(name='euro', code='EUR')
+        self.run_commit_hooks()
+        response = self.client.get('/currencies/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), 3)
+
+    def test_miss_read_from_primary(self):
+        pinned = []
+
+        def db_for_read(router, model, **hints):
+            pinned.append(routers.is_pinned())
+            return 'default'
+
+        with override_settings(STOCKS_SETTINGS={**settings.STOCKS_SETTINGS, 'READ_REPLICAS': ['replica']}), \
+                mock.patch.object(routers.PrimaryReplicaRouter, 'db_for_read', db_for_read):
+            self.assertEqual(self.client.get('/stocks/').status_code, 200)
+            self.assertTrue(pinned)
+            self.assertTrue(all(pinned))
+            self.assertFalse(routers.is_pinned())
+
+            # hit doesn't read anything
+            pinned.clear()
+            self.assertEqual(self.client.get('/stocks/').status_code, 200)
+            self.assertEqual(pinned, [])
+
+
+class PostgresEventsTestCase(SimpleTestCase):
+
+    def test_split_payloads(self):
+        messages = [(user_id, {'type': 'balance', 'value': 'x' * 100}) for user_id in range(50)]
+        payloads = list(split_payloads(messages, max_size=1000))
+        self.assertGreater(len(payloads), 1)
+        self.assertTrue(all(len(payload) <= 1000 for payload in payloads))
+        self.assertEqual([message for payload in payloads for message in json.loads(payload)],
+                         [[user_id, event] for user_id, event in messages])
+
+        with self.assertLogs('exchange.stocks.events', 'ERROR') as logs:
+            self.assertEqual(list(split_payloads(messages[:1], max_size=50)), [])
+        self.assertEqual(logs.records[0].getMessage(), 'Stock event of user 0 is too large to be published')
+        self.assertEqual(list(split_payloads([])), [])
+
+    def test_listen_reconnects(self):
+        class StopListening(BaseException):
+            pass
+
+        backend = PostgresBackend()
+        errors = [OperationalError('closed'), StopListening()]
+        with mock.patch.object(backend, '_listen', side_effect=errors) as listen, \
+                mock.patch('exchange.stocks.events.time.sleep') as sleep, \
+                self.assertLogs('exchange.stocks.events', 'ERROR'):
+            with self.assertRaises(StopListening):
+                backend.listen()
+        self.assertEqual(listen.call_count, 2)
+        sleep.assert_called_once_with(settings.STOCKS_SETTINGS['EVENTS']['RECONNECT_DELAY'])
+
+
+class EventsTestCase(StocksTestCase):
+
+    def setUp(self):
+        super().setUp()
+        settings_override = override_settings(STOCKS_SETTINGS={
+            **settings.STOCKS_SETTINGS,
+            'EVENTS': {**settings.STOCKS_SETTINGS['EVENTS'], 'ENABLED': True},
+        })
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def test_publish(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+
+        async def subscribe():
+            return broker.subscribe(self.other_user.pk)
+        subscription = loop.run_until_complete(subscribe())
+        self.addCleanup(broker.unsubscribe, subscription)
+
+        self.post_transaction(self.user_usd, self.other_usd, '100')
+        self.assertTrue(subscription.queue.empty())
+        self.run_commit_hooks()
+        # events are put to queue by event loop of subscriber
+        loop.run_until_complete(asyncio.sleep(0))
+
+        events = [subscription.queue.get_nowait() for _ in range(subscription.queue.qsize())]
+        self.assertEqual([event['type'] for event in events], ['balance', 'transaction'])
+        self.assertEqual(events[0]['stock'], self.other_usd.pk)
+        self.assertEqual(events[0]['value'], '100.00')
+        self.assertEqual(events[1]['value'], '100.00')
+
+    def stream(self, headers):
+        messages = []
+
+        async def run():
+            requested = asyncio.Event()
+            received = asyncio.Event()
+
+            async def receive():
+                if not requested.is_set():
+                    requested.set()
+                    return {'type': 'http.request', 'body': b''}
+                await received.wait()
+                return {'type': 'http.disconnect'}
+
+            async def send(message):
+                messages.append(message)
+                if b'event: ' in message.get('body', b''):
+                    received.set()
+
+            scope = {'type': 'http', 'method': 'GET', 'path': '/events/', 'headers': headers}
+            task = asyncio.ensure_future(events_application(scope, receive, send))
+            while not task.done() and not broker.has_subscribers(self.user.pk):
+                await asyncio.sleep(0)
+            broker.dispatch(self.user.pk, {'type': 'balance', 'stock': self.user_usd.pk})
+            await task
+
+        async_to_sync(run)()
+        return messages
+
+    def test_stream(self):
+        self.client.force_login(self.user)
+        session_key = self.client.cookies[settings.SESSION_COOKIE_NAME].value
+        messages = self.stream([(b'cookie', f'{settings.SESSION_COOKIE_NAME}={session_key}'.encode())])
+        self.assertEqual(messages[0]['status'], 200)
+        self.assertIn((b'content-type', b'text/event-stream'), messages[0]['headers'])
+        self.assertEqual(
+            messages[1]['body'],
+            f'event: balance\ndata: {{"type": "balance", "stock": {self.user_usd.pk}}}\n\n'.encode(),
+        )
+        self.assertFalse(broker.has_subscribers(self.user.pk))
+
+    def test_stream_unauthenticated(self):
+        messages = self.stream([])
+        self.assertEqual(messages[0]['status'], 401)
+
+
+class ExchangeMatchingTestCase(StocksTestCase):
+
+    def setUp(self):
+        super().setUp()
+        settings_override = override_settings(STOCKS_SETTINGS={
+            **settings.STOCKS_SETTINGS,
+            'EXCHANGE_MATCHING': {**settings.STOCKS_SETTINGS['EXCHANGE_MATCHING'], 'ENABLED': True},
+        })
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.other_rub = Stock.objects.create(user=self.other_user, currency=self.rub,
+                                              value=to_minor('1300', self.rub.scale))
+
+    def test_netted(self):
+        # master stock covers only residual of opposite exchanges
+        Stock.objects.filter(pk=self.master_usd.pk).update(value=to_minor('10', self.usd.scale))
+        other_client = APIClient()
+        other_client.force_authenticate(self.other_user)
+        self.post_transaction(self.user_usd, self.user_rub, '10', TransactionTypes.exchange, status_code=202)
+        self.post_transaction(self.other_rub, self.other_usd, '1300', TransactionTypes.exchange, client=other_client,
+                              status_code=202)
+        # waits for the first exchange of the same stocks
+        failed_pk = self.post_transaction(self.user_rub, self.user_usd, '2000', TransactionTypes.exchange,
+                                          status_code=202).data['id']
+
+        self.assertIsNone(UserTransactionService.process_queued())
+        out = StringIO()
+        call_command('match_exchanges', '--window', '0', '--drain', stdout=out)
+
+        self.assertFalse(TransactionQueueItem.objects.exists())
+        self.assertEqual(Transaction.objects.filter(type=TransactionTypes.exchange,
+                                                    status=TransactionStatuses.done).count(), 4)
+        self.assertStockValue(self.user_usd, '990')
+        self.assertStockValue(self.user_rub, '1650')
+        self.assertStockValue(self.other_rub, '0')
+        self.assertStockValue(self.other_usd, '20')
+        self.assertStockValue(self.master_usd, '0')
+        self.assertStockValue(self.master_rub, '100650')
+        failed = Transaction.objects.get(pk=failed_pk)
+        self.assertEqual(failed.status, TransactionStatuses.failed)
+        self.assertEqual(failed.stock_to_id, self.user_usd.pk)
+        self.assertIn(f'Transaction {failed_pk} failed', out.getvalue())
+
+
+class ValuationTestCase(StocksTestCase):
+
+    def get_valuation(self, currency):
+        response = self.client.get('/stocks/valuation/', {'currency': currency})
+        self.assertEqual(response.status_code, 200, response.data)
+        return response.data
+
+    def test_valuation(self):
+        valuation = self.get_valuation('USD')
+        self.assertEqual(valuation['value'], '1015.38')
+        self.assertEqual(valuation['holdings'], [
+            {'currency': 'USD', 'amount': '1000.00', 'value': '1000.00'},
+            {'currency': 'RUB', 'amount': '1000.00', 'value': '15.38'},
+        ])
+        self.assertEqual(self.get_valuation('RUB')['value'], '66000.00')
+
+        # cached until user's next transaction
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get_valuation('RUB')['value'], '66000.00')
+        self.post_transaction(self.user_usd, self.other_usd, '100')
+        self.run_commit_hooks()
+        self.assertEqual(self.get_valuation('RUB')['value'], '59175.00')
+
+    def test_missing_rate(self):
+        gbp = Currency.objects.create(name='pound', code='GBP')
+        Stock.objects.create(user=self.user, currency=gbp, value=1)
+        response = self.client.get('/stocks/valuation/', {'currency': 'USD'})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('currency', response.data)
+
+    def test_all_users(self):
+        out = StringIO()
+        err = StringIO()
+        call_command('value_portfolios', 'RUB', stdout=out, stderr=err)
+        valuations = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual([(item['user'], item['value']) for item in valuations],
+                         [(self.user.pk, '66000.00'), (self.other_user.pk, '0.00')])
+        self.assertIn('Valued 2 users, total 66000.00 RUB', err.getvalue())
+
+
+class StockProvisioningTestCase(StocksTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.eur = Currency.objects.create(name='euro', code='EUR')
+
+    def test_bulk_api(self):
+        response = self.client.post('/stocks/bulk/', {'currencies': ['USD', 'EUR', 'EUR']}, format='json')
+        self.assertEqual(response.status_code, 201, response.data)
+        stocks = {item['currency']: item for item in response.data['results']}
+        self.assertEqual(len(response.data['results']), 2)
+        self.assertEqual(stocks['USD']['id'], self.user_usd.pk)
+        self.assertEqual(stocks['USD']['value'], '1000.00')
+        self.assertEqual(stocks['EUR']['value'], '0.00')
+
+        response = self.client.post('/stocks/bulk/', {'currencies': ['GBP']}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_backfill(self):
+        out = StringIO()
+        call_command('provision_currency', 'EUR', '--batch-size', '2', stdout=out, stderr=StringIO())
+        self.assertIn('Processed 3 users, created 3 stocks of EUR', out.getvalue())
+        self.assertEqual(set(Stock.objects.filter(currency=self.eur).values_list('user_id', flat=True)),
+                         set(User.objects.values_list('pk', flat=True)))
+
+        call_command('provision_currency', 'EUR', stdout=out, stderr=StringIO())
+        self.assertIn('Processed 3 users, created 0 stocks of EUR', out.getvalue())
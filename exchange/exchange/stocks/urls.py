@@ -14,5 +14,6 @@ router.register(r'currencies', views.CurrencyViewSet)
 router.register(r'transactions', views.TransactionViewSet)
 
 urlpatterns = [
+    path('metrics/', views.metrics_view, name='metrics'),
     path('', include(router.urls)),
 ]
@@ -3,54 +3,178 @@
 :Authors: norlyakov
 :Date: 23.12.2019
 """
-from decimal import Decimal, getcontext
+import logging
 
 from django.conf import settings
 from django.core.exceptions import ValidationError as CoreValidationError
-from django.db import transaction
-from django.db.models import F
+from django.db import transaction, connection, OperationalError
+from django.db.models import F, Sum, Q, OuterRef, Exists
+from django.utils import timezone
 from rest_framework import serializers
 
-from .errors import TransactionCantBeRevoked, TransactionAlreadyExecuted
-from .models import TransactionTypes, Transaction, Stock
+from . import metrics, money
+from .caching import bump_version, bump_stocks_versions, get_stocks_scope
+from .events import publish_changes
+from .errors import TransactionCantBeRevoked, TransactionAlreadyExecuted, ExchangeRateError
+from .locking import lock_stocks, retry_on_conflict
+from .models import (
+    TransactionTypes, TransactionStatuses, Transaction, TransactionQueueItem, Stock, CommissionAccrual,
+)
+from .rates import rates_cache
+from .registry import master_stocks, currencies, get_master_stock_pks
+
+logger = logging.getLogger(__name__)
+
+COMMISSION_MODE_IMMEDIATE = 'immediate'
+COMMISSION_MODE_ACCRUAL = 'accrual'
+
+
+def get_commission_value(tr_value):
+    return money.multiply(tr_value, settings.STOCKS_SETTINGS['COMMISSION'])
+
+
+def convert_value(tr_value, currency_from_id, currency_to_id):
+    currency_from = currencies.get(currency_from_id)
+    currency_to = currencies.get(currency_to_id)
+    try:
+        rate = get_exchange_rate(currency_from, currency_to)
+    except ExchangeRateError as e:
+        raise serializers.ValidationError(str(e))
+    return money.convert(tr_value, currency_from.scale, currency_to.scale, rate)
+
+
+def get_minor_value(value, currency_id):
+    """Converts amount given by user in major units, it can't have more decimal places than currency has"""
+    scale = currencies.get(currency_id).scale
+    if not money.fits_scale(value, scale):
+        raise serializers.ValidationError({'value': [f'Ensure that there are no more than {scale} decimal places.']})
+    try:
+        return money.to_minor(value, scale)
+    except ValueError as e:
+        raise serializers.ValidationError({'value': [str(e)]})
+
+
+def is_commission_accrued():
+    return settings.STOCKS_SETTINGS['COMMISSION_MODE'] == COMMISSION_MODE_ACCRUAL
+
+
+def is_async_transactions():
+    return settings.STOCKS_SETTINGS['ASYNC_TRANSACTIONS']
+
+
+def is_exchange_matching():
+    return settings.STOCKS_SETTINGS['EXCHANGE_MATCHING']['ENABLED']
+
+
+def format_errors(detail):
+    messages = detail if isinstance(detail, list) else [detail]
+    return '; '.join(str(message) for message in messages)[:255]
+
+
+def get_revocable_transactions(date_from=None, date_to=None, stock_pk=None):
+    """Done common transactions filtered like export, to be revoked in bulk"""
+    queryset = Transaction.objects.filter(type=TransactionTypes.common, status=TransactionStatuses.done)
+    if stock_pk is not None:
+        queryset = queryset.filter(Q(stock_from=stock_pk) | Q(stock_to=stock_pk))
+    if date_from is not None:
+        queryset = queryset.filter(created__gte=date_from)
+    if date_to is not None:
+        queryset = queryset.filter(created__lt=date_to)
+    return queryset
+
+
+def bulk_create_with_pks(model, objs):
+    """bulk_create() sets pks only on backends which can return them from insert"""
+    if connection.features.can_return_rows_from_bulk_insert:
+        return model.objects.bulk_create(objs)
+    for obj in objs:
+        obj.save(force_insert=True)
+    return objs
 
 
 class UserTransactionService:
 
     @staticmethod
-    def _get_master_stock(currency):
-        master_stock_pk = settings.STOCKS_SETTINGS['MASTER_STOCKS'].get(currency.code)
-        if not master_stock_pk:
-            raise RuntimeError(f"Didn't find master stock for currency {currency.code}")
-        master_stock = Stock.objects.get(pk=master_stock_pk)
-        if master_stock.currency != currency:
-            raise RuntimeError(f'Master stock for {currency.code} has another currency - {master_stock.currency.code}')
-        return master_stock
+    def get_master_balance(currency):
+        """Aggregated balance of all master sub-stocks of currency"""
+        master_stock_pks = master_stocks.get_pks(currency.pk)
+        result = Stock.objects.filter(pk__in=master_stock_pks).aggregate(total=Sum('value'))
+        return result['total'] or 0
 
     @staticmethod
-    def execute_and_save(transaction_model):
-        with transaction.atomic():
-            if transaction_model.created:
+    @metrics.instrumented('execute_and_save')
+    def execute_and_save(transaction_model, locked_stocks=None):
+        """
+        Moves money between stocks of transaction and saves it.
+        Caller should lock all stocks of operation at once with lock_stocks() and pass them here,
+        otherwise stocks of this transaction are locked. Stocks which are not in passed locked_stocks
+        are updated by id with F() expressions, it is used for master stocks.
+        """
+        # nothing is written before checks, so savepoint isn't needed
+        with transaction.atomic(savepoint=False):
+            if transaction_model.created and transaction_model.status != TransactionStatuses.pending:
                 raise TransactionAlreadyExecuted()
 
-            if transaction_model.stock_from:
-                # lock stock for transaction
-                Stock.objects.filter(pk=transaction_model.stock_from.id).select_for_update()
-                transaction_model.stock_from.refresh_from_db()
-                transaction_model.stock_from.value -= transaction_model.value
-                transaction_model.stock_from.clean_fields()  # check that stock's value not negative
-                transaction_model.stock_from.save()
+            if locked_stocks is None:
+                locked_stocks = lock_stocks(
+                    pk for pk in (transaction_model.stock_from_id, transaction_model.stock_to_id) if pk
+                )
+
+            if transaction_model.stock_from_id in locked_stocks:
+                stock_from = locked_stocks[transaction_model.stock_from_id]
+                UserTransactionService._debit_locked_stock(stock_from, transaction_model.value)
+                transaction_model.stock_from = stock_from
+            elif transaction_model.stock_from_id:
+                # not locked (master) stock is checked and updated by single query
+                updated = Stock.objects.filter(
+                    pk=transaction_model.stock_from_id,
+                    value__gte=transaction_model.value,
+                ).update(value=F('value') - transaction_model.value, updated=timezone.now())
+                if not updated:
+                    raise CoreValidationError('Not enough money on stock')
+                bump_stocks_versions([transaction_model.stock_from_id])
 
-            if transaction_model.stock_to:
-                transaction_model.stock_to.value = F('value') + transaction_model.value
-                transaction_model.stock_to.save()
+            if transaction_model.stock_to_id in locked_stocks:
+                stock_to = locked_stocks[transaction_model.stock_to_id]
+                stock_to.value += transaction_model.value
+                stock_to.save(update_fields=['value', 'updated'])
+                transaction_model.stock_to = stock_to
+            elif transaction_model.stock_to_id:
+                Stock.objects.filter(pk=transaction_model.stock_to_id).update(
+                    value=F('value') + transaction_model.value, updated=timezone.now(),
+                )
+                bump_stocks_versions([transaction_model.stock_to_id])
 
+            if transaction_model.status == TransactionStatuses.pending:
+                # queued transaction changes balances now, balance snapshots rely on it
+                transaction_model.created = timezone.now()
+            transaction_model.status = TransactionStatuses.done
             transaction_model.save()
+            publish_changes(transaction_model, [locked_stocks.get(transaction_model.stock_from_id),
+                                                locked_stocks.get(transaction_model.stock_to_id)])
+
+    @staticmethod
+    def _debit_locked_stock(stock, value):
+        new_value = stock.value - value
+        if new_value < 0:
+            raise CoreValidationError('Not enough money on stock')
+        stock.value = new_value
+        stock.save(update_fields=['value', 'updated'])
 
     @classmethod
-    def make_transaction(cls, validated_data):
-        tr_type = validated_data['type']
-        tr_value = validated_data['value']
+    def _accrue_commission(cls, orig_transaction, commission_value, locked_stocks):
+        """Takes commission from user's stock, master stock gets it later by settle_commissions()"""
+        stock_from = locked_stocks[orig_transaction.stock_from_id]
+        cls._debit_locked_stock(stock_from, commission_value)
+        CommissionAccrual.objects.create(
+            transaction=orig_transaction,
+            stock=stock_from,
+            currency_id=stock_from.currency_id,
+            value=commission_value,
+        )
+
+    @staticmethod
+    def _check_request(validated_data):
         stock_from = validated_data.get('stock_from')
         stock_to = validated_data.get('stock_to')
 
@@ -60,114 +184,600 @@ class UserTransactionService:
         if stock_from == stock_to:
             raise serializers.ValidationError('Need different stocks')
 
-        make_method = getattr(cls, tr_type.name, None)
+    @staticmethod
+    def _check_stocks(tr_type, stock_from, stock_to):
+        if tr_type == TransactionTypes.common:
+            if stock_from.currency_id != stock_to.currency_id:
+                raise serializers.ValidationError('Stocks must have same currency')
+        elif tr_type == TransactionTypes.exchange:
+            if stock_from.user_id != stock_to.user_id:
+                raise serializers.ValidationError('Stocks must belong to same user')
+            if stock_from.currency_id == stock_to.currency_id:
+                raise serializers.ValidationError('Stocks must have different currency')
+        else:
+            raise ValueError('Unknown transaction type')
+
+    @classmethod
+    def make_transaction(cls, validated_data):
+        cls._check_request(validated_data)
+        make_method = getattr(cls, validated_data['type'].name, None)
         if not make_method:
             raise ValueError('Unknown transaction type')
 
-        return make_method(tr_value, stock_from, stock_to)
+        return make_method(validated_data['value'], validated_data['stock_from'], validated_data['stock_to'])
+
+    @classmethod
+    def enqueue_transaction(cls, validated_data):
+        """Saves pending transaction, it is executed later by process_queued() in queue worker"""
+        cls._check_request(validated_data)
+        stock_from = validated_data['stock_from']
+        stock_to = validated_data['stock_to']
+        cls._check_stocks(validated_data['type'], stock_from, stock_to)
+
+        with transaction.atomic():
+            pending_transaction = Transaction.objects.create(
+                type=validated_data['type'],
+                value=validated_data['value'],
+                stock_from=stock_from,
+                stock_to=stock_to,
+                status=TransactionStatuses.pending,
+            )
+            TransactionQueueItem.objects.create(
+                transaction=pending_transaction,
+                stock_from=stock_from,
+                stock_to=stock_to,
+            )
+        return pending_transaction
+
+    @staticmethod
+    def get_queue_heads():
+        """Queued items which stocks are not used by earlier queued items"""
+        earlier_items = TransactionQueueItem.objects.filter(pk__lt=OuterRef('pk')).filter(
+            Q(stock_from=OuterRef('stock_from')) | Q(stock_from=OuterRef('stock_to')) |
+            Q(stock_to=OuterRef('stock_from')) | Q(stock_to=OuterRef('stock_to'))
+        )
+        return TransactionQueueItem.objects.annotate(blocked=Exists(earlier_items)).filter(blocked=False)
+
+    @classmethod
+    @metrics.instrumented('process_queued')
+    @retry_on_conflict
+    def process_queued(cls):
+        """
+        Executes the oldest queue head, so transactions of the same stock are applied in order
+        and others can go in parallel. Heads taken by other workers are skipped, their successors
+        are not heads until they are done. Exchanges are left to match_exchanges() when matching is on.
+        Unexpected errors fail transaction too, otherwise it would stay head and block its stocks forever.
+        Returns executed or failed transaction, None if there is nothing to do now.
+        """
+        heads = cls.get_queue_heads()
+        if is_exchange_matching():
+            heads = heads.exclude(transaction__type=TransactionTypes.exchange)
+        item = heads.select_related(
+            'transaction', 'stock_from', 'stock_to',
+        ).order_by('pk').select_for_update(skip_locked=True, of=('self',)).first()
+        if item is None:
+            return None
+
+        pending_transaction = item.transaction
+        make_method = getattr(cls, TransactionTypes(pending_transaction.type).name)
+        error = None
+        try:
+            make_method(pending_transaction.value, item.stock_from, item.stock_to, pending_transaction)
+        except serializers.ValidationError as e:
+            error = format_errors(e.detail)
+        except OperationalError:
+            # conflicts are retried, lost connection isn't a fault of transaction
+            raise
+        except Exception:
+            # details are not shown to users
+            logger.exception('Queued transaction %s failed', pending_transaction.pk)
+            error = 'Internal error'
+        if error is not None:
+            pending_transaction.status = TransactionStatuses.failed
+            pending_transaction.error = error
+            pending_transaction.save(update_fields=['status', 'error', 'updated'])
+
+        item.delete()
+        return pending_transaction
 
     @classmethod
-    def common(cls, tr_value, stock_from, stock_to):
-        if stock_from.currency_id != stock_to.currency_id:
-            raise serializers.ValidationError('Stocks must have same currency')
+    def _plan_matched_exchange(cls, item):
+        """Legs of queued exchange through primary master stocks, first one is its pending transaction"""
+        cls._check_stocks(TransactionTypes.exchange, item.stock_from, item.stock_to)
+        from_transaction = item.transaction
+        to_transaction = Transaction(
+            type=TransactionTypes.exchange,
+            value=convert_value(from_transaction.value, item.stock_from.currency_id, item.stock_to.currency_id),
+            stock_from_id=master_stocks.get_pk(item.stock_to.currency_id),
+            stock_to=item.stock_to,
+        )
+        from_transaction.stock_to_id = master_stocks.get_pk(item.stock_from.currency_id)
+        return [from_transaction, to_transaction]
 
+    @classmethod
+    @metrics.instrumented('match_exchanges')
+    @retry_on_conflict
+    def match_exchanges(cls, limit=None):
+        """
+        Executes up to limit queued exchanges together at current rates. Opposite flows are netted:
+        each master stock is written once with residual of the batch, it needs money only for
+        exchanges not covered by earlier ones. Exchanges are taken from queue heads like
+        process_queued() does. Returns list of executed or failed transactions.
+        """
+        limit = limit or settings.STOCKS_SETTINGS['EXCHANGE_MATCHING']['MAX_ORDERS']
         with transaction.atomic():
+            items = list(cls.get_queue_heads().filter(
+                transaction__type=TransactionTypes.exchange,
+            ).select_related(
+                'transaction', 'stock_from', 'stock_to',
+            ).order_by('pk').select_for_update(skip_locked=True, of=('self',))[:limit])
+            if not items:
+                return []
+
+            plans = []
+            for item in items:
+                try:
+                    plans.append((cls._plan_matched_exchange(item), None))
+                except serializers.ValidationError as e:
+                    plans.append(([], e.detail))
+
+            locked_stocks = lock_stocks({
+                pk for legs, _ in plans for leg in legs for pk in (leg.stock_from_id, leg.stock_to_id)
+            })
+            balances = {pk: stock.value for pk, stock in locked_stocks.items()}
+
+            now = timezone.now()
+            to_transactions = []
+            for item, (legs, error) in zip(items, plans):
+                pending_transaction = item.transaction
+                if error is None:
+                    error = cls._apply_batch_legs(legs, locked_stocks, balances)
+                if error is None:
+                    # queued transaction changes balances now, balance snapshots rely on it
+                    pending_transaction.created = now
+                    pending_transaction.status = TransactionStatuses.done
+                    to_transactions.append(legs[1])
+                else:
+                    pending_transaction.stock_to_id = item.stock_to_id
+                    pending_transaction.status = TransactionStatuses.failed
+                    pending_transaction.error = format_errors(error)
+                pending_transaction.updated = now
+
+            cls._save_balances(locked_stocks, balances)
+            bulk_create_with_pks(Transaction, to_transactions)
+            Transaction.objects.bulk_update(
+                [item.transaction for item in items], ['created', 'updated', 'stock_to', 'status', 'error'],
+            )
+            TransactionQueueItem.objects.filter(pk__in=[item.pk for item in items]).delete()
+
+        return [item.transaction for item in items]
+
+    @classmethod
+    @metrics.instrumented('common')
+    @retry_on_conflict
+    def common(cls, tr_value, stock_from, stock_to, orig_transaction=None):
+        """orig_transaction is pending transaction of the same request, when it is made from queue"""
+        cls._check_stocks(TransactionTypes.common, stock_from, stock_to)
+
+        with transaction.atomic():
+            # master stock is not locked, commission is added to it by update after users' stocks are locked
+            locked_stocks = lock_stocks([stock_from.pk, stock_to.pk])
             try:
-                orig_transaction = Transaction(
-                    type=TransactionTypes.common,
-                    value=tr_value,
-                    stock_from=stock_from,
-                    stock_to=stock_to,
-                )
-                cls.execute_and_save(orig_transaction)
-
-                getcontext().prec = 5
-                commission = settings.STOCKS_SETTINGS['COMMISSION']
-                commission_value = Decimal(commission) * tr_value
-                master_stock = cls._get_master_stock(stock_from.currency)
-                commission_transaction = Transaction(
-                    type=TransactionTypes.commission,
-                    value=commission_value,
-                    stock_from=stock_from,
-                    stock_to=master_stock,
-                )
-                cls.execute_and_save(commission_transaction)
+                if orig_transaction is None:
+                    orig_transaction = Transaction(
+                        type=TransactionTypes.common,
+                        value=tr_value,
+                        stock_from=stock_from,
+                        stock_to=stock_to,
+                    )
+                cls.execute_and_save(orig_transaction, locked_stocks)
+
+                commission_value = get_commission_value(tr_value)
+                if is_commission_accrued():
+                    cls._accrue_commission(orig_transaction, commission_value, locked_stocks)
+                else:
+                    commission_transaction = Transaction(
+                        type=TransactionTypes.commission,
+                        value=commission_value,
+                        stock_from=stock_from,
+                        stock_to_id=master_stocks.get_pk(stock_from.currency_id, shard_key=stock_from.user_id),
+                        related_transaction=orig_transaction,
+                    )
+                    cls.execute_and_save(commission_transaction, locked_stocks)
             except CoreValidationError:
                 raise serializers.ValidationError("Don't have enough money on stock_from")
 
         return orig_transaction
 
     @classmethod
-    def exchange(cls, tr_value, stock_from, stock_to):
-        if stock_from.user_id != stock_to.user_id:
-            raise serializers.ValidationError('Stocks must belong to same user')
-
-        if stock_from.currency_id == stock_to.currency_id:
-            raise serializers.ValidationError('Stocks must have different currency')
+    @metrics.instrumented('exchange')
+    @retry_on_conflict
+    def exchange(cls, tr_value, stock_from, stock_to, from_transaction=None):
+        """from_transaction is pending transaction of the same request, when it is made from queue"""
+        cls._check_stocks(TransactionTypes.exchange, stock_from, stock_to)
 
+        # only crediting leg is sharded, shards are emptied by consolidation, so payout is made by primary one
+        master_stock_to_pk = master_stocks.get_pk(stock_from.currency_id, shard_key=stock_from.user_id)
+        master_stock_from_pk = master_stocks.get_pk(stock_to.currency_id)
         with transaction.atomic():
+            # both master stocks are locked by the same query to keep lock order between them
+            locked_stocks = lock_stocks([stock_from.pk, stock_to.pk, master_stock_to_pk, master_stock_from_pk])
             try:
-                master_stock_to = cls._get_master_stock(stock_from.currency)
-                from_transaction = Transaction(
-                    type=TransactionTypes.exchange,
-                    value=tr_value,
-                    stock_from=stock_from,
-                    stock_to=master_stock_to,
-                )
-                cls.execute_and_save(from_transaction)
+                if from_transaction is None:
+                    from_transaction = Transaction(
+                        type=TransactionTypes.exchange,
+                        value=tr_value,
+                        stock_from=stock_from,
+                    )
+                from_transaction.stock_to_id = master_stock_to_pk
+                cls.execute_and_save(from_transaction, locked_stocks)
             except CoreValidationError:
                 raise serializers.ValidationError("Don't have enough money on stock_from")
 
             try:
-                getcontext().prec = 5
-                rate = get_exchange_rate(stock_from.currency, stock_to.currency)
-                converted_value = tr_value * Decimal(rate)
-                master_stock_from = cls._get_master_stock(stock_to.currency)
-
+                converted_value = convert_value(tr_value, stock_from.currency_id, stock_to.currency_id)
                 to_transaction = Transaction(
                     type=TransactionTypes.exchange,
                     value=converted_value,
-                    stock_from=master_stock_from,
+                    stock_from_id=master_stock_from_pk,
                     stock_to=stock_to,
                 )
-                cls.execute_and_save(to_transaction)
+                cls.execute_and_save(to_transaction, locked_stocks)
             except CoreValidationError:
                 raise serializers.ValidationError("Don't have enough money on master stock")
 
         return from_transaction
 
     @classmethod
+    @metrics.instrumented('revoke')
     def revoke(cls, orig_transaction):
-        with transaction.atomic():
-            Transaction.objects.filter(pk=orig_transaction.pk).select_for_update()
-            orig_transaction.refresh_from_db()
+        [(legs, error)] = cls.revoke_batch([orig_transaction.pk], atomic=False)
+        if error is not None:
+            raise TransactionCantBeRevoked(error[0])
+        return legs[0]
 
-            if not (orig_transaction.type == TransactionTypes.common and
-                    orig_transaction.stock_from and orig_transaction.stock_to and orig_transaction.pk):
-                raise TransactionCantBeRevoked('Only common transactions can be revoked')
-
-            orig_transaction.type = TransactionTypes.canceled
-            orig_transaction.save()
+    @staticmethod
+    def _check_revocable(orig_transaction):
+        if not (orig_transaction.type == TransactionTypes.common and
+                orig_transaction.status == TransactionStatuses.done and
+                orig_transaction.stock_from_id and orig_transaction.stock_to_id):
+            raise TransactionCantBeRevoked('Only common transactions can be revoked')
 
-            revoke_transaction = Transaction(
+    @staticmethod
+    def _plan_revoke(orig_transaction, commission_transaction, accrual):
+        """
+        Unsaved revoke transactions (legs) of original and its commission, first leg is revoke of original.
+        Commissions are returned from primary master stock: immediate ones could be paid to shard,
+        which is emptied by consolidation, and journaled ones get there by settlement.
+        """
+        legs = [Transaction(
+            type=TransactionTypes.revoke,
+            value=orig_transaction.value,
+            stock_from_id=orig_transaction.stock_to_id,
+            stock_to_id=orig_transaction.stock_from_id,
+            related_transaction=orig_transaction,
+        )]
+        if commission_transaction is not None:
+            legs.append(Transaction(
+                type=TransactionTypes.revoke,
+                value=commission_transaction.value,
+                stock_from_id=(master_stocks.get_primary_pk(commission_transaction.stock_to_id) or
+                               commission_transaction.stock_to_id),
+                stock_to_id=orig_transaction.stock_from_id,
+                related_transaction=commission_transaction,
+            ))
+        if accrual is not None:
+            legs.append(Transaction(
                 type=TransactionTypes.revoke,
-                value=orig_transaction.value,
-                stock_from=orig_transaction.stock_to,
-                stock_to=orig_transaction.stock_from,
+                value=accrual.value,
+                stock_from_id=master_stocks.get_pk(accrual.currency_id),
+                stock_to_id=accrual.stock_id,
                 related_transaction=orig_transaction,
+            ))
+        return legs
+
+    @classmethod
+    @metrics.instrumented('revoke_batch')
+    @retry_on_conflict
+    def revoke_batch(cls, transaction_pks, atomic=True):
+        """
+        Revokes many common transactions with their commissions at once. Originals are locked in pk order,
+        then all affected stocks by single query, balances are changed in aggregate
+        and revoke transactions are inserted in bulk.
+        With atomic=False failed items are skipped, otherwise whole batch is rejected.
+        Returns list of (legs, error) pairs in the same order as pks, first leg is revoke of original.
+        """
+        with transaction.atomic():
+            with metrics.timer(metrics.lock_seconds, 'transaction'):
+                originals = {
+                    orig_transaction.pk: orig_transaction
+                    for orig_transaction in Transaction.objects.filter(
+                        pk__in=transaction_pks,
+                    ).order_by('pk').select_for_update()
+                }
+            # commissions of transactions made before they were linked can't be found and are kept
+            commissions = {
+                commission_transaction.related_transaction_id: commission_transaction
+                for commission_transaction in Transaction.objects.filter(
+                    related_transaction__in=originals, type=TransactionTypes.commission,
+                    status=TransactionStatuses.done,
+                )
+            }
+            accruals = {accrual.transaction_id: accrual
+                        for accrual in CommissionAccrual.objects.filter(transaction__in=originals)}
+
+            plans = []
+            revoked_pks = set()
+            for pk in transaction_pks:
+                orig_transaction = originals.get(pk)
+                try:
+                    if orig_transaction is None:
+                        raise TransactionCantBeRevoked('Transaction does not exist')
+                    if pk in revoked_pks:
+                        raise TransactionCantBeRevoked('Transaction is revoked already')
+                    cls._check_revocable(orig_transaction)
+                except TransactionCantBeRevoked as e:
+                    plans.append(([], [str(e)]))
+                    continue
+                revoked_pks.add(pk)
+                plans.append((cls._plan_revoke(orig_transaction, commissions.get(pk), accruals.get(pk)), None))
+
+            locked_stocks = lock_stocks({
+                pk for legs, _ in plans for leg in legs for pk in (leg.stock_from_id, leg.stock_to_id)
+            })
+            balances = {pk: stock.value for pk, stock in locked_stocks.items()}
+
+            results = []
+            for legs, error in plans:
+                if error is None:
+                    failed_leg = cls._apply_legs(legs, locked_stocks, balances)
+                    if failed_leg is legs[0]:
+                        error = ['Not enough money on foreign stock']
+                    elif failed_leg is not None:
+                        error = ['Not enough money on master stock']
+                results.append((legs if error is None else [], error))
+
+            if atomic and any(error is not None for _, error in results):
+                raise serializers.ValidationError({'results': [
+                    {'status': 'error', 'errors': error} if error is not None else {'status': 'ok'}
+                    for _, error in results
+                ]})
+
+            cls._save_balances(locked_stocks, balances)
+            bulk_create_with_pks(Transaction, [leg for legs, _ in results for leg in legs])
+            Transaction.objects.filter(pk__in=[legs[0].related_transaction_id for legs, _ in results if legs]).update(
+                type=TransactionTypes.canceled, updated=timezone.now(),
             )
+
+        return results
+
+    @classmethod
+    def _plan_batch_item(cls, user, item, stocks):
+        """
+        Validates batch item like make_transaction does and returns list of unsaved
+        transactions (legs) for it. First leg is the one shown to user.
+        """
+        stock_from = stocks.get(item['stock_from'])
+        stock_to = stocks.get(item['stock_to'])
+        tr_type = item['type']
+
+        if not stock_from or not stock_to:
+            raise serializers.ValidationError('Stock does not exist')
+
+        if stock_from.user_id != user.pk:
+            raise serializers.ValidationError("Stock don't belong to user.")
+
+        if stock_from == stock_to:
+            raise serializers.ValidationError('Need different stocks')
+
+        tr_value = get_minor_value(item['value'], stock_from.currency_id)
+        if tr_type == TransactionTypes.common:
+            if stock_from.currency_id != stock_to.currency_id:
+                raise serializers.ValidationError('Stocks must have same currency')
+            # accrued commission has no stock_to, it is saved as CommissionAccrual
+            master_stock_pk = None
+            if not is_commission_accrued():
+                master_stock_pk = master_stocks.get_pk(stock_from.currency_id, shard_key=stock_from.user_id)
+            return [
+                Transaction(type=TransactionTypes.common, value=tr_value,
+                            stock_from=stock_from, stock_to=stock_to),
+                Transaction(type=TransactionTypes.commission, value=get_commission_value(tr_value),
+                            stock_from=stock_from, stock_to_id=master_stock_pk),
+            ]
+
+        if tr_type == TransactionTypes.exchange:
+            if stock_from.user_id != stock_to.user_id:
+                raise serializers.ValidationError('Stocks must belong to same user')
+            if stock_from.currency_id == stock_to.currency_id:
+                raise serializers.ValidationError('Stocks must have different currency')
+            master_stock_to_pk = master_stocks.get_pk(stock_from.currency_id, shard_key=stock_from.user_id)
+            master_stock_from_pk = master_stocks.get_pk(stock_to.currency_id)
+            return [
+                Transaction(type=TransactionTypes.exchange, value=tr_value,
+                            stock_from=stock_from, stock_to_id=master_stock_to_pk),
+                Transaction(type=TransactionTypes.exchange,
+                            value=convert_value(tr_value, stock_from.currency_id, stock_to.currency_id),
+                            stock_from_id=master_stock_from_pk, stock_to=stock_to),
+            ]
+
+        raise ValueError('Unknown transaction type')
+
+    @classmethod
+    @metrics.instrumented('make_batch')
+    @retry_on_conflict
+    def make_batch(cls, user, items, atomic=True):
+        """
+        Executes many transactions at once: all affected stocks are locked by single query,
+        balances are changed in aggregate and transactions are inserted in bulk.
+        With atomic=False failed items are skipped, otherwise whole batch is rejected.
+        Returns list of (legs, error) pairs in the same order as items.
+        """
+        stock_pks = {item['stock_from'] for item in items} | {item['stock_to'] for item in items}
+        stocks = Stock.objects.filter(pk__in=stock_pks, is_active=True).in_bulk()
+
+        plans = []
+        for item in items:
             try:
-                cls.execute_and_save(revoke_transaction)
-            except CoreValidationError:
-                raise TransactionCantBeRevoked('Not enough money on foreign stock')
+                plans.append((cls._plan_batch_item(user, item, stocks), None))
+            except serializers.ValidationError as e:
+                plans.append(([], e.detail))
+
+        with transaction.atomic():
+            locked_stocks = lock_stocks({
+                pk for legs, _ in plans for leg in legs for pk in (leg.stock_from_id, leg.stock_to_id) if pk
+            })
+            balances = {pk: stock.value for pk, stock in locked_stocks.items()}
+
+            results = []
+            for legs, error in plans:
+                if error is None:
+                    error = cls._apply_batch_legs(legs, locked_stocks, balances)
+                results.append((legs if error is None else [], error))
+
+            if atomic and any(error is not None for _, error in results):
+                raise serializers.ValidationError({'results': [
+                    {'status': 'error', 'errors': error} if error is not None else {'status': 'ok'}
+                    for _, error in results
+                ]})
+
+            cls._save_balances(locked_stocks, balances)
+
+            accrued = [(legs[0], leg) for legs, _ in results for leg in legs if leg.stock_to_id is None]
+            # commission is linked to its transaction, which must be inserted first
+            bulk_create_with_pks(Transaction, [legs[0] for legs, _ in results if legs])
+            for legs, _ in results:
+                for leg in legs[1:]:
+                    if leg.type == TransactionTypes.commission:
+                        leg.related_transaction_id = legs[0].pk
+            bulk_create_with_pks(Transaction, [leg for legs, _ in results for leg in legs[1:] if leg.stock_to_id])
+            CommissionAccrual.objects.bulk_create([
+                CommissionAccrual(
+                    transaction=orig_transaction,
+                    stock_id=leg.stock_from_id,
+                    currency_id=locked_stocks[leg.stock_from_id].currency_id,
+                    value=leg.value,
+                )
+                for orig_transaction, leg in accrued
+            ])
+
+        return results
+
+    @staticmethod
+    def _apply_legs(legs, locked_stocks, balances):
+        """
+        Applies legs to running balances if none of stocks goes negative,
+        returns the leg which stock_from doesn't have enough money otherwise
+        """
+        new_balances = {}
+        for leg in legs:
+            stock_from = locked_stocks[leg.stock_from_id]
+            stock_to = locked_stocks.get(leg.stock_to_id)
+            if stock_to and stock_from.currency_id != stock_to.currency_id:
+                raise RuntimeError(f'Master stock has another currency than stock {stock_from.pk}')
+
+            from_balance = new_balances.get(stock_from.pk, balances[stock_from.pk]) - leg.value
+            if from_balance < 0:
+                return leg
+            new_balances[stock_from.pk] = from_balance
+            if stock_to:
+                new_balances[stock_to.pk] = new_balances.get(stock_to.pk, balances[stock_to.pk]) + leg.value
+
+        balances.update(new_balances)
+        return None
+
+    @classmethod
+    def _apply_batch_legs(cls, legs, locked_stocks, balances):
+        """Applies legs of batch item to running balances, returns error if they can't be applied"""
+        for leg in legs:
+            if leg.stock_from_id not in locked_stocks or leg.stock_to_id and leg.stock_to_id not in locked_stocks:
+                return ['Stock does not exist']
+
+        failed_leg = cls._apply_legs(legs, locked_stocks, balances)
+        if failed_leg is None:
+            return None
+        if failed_leg.stock_from_id == legs[0].stock_from_id:
+            return ["Don't have enough money on stock_from"]
+        return ["Don't have enough money on master stock"]
+
+    @staticmethod
+    def _save_balances(locked_stocks, balances):
+        """Saves changed balances of locked stocks by single query"""
+        now = timezone.now()
+        changed_stocks = []
+        for pk, value in balances.items():
+            stock = locked_stocks[pk]
+            if stock.value != value:
+                stock.value = value
+                stock.updated = now
+                changed_stocks.append(stock)
+        Stock.objects.bulk_update(changed_stocks, ['value', 'updated'])
+        for user_id in {stock.user_id for stock in changed_stocks}:
+            bump_version(get_stocks_scope(user_id))
+        publish_changes(None, changed_stocks)
+
+    @classmethod
+    @metrics.instrumented('settle_commissions')
+    @retry_on_conflict
+    def settle_commissions(cls, currency_id, limit=None):
+        """
+        Nets pending commission accruals of currency into one summary commission transaction
+        to primary master stock. Accruals locked by concurrent settlement are skipped.
+        Returns summary transaction or None if there was nothing to settle.
+        """
+        with transaction.atomic():
+            pending = CommissionAccrual.objects.filter(
+                currency_id=currency_id, settlement__isnull=True,
+            ).order_by('pk').select_for_update(skip_locked=True).values_list('pk', 'value')
+            if limit:
+                pending = pending[:limit]
+            pending = list(pending)
+            if not pending:
+                return None
+
+            total = sum(value for _, value in pending)
+            summary_transaction = Transaction(
+                type=TransactionTypes.commission,
+                value=total,
+                stock_to_id=master_stocks.get_pk(currency_id),
+            )
+            cls.execute_and_save(summary_transaction, {})
+            CommissionAccrual.objects.filter(pk__in=[pk for pk, _ in pending]).update(settlement=summary_transaction)
+
+        return summary_transaction
+
+    @classmethod
+    @metrics.instrumented('consolidate_master_stocks')
+    @retry_on_conflict
+    def consolidate_master_stocks(cls, currency_code):
+        """
+        Sweeps balances of all master sub-stocks of currency into the primary one.
+        Returns list of created consolidation transactions.
+        """
+        master_stock_pks = get_master_stock_pks(currency_code)
+        primary_pk = master_stock_pks[0]
+        transactions = []
+        with transaction.atomic():
+            locked_stocks = lock_stocks(master_stock_pks)
+            primary = locked_stocks.get(primary_pk)
+            if primary is None:
+                raise RuntimeError(f"Didn't find primary master stock for currency {currency_code}")
+
+            for shard in locked_stocks.values():
+                if shard.pk == primary_pk or shard.value <= 0:
+                    continue
+                if shard.currency_id != primary.currency_id:
+                    raise RuntimeError(f'Master stock {shard.pk} has another currency than primary one')
+                consolidation_transaction = Transaction(
+                    type=TransactionTypes.consolidation,
+                    value=shard.value,
+                    stock_from=shard,
+                    stock_to=primary,
+                )
+                cls.execute_and_save(consolidation_transaction, locked_stocks)
+                transactions.append(consolidation_transaction)
+
+        return transactions
 
 
 def get_exchange_rate(currency_from, currency_to):
-    """Temp mock for exchange rates system"""
-    currencies = {
-        'USD': 65,
-        'EUR': 75,
-        'RUB': 1,
-    }
-    rate = currencies[currency_from.code] / currencies[currency_to.code]
-    return rate
+    return rates_cache.get_rate(currency_from.code, currency_to.code)
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors: norlyakov
+:Date: 18.10.2026
+"""
+from itertools import groupby
+
+from django.conf import settings
+from django.db.models import Sum
+
+from . import caching, money
+from .errors import ExchangeRateError
+from .models import Stock
+from .rates import rates_cache
+from .registry import currencies, master_stocks
+
+VALUATION_KEY = 'stocks:valuation:{}:{}:{}'
+
+
+def get_rate_vector(base_currency):
+    """Rates of all currencies to base one taken from the same rates matrix, currency id -> rate"""
+    matrix = rates_cache.get_matrix()
+    return {
+        currency.pk: matrix[(currency.code, base_currency.code)]
+        for currency in currencies.all()
+        if (currency.code, base_currency.code) in matrix
+    }
+
+
+def value_totals(totals, base_currency, rates):
+    """
+    Values totals of currencies (currency id -> amount) in base currency, amounts are in minor units.
+    Returns (value, holdings), holdings are (currency id, amount, value) ordered by currency id.
+    """
+    holdings = []
+    for currency_id, amount in sorted(totals.items()):
+        currency = currencies.get(currency_id)
+        if currency_id not in rates:
+            raise ExchangeRateError(f"Don't have exchange rate {currency.code}/{base_currency.code}")
+        value = money.convert(amount, currency.scale, base_currency.scale, rates[currency_id])
+        holdings.append((currency_id, amount, value))
+    return sum(value for _, _, value in holdings), holdings
+
+
+def format_valuation(value, holdings, base_currency):
+    """Valuation in major units of currencies"""
+    base_scale = base_currency.scale
+    return {
+        'currency': base_currency.code,
+        'value': str(money.to_major(value, base_scale)),
+        'holdings': [
+            {
+                'currency': currencies.get(currency_id).code,
+                'amount': str(money.to_major(amount, currencies.get(currency_id).scale)),
+                'value': str(money.to_major(currency_value, base_scale)),
+            }
+            for currency_id, amount, currency_value in holdings
+        ],
+    }
+
+
+def get_user_totals(user_id):
+    """Balances of user's stocks summed by currency with single query"""
+    return dict(
+        Stock.objects.filter(user_id=user_id).values('currency_id').annotate(
+            total=Sum('value'),
+        ).order_by().values_list('currency_id', 'total')
+    )
+
+
+def get_user_valuation(user_id, base_currency):
+    """
+    Valuation of user's stocks in base currency. It is cached by version of user's stocks,
+    which is increased by his next transaction, and no longer than rates it is made by are fresh.
+    """
+    if not caching.is_enabled():
+        return value_totals(get_user_totals(user_id), base_currency, get_rate_vector(base_currency))
+
+    version = caching.get_version(caching.get_stocks_scope(user_id))
+    key = VALUATION_KEY.format(user_id, base_currency.code, version)
+    cache = caching.get_cache()
+    valuation = cache.get(key)
+    if valuation is None:
+        valuation = value_totals(get_user_totals(user_id), base_currency, get_rate_vector(base_currency))
+        cache.set(key, valuation, settings.STOCKS_SETTINGS['EXCHANGE_RATES']['TTL'])
+    return valuation
+
+
+def get_all_valuations(base_currency):
+    """
+    Yields (user id, value, holdings) of all users, master stocks are not counted.
+    Balances are summed by user and currency with single query and valued by the same rates.
+    """
+    rates = get_rate_vector(base_currency)
+    rows = Stock.objects.exclude(pk__in=master_stocks.get_all_pks()).values('user_id', 'currency_id').annotate(
+        total=Sum('value'),
+    ).order_by('user_id', 'currency_id').values_list('user_id', 'currency_id', 'total')
+    for user_id, user_rows in groupby(rows.iterator(), key=lambda row: row[0]):
+        value, holdings = value_totals({currency_id: total for _, currency_id, total in user_rows},
+                                       base_currency, rates)
+        yield user_id, value, holdings
@@ -1,20 +1,62 @@
-from rest_framework import viewsets, permissions, mixins, serializers
+from django.db.models import Q, prefetch_related_objects
+from django.http import Http404, HttpResponse
+from django.shortcuts import get_object_or_404
+from rest_framework import viewsets, permissions, mixins, serializers, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
 
-from .errors import TransactionCantBeRevoked
-from .models import Stock, Currency, Transaction
-from .serializers import StockSerializer, CurrencySerializer, TransactionSerializer
+from . import metrics
+from .archive import get_archive_boundary, needs_archive
+from .caching import cached_response, get_stocks_scope, CURRENCIES_SCOPE
+from .balances import get_balance_at
+from .errors import TransactionCantBeRevoked, ExchangeRateError
+from .export import export_transactions
+from .idempotency import idempotent
+from .money import to_major
+from .locking import get_retry_stats
+from .models import Stock, Currency, Transaction, TransactionStatuses, ArchivedTransaction
+from .pagination import UnionCursorPagination
+from .registry import currencies
+from .routers import PrimaryPinViewMixin
+from .serializers import (
+    StockSerializer, CurrencySerializer, TransactionSerializer, TransactionBatchSerializer, TransactionExportSerializer,
+    StockBalanceSerializer, TransactionRevokeBatchSerializer, StockValuationSerializer, StockBulkCreateSerializer,
+)
 from .utils import UserTransactionService
+from .valuation import get_user_valuation, format_valuation
 
 
-class CurrencyViewSet(viewsets.ReadOnlyModelViewSet):
+class CurrencyViewSet(metrics.InstrumentedViewMixin, PrimaryPinViewMixin, viewsets.ReadOnlyModelViewSet):
     queryset = Currency.objects.all()
     serializer_class = CurrencySerializer
     permission_classes = [permissions.IsAuthenticated]
 
+    @cached_response(lambda request: CURRENCIES_SCOPE)
+    def list(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs)
 
-class StockViewSet(mixins.CreateModelMixin,
+    @cached_response(lambda request: CURRENCIES_SCOPE)
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
+
+    def get_queryset(self):
+        # currencies are served from registry without queries
+        return currencies.all()
+
+    def get_object(self):
+        try:
+            currency = currencies.get(int(self.kwargs[self.lookup_field]))
+        except ValueError:
+            currency = None
+        if not currency:
+            raise Http404('No Currency matches the given query.')
+        self.check_object_permissions(self.request, currency)
+        return currency
+
+
+class StockViewSet(metrics.InstrumentedViewMixin,
+                   PrimaryPinViewMixin,
+                   mixins.CreateModelMixin,
                    mixins.RetrieveModelMixin,
                    mixins.ListModelMixin,
                    viewsets.GenericViewSet):
@@ -26,11 +68,58 @@ class StockViewSet(mixins.CreateModelMixin,
         queryset = super().get_queryset()
         return queryset.filter(user=self.request.user)
 
+    @cached_response(lambda request: get_stocks_scope(request.user.pk))
+    def list(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs)
+
+    @cached_response(lambda request: get_stocks_scope(request.user.pk))
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
+
     def perform_create(self, serializer):
         serializer.save(user=self.request.user)
 
+    @action(methods=['post'], detail=False)
+    def bulk(self, request, *args, **kwargs):
+        """Creates user's stocks of given currencies, stocks which exist already are returned as is"""
+        serializer = StockBulkCreateSerializer(data=request.data, context=self.get_serializer_context())
+        serializer.is_valid(raise_exception=True)
+        stocks = serializer.save()
+        return Response({'results': StockSerializer(stocks, many=True).data}, status=status.HTTP_201_CREATED)
 
-class TransactionViewSet(mixins.CreateModelMixin,
+    @action(methods=['get'], detail=True)
+    def balance(self, request, *args, **kwargs):
+        """Balance of stock at given time"""
+        stock = self.get_object()
+        params = StockBalanceSerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+
+        value = get_balance_at(stock, params.validated_data['at'])
+        currency = currencies.get(stock.currency_id)
+        return Response({
+            'stock': stock.pk,
+            'currency': currency.code,
+            'at': params.data['at'],
+            'value': str(to_major(value, currency.scale)),
+        })
+
+    @action(methods=['get'], detail=False)
+    def valuation(self, request, *args, **kwargs):
+        """Total value of user's stocks in given currency"""
+        params = StockValuationSerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+
+        base_currency = params.validated_data['currency']
+        try:
+            value, holdings = get_user_valuation(request.user.pk, base_currency)
+        except ExchangeRateError as e:
+            raise serializers.ValidationError({'currency': [str(e)]})
+        return Response(format_valuation(value, holdings, base_currency))
+
+
+class TransactionViewSet(metrics.InstrumentedViewMixin,
+                         PrimaryPinViewMixin,
+                         mixins.CreateModelMixin,
                          mixins.RetrieveModelMixin,
                          mixins.ListModelMixin,
                          viewsets.GenericViewSet):
@@ -38,10 +127,56 @@ class TransactionViewSet(mixins.CreateModelMixin,
     serializer_class = TransactionSerializer
     permission_classes = [permissions.IsAuthenticated]
 
+    pagination_class = UnionCursorPagination
+
+    @idempotent
+    def create(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        instance = serializer.save()
+        # queued transaction is only accepted yet
+        if instance.status == TransactionStatuses.pending:
+            status_code = status.HTTP_202_ACCEPTED
+        else:
+            status_code = status.HTTP_201_CREATED
+        return Response(serializer.data, status=status_code, headers=self.get_success_headers(serializer.data))
+
     def get_queryset(self):
         queryset = super().get_queryset()
         return queryset.filter(stock_from__user=self.request.user) | queryset.filter(stock_to__user=self.request.user)
 
+    def get_archive_queryset(self):
+        queryset = ArchivedTransaction.objects.all()
+        return queryset.filter(stock_from__user=self.request.user) | queryset.filter(stock_to__user=self.request.user)
+
+    @staticmethod
+    def get_history_legs(queryset, stock_pks):
+        """User's history as separate querysets for each stock and direction, to use indexes by stock"""
+        return [queryset.filter(stock_from=pk) for pk in stock_pks] + [queryset.filter(stock_to=pk) for pk in stock_pks]
+
+    def list(self, request, *args, **kwargs):
+        stock_pks = list(Stock.objects.filter(user=self.request.user).values_list('pk', flat=True))
+        # archive is read only by pages which reach its transactions
+        page = self.paginator.paginate_legs(
+            self.get_history_legs(super().get_queryset(), stock_pks), request, view=self,
+            archive_legs=self.get_history_legs(ArchivedTransaction.objects.all(), stock_pks),
+            archive_boundary=get_archive_boundary(),
+        )
+        # amounts are shown in units of stocks' currency
+        prefetch_related_objects(page, 'stock_from')
+        prefetch_related_objects([item for item in page if not item.stock_from_id], 'stock_to')
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
+
+    def retrieve(self, request, *args, **kwargs):
+        try:
+            instance = self.get_object()
+        except Http404:
+            # transaction of closed month is looked for in archive
+            instance = get_object_or_404(self.get_archive_queryset(), pk=self.kwargs[self.lookup_field])
+        serializer = self.get_serializer(instance)
+        return Response(serializer.data)
+
     @action(methods=['post'], detail=True)
     def revoke(self, request, *args, **kwargs):
         orig_transaction = self.get_object()
@@ -52,3 +187,52 @@ class TransactionViewSet(mixins.CreateModelMixin,
             raise serializers.ValidationError(str(e))
 
         return Response({'status': 'Transaction revoked'})
+
+    @action(methods=['post'], detail=False, url_path='revoke', url_name='revoke-batch',
+            permission_classes=[permissions.IsAdminUser])
+    def revoke_batch(self, request, *args, **kwargs):
+        """Revokes transactions of any users after incident, available to staff only"""
+        serializer = TransactionRevokeBatchSerializer(data=request.data, context=self.get_serializer_context())
+        serializer.is_valid(raise_exception=True)
+        results = serializer.save()
+        return Response({'results': results})
+
+    @action(methods=['post'], detail=False)
+    @idempotent
+    def batch(self, request, *args, **kwargs):
+        serializer = TransactionBatchSerializer(data=request.data, context=self.get_serializer_context())
+        serializer.is_valid(raise_exception=True)
+        results = serializer.save()
+        return Response({'results': results}, status=status.HTTP_201_CREATED)
+
+    @action(methods=['get'], detail=False)
+    def export(self, request, *args, **kwargs):
+        params = TransactionExportSerializer(data=request.query_params, context=self.get_serializer_context())
+        params.is_valid(raise_exception=True)
+        filters = params.validated_data
+
+        querysets = [self.get_queryset()]
+        if needs_archive(filters.get('date_from'), get_archive_boundary()):
+            querysets.insert(0, self.get_archive_queryset())
+        return export_transactions([self.filter_export(queryset, filters) for queryset in querysets], filters['output'])
+
+    @staticmethod
+    def filter_export(queryset, filters):
+        if 'stock' in filters:
+            queryset = queryset.filter(Q(stock_from=filters['stock']) | Q(stock_to=filters['stock']))
+        if 'date_from' in filters:
+            queryset = queryset.filter(created__gte=filters['date_from'])
+        if 'date_to' in filters:
+            queryset = queryset.filter(created__lt=filters['date_to'])
+        return queryset
+
+
+def metrics_view(request):
+    """Metrics of this process in Prometheus text format, available when STOCKS_SETTINGS['METRICS_ENABLED'] is set"""
+    if not metrics.is_enabled():
+        raise Http404()
+
+    lines = [metrics.registry.render()]
+    for name, count in get_retry_stats().items():
+        lines.append(f'# TYPE stocks_lock_{name}_total counter\nstocks_lock_{name}_total {count}\n')
+    return HttpResponse(''.join(lines), content_type=metrics.CONTENT_TYPE)
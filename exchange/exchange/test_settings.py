@@ -0,0 +1,16 @@
+"""
+Django settings for running exchange project tests:
+
+    python manage.py test --settings=exchange.test_settings
+
+Replica alias is a mirror of the test database, so reads routed to it
+are checked end to end without a real replica.
+"""
+
+from .settings import *  # noqa: F401,F403
+from .settings import DATABASES
+
+DATABASES['replica'] = {
+    **DATABASES['default'],
+    'TEST': {'MIRROR': 'default'},
+}